@@ -40,3 +40,10 @@ def create_dbc(u):
 
 dbc = create_dbc(default_user)
 
+
+# Settings for the connection pool shared by all requests within a process.
+# Connections are recycled after pool_recycle seconds to avoid connections
+# being closed by the MySQL server (wait_timeout).
+pool_size = 5
+max_overflow = 10
+pool_recycle = 3600
@@ -24,7 +24,9 @@ simulator_config = os.path.join(top_dir, "phenology", "simulator.conf")
 crop_end_type = "maturity"
 crop_start_type = "sowing"
 
-# Historic_years, no. of years to fetch historic weather
+# Historic_years, no. of years to fetch historic weather. These settings are
+# only used for weather data providers without window, see
+# `data_providers.simulation_window()`.
 historic_years = 1
 # Future_years, no. of years to fetch lta weather in the future
 future_years = 1
@@ -42,3 +44,59 @@ weather_alert_limit = {"DEFAULT": 3,
                        signals.FOG_STRESS: 3
                        }
 
+# Weather data providers are cached per grid cell so that all requests for
+# the same grid cell share the same weather data. The cache size defines
+# the maximum number of grid cells kept in memory (least recently used grid
+# cells are evicted first). The check interval defines how often (in seconds)
+# the database is checked for a new load of observed weather data, which
+# invalidates the cache.
+weather_cache_size = 256
+weather_version_check_interval = 300
+
+# Engine used for phenology-only simulations: "numpy" uses the vectorized
+# phenology model, "pcse" runs the day-by-day simulation in the PCSE Engine.
+# Both give identical results.
+phenology_engine = "numpy"
+
+# The cumulative development rates for phenology-only queries are indexed
+# per grid cell and set of crop temperature/daylength parameters. This
+# defines the maximum number of indexes kept in memory.
+thermal_time_index_size = 256
+
+# Results of the service runner are cached under the grid cell, sowing date,
+# crop/variety/season, weather data version and run date. The backend can
+# be "memory" (LRU cache local to the process), "disk" (files in
+# result_cache_directory, shared between processes) or None to disable the
+# cache. The cache is cleared when the crop tables or the observed weather
+# data change. New observed weather data are checked for every
+# result_cache_check_interval seconds, edits of the crop tables are taken
+# from the crop catalog (see crop_catalog_check_interval).
+result_cache_backend = "memory"
+result_cache_size = 10000
+result_cache_directory = os.path.join(top_dir, "cache", "results")
+result_cache_check_interval = 300
+
+# The daily simulation with `runners.incremental_service_runner` continues from
+# a checkpoint of the simulation state at the last day with observed weather
+# data. Checkpoints are kept in memory (at most checkpoint_store_size) and,
+# when checkpoint_directory is not None, as files in that directory so that
+# they are shared between processes.
+checkpoint_store_size = 10000
+checkpoint_directory = None
+
+# The crop parameters and alerts are read in bulk into the crop catalog of each
+# process. The check interval defines how often (in seconds) the checksums of
+# the crop tables are checked for edits, which reload the catalog.
+crop_catalog_check_interval = 300
+
+# The durations of the stages of the requests (crop data, alerts, weather data, simulation,
+# results) are aggregated per process into histograms, see `phenology.instrumentation`. The
+# buckets are the upper bounds (seconds) of the histograms. When metrics_file is not None, the
+# histograms are written in Prometheus text format to that file every metrics_write_interval
+# seconds, "{pid}" in the file name is replaced by the process id. A fraction
+# timing_sample_rate of the requests gets the durations of its stages added to the results
+# under the key "timings".
+latency_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+metrics_file = None
+metrics_write_interval = 60
+timing_sample_rate = 0.0
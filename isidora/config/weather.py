@@ -13,3 +13,37 @@ import os, sys
 
 LTA_start_year = 2010
 LTA_end_year = 2019
+
+###############################################################################
+#    SETTINGS FOR the weather forecast
+###############################################################################
+
+# The weather forecast is ingested once per issue day for all grid cells from
+# a forecast source (see `phenology.forecast_sources`) into the forecast store,
+# which keeps the forecasts of the last forecast_store_keep_issues issue days.
+forecast_source = "gfs"
+forecast_store_directory = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                        "cache", "forecasts")
+forecast_store_keep_issues = 7
+
+# Offset of the local time of the area (Myanmar Time, UTC+06:30) from UTC. The
+# forecast issue day and the days of the forecast are taken in local time.
+SECONDS_from_UTC = int(6.5 * 3600)
+
+# Location and file names of the 3-hourly GFS forecast downloads
+GFS_download_directory = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                      "cache", "GFS_3hrly_downloads")
+GFS_forecast_file = "GFS_10_day_3hr_forecast_%Y%m%d.nc"
+
+###############################################################################
+#    SETTINGS FOR the weather archive
+###############################################################################
+
+# When use_weather_archive is True, the grid weather data are read from the
+# local weather archive (see `phenology.weather_archive`) instead of the
+# database. The archive is written by an export job after each daily load of
+# observed weather data and keeps the last weather_archive_keep_exports exports.
+use_weather_archive = False
+weather_archive_directory = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                         "cache", "weather_archive")
+weather_archive_keep_exports = 2
@@ -1,7 +1,22 @@
+from . import instrumentation
+from . import records
+from . import grid_index
+from . import data_access
+from . import crop_template
+from . import crop_catalog
+from . import forecast_store
 from . import data_providers
+from . import weather_archive
 from . import main_simulator
 from . import management_alerts_simulator
 from . import weather_alerts_simulator
 from . import signals
 from . import phenology_simulator
+from . import vectorized_phenology
+from . import vectorized_alerts
+from . import thermal_time
+from . import weather_cache
+from . import result_cache
+from . import checkpoints
+from . import profiling
 from . import runners
\ No newline at end of file
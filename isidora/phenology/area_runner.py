@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+# Copyright Alterra, Wageningen-UR
+# Allard de Wit (allard.dewit@wur.nl), March 2023
+"""Area runner for simulating phenology and alerts for all grid cells in the area of interest.
+
+The area of interest is the bounding box defined by `config.lat_bnds` and `config.lon_bnds`,
+divided into a raster with cells of `config.cell_size` aligned with the grid. For a given crop and sowing date, the
+phenology and weather alerts are simulated with the vectorized models for every raster cell
+that is part of the grid. The raster is processed in spatial chunks which are distributed over
+a pool of worker processes, so only the weather data of the cells of a chunk are kept in memory.
+Each chunk is written to the output directory when finished, so an interrupted run can be
+resumed by running it again with the same output directory and run date. The chunks are kept in
+a directory per chunk size and version of the weather data (the last day of observed weather data
+and the forecast issue day), so chunks of another chunk size or of outdated weather data are never
+picked up.
+
+The results are gridded arrays with the BBCH stage dates and maturity date (as days since the
+sowing date, -1 if not reached) and the number of alerts for each weather alert type. They are
+written as NumPy (.npz) file and, when xarray is available, as NetCDF file.
+
+Run it from the isidora directory as::
+
+    python -m phenology.area_runner 2023-06-15 12 output_dir --workers 8
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import datetime as dt
+import logging
+import os
+import tempfile
+import time
+
+import numpy as np
+
+try:
+    import xarray as xr
+except ImportError:
+    xr = None
+
+import config
+from pcse.exceptions import PCSEError
+from . import data_access
+from . import data_providers as dp
+from . import signals
+from . import vectorized_alerts
+from . import vectorized_phenology
+
+logger = logging.getLogger(__name__)
+
+# Weather alert types that are counted in the output
+alert_signals = (signals.TMAX_STRESS, signals.TMIN_STRESS, signals.RAIN_STRESS,
+                 signals.RHMAX_STRESS, signals.FOG_STRESS)
+
+# Status of raster cells
+STATUS_OK = 0
+STATUS_FAILED = 1
+STATUS_NO_GRID = -1
+
+
+def area_raster():
+    """Returns the latitude and longitude of the centres of the raster cells covering the area
+    of interest, latitudes ascending. The raster is aligned with the centroids of the grid.
+    """
+    grid_index = dp.get_grid_index()
+
+    def axis(origin, bounds):
+        first = int(np.ceil((bounds[0] - origin) / config.cell_size - 1e-6))
+        last = int(np.floor((bounds[1] - origin) / config.cell_size + 1e-6))
+        return origin + np.arange(first, last + 1) * config.cell_size
+
+    return axis(grid_index.lat0, config.lat_bnds), axis(grid_index.lon0, config.lon_bnds)
+
+
+class CropModels(object):
+    """Phenology model and alert evaluators for a crop, variety and season.
+    """
+
+    def __init__(self, crop_no, variety_no, season_no):
+        session = data_access.get_session()
+        crop = dp.CropDataProvider(session, crop_no, variety_no)
+        management_alerts, _ = dp.fetch_management_alerts(session, crop_no, variety_no, season_no)
+        weather_alerts, _ = dp.fetch_weather_alerts(session, crop_no, variety_no, season_no)
+
+        self.max_duration = crop["MAX_DURATION"]
+        self.phenology = vectorized_phenology.VectorizedBBCHPhenology(crop)
+        self.weather_alerts = vectorized_alerts.WeatherAlertEvaluator(weather_alerts)
+        self.management_alerts = vectorized_alerts.ManagementAlertEvaluator(management_alerts)
+
+
+# The CropModels of this worker process keyed on (crop_no, variety_no, season_no)
+_crop_models = {}
+
+
+def get_crop_models(crop_no, variety_no, season_no):
+    """Returns the CropModels, loaded once per worker process."""
+    key = (crop_no, variety_no, season_no)
+    if key not in _crop_models:
+        _crop_models[key] = CropModels(crop_no, variety_no, season_no)
+    return _crop_models[key]
+
+
+def clear_crop_models():
+    """Discards the CropModels of this process, so that they are built again from the crop
+    catalog at the next call of `get_crop_models()`.
+    """
+    _crop_models.clear()
+
+
+def empty_chunk(shape, bbch_codes):
+    """Returns a dict with arrays for the output variables of a chunk."""
+    arrays = {"grid_no": np.full(shape, -1, dtype=np.int32),
+              "status": np.full(shape, STATUS_NO_GRID, dtype=np.int8),
+              "maturity_day": np.full(shape, -1, dtype=np.int16),
+              "management_alerts": np.zeros(shape, dtype=np.int16)}
+    for code in bbch_codes:
+        arrays[code] = np.full(shape, -1, dtype=np.int16)
+    for signal in alert_signals:
+        arrays[signal] = np.zeros(shape, dtype=np.int16)
+    return arrays
+
+
+def run_chunk(latitudes, longitudes, sowing_date, crop_no, variety_no, season_no, run_date):
+    """Simulates all grid cells in a chunk of the raster.
+
+    This function is executed in the worker processes.
+
+    :param latitudes: latitudes of the rows of the chunk
+    :param longitudes: longitudes of the columns of the chunk
+    :return: a dict with the output arrays of the chunk
+    """
+    models = get_crop_models(crop_no, variety_no, season_no)
+    lats, lons = np.meshgrid(latitudes, longitudes, indexing="ij")
+    grid_no, elevation = dp.get_grid_index().lookup_many(lats.ravel(), lons.ravel())
+    grid_no = grid_no.reshape(lats.shape)
+    elevation = elevation.reshape(lats.shape)
+
+    arrays = empty_chunk(lats.shape, models.phenology.bbch_codes)
+    arrays["grid_no"][:] = grid_no
+    start_date, end_date = dp.simulation_window(sowing_date, models.max_duration)
+    for i, j in zip(*np.nonzero(grid_no >= 0)):
+        try:
+            wdp = dp.CombinedECMWFDarkSkyWeatherDataProvider(lats[i, j], lons[i, j], grid_no=int(grid_no[i, j]),
+                                                             elevation=None if np.isnan(elevation[i, j])
+                                                             else float(elevation[i, j]),
+                                                             start_date=start_date, end_date=end_date)
+            result = models.phenology.run(wdp, sowing_date, models.max_duration)
+            counts = models.weather_alerts.count_alerts(result, run_date)
+            nmanagement = len(models.management_alerts.evaluate(result))
+        except Exception as e:
+            logger.warning("Simulation failed for grid %s: %s" % (grid_no[i, j], e))
+            arrays["status"][i, j] = STATUS_FAILED
+            continue
+
+        for code, day in zip(result.bbch_codes, result.stage_days):
+            arrays[code][i, j] = day
+        arrays["maturity_day"][i, j] = result.stage_days[-1]
+        for signal, count in counts.items():
+            arrays[signal][i, j] = count
+        arrays["management_alerts"][i, j] = nmanagement
+        arrays["status"][i, j] = STATUS_OK
+    return arrays
+
+
+class AreaRunner(object):
+    """Runs a crop and sowing date for all grid cells in the area of interest.
+
+    :param sowing_date: date object with the sowing date
+    :param crop_no: The crop number
+    :param variety_no: The variety number (defaults to -1, generic variety)
+    :param season_no: The season number (defaults to -1: generic season)
+    :param output_dir: directory for the chunks and the final output
+    :param chunk_size: the number of rows and columns of the chunks
+    :param workers: the number of worker processes, defaults to the number of CPUs
+    :param run_date: the date of the run which determines the range of trusted weather data
+        for the weather alerts, defaults to today.
+    """
+
+    def __init__(self, sowing_date, crop_no, variety_no=-1, season_no=-1, output_dir=".", chunk_size=25,
+                 workers=None, run_date=None):
+        self.sowing_date = sowing_date
+        self.crop_no = crop_no
+        self.variety_no = variety_no
+        self.season_no = season_no
+        self.chunk_size = chunk_size
+        self.workers = workers or os.cpu_count()
+        self.run_date = dt.date.today() if run_date is None else run_date
+
+        # The run date is part of the name, as the weather alerts depend on it
+        self.name = "crop%s_var%s_season%s_%s_run%s" % (crop_no, variety_no, season_no, sowing_date.strftime("%Y%m%d"),
+                                                        self.run_date.strftime("%Y%m%d"))
+        self.output_dir = output_dir
+        weather_version, forecast_issue_day = self.weather_versions()
+        self.chunk_dir = os.path.join(output_dir, "%s_chunks%i_weather%s_forecast%s" %
+                                      (self.name, chunk_size, weather_version.strftime("%Y%m%d"),
+                                       forecast_issue_day.strftime("%Y%m%d")))
+        os.makedirs(self.chunk_dir, exist_ok=True)
+        self.latitudes, self.longitudes = area_raster()
+
+    @staticmethod
+    def weather_versions():
+        """Returns the last day of observed weather data in the database and the issue day of
+        the weather forecast used by the simulations."""
+        connection = dp.connect_weather_db()
+        try:
+            weather_version = dp.fetch_weather_version(connection)
+        finally:
+            connection.close()
+        return weather_version, dp.current_forecast_issue_day()
+
+    def chunks(self):
+        """Returns a list of (row, col) offsets of the chunks."""
+        return [(r, c) for r in range(0, len(self.latitudes), self.chunk_size)
+                for c in range(0, len(self.longitudes), self.chunk_size)]
+
+    def _chunk_fname(self, row, col):
+        return os.path.join(self.chunk_dir, "chunk_%04i_%04i.npz" % (row, col))
+
+    def run(self):
+        """Runs all chunks that have not been written by an earlier run and writes the output.
+
+        :return: a dict with the output arrays
+        """
+        todo = [(r, c) for r, c in self.chunks() if not os.path.exists(self._chunk_fname(r, c))]
+        logger.info("Running %i of %i chunks for %s" % (len(todo), len(self.chunks()), self.name))
+
+        t_start = time.time()
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            futures = {}
+            for r, c in todo:
+                future = executor.submit(run_chunk, self.latitudes[r:r + self.chunk_size],
+                                         self.longitudes[c:c + self.chunk_size], self.sowing_date,
+                                         self.crop_no, self.variety_no, self.season_no, self.run_date)
+                futures[future] = (r, c)
+            for ndone, future in enumerate(as_completed(futures), 1):
+                r, c = futures[future]
+                self._write_chunk(self._chunk_fname(r, c), future.result())
+                logger.info("Finished chunk %i/%i after %i seconds" % (ndone, len(todo), time.time() - t_start))
+
+        arrays = self.assemble()
+        self.write_output(arrays)
+        return arrays
+
+    def _write_chunk(self, fname, arrays):
+        # Write to a temporary file first so that only complete chunks are picked up when resuming
+        fd, tmp_fname = tempfile.mkstemp(dir=self.chunk_dir, suffix=".npz.tmp")
+        with os.fdopen(fd, "wb") as fp:
+            np.savez(fp, **arrays)
+        os.replace(tmp_fname, fname)
+
+    def assemble(self):
+        """Assembles the chunks into arrays covering the area of interest."""
+        shape = (len(self.latitudes), len(self.longitudes))
+        arrays = None
+        for r, c in self.chunks():
+            fname = self._chunk_fname(r, c)
+            expected = (len(self.latitudes[r:r + self.chunk_size]), len(self.longitudes[c:c + self.chunk_size]))
+            with np.load(fname) as chunk:
+                if arrays is None:
+                    bbch_codes = [name for name in chunk.files if name.startswith("BBCH")]
+                    arrays = empty_chunk(shape, bbch_codes)
+                for name in chunk.files:
+                    values = chunk[name]
+                    if values.shape != expected:
+                        msg = "Chunk %s has shape %s, expected %s" % (fname, values.shape, expected)
+                        raise PCSEError(msg)
+                    arrays[name][r:r + values.shape[0], c:c + values.shape[1]] = values
+        return arrays
+
+    def write_output(self, arrays):
+        """Writes the output arrays as NumPy file and, when xarray is available, as NetCDF file."""
+        fname = os.path.join(self.output_dir, self.name)
+        np.savez_compressed(fname + ".npz", latitude=self.latitudes, longitude=self.longitudes, **arrays)
+        if xr is None:
+            logger.warning("xarray not available, NetCDF output is not written.")
+            return
+
+        attrs = {"sowing_date": self.sowing_date.strftime("%Y-%m-%d"),
+                 "run_date": self.run_date.strftime("%Y-%m-%d"),
+                 "crop_no": self.crop_no, "variety_no": self.variety_no, "season_no": self.season_no}
+        ds = xr.Dataset({name: (("latitude", "longitude"), values) for name, values in arrays.items()},
+                        coords={"latitude": self.latitudes, "longitude": self.longitudes}, attrs=attrs)
+        for name in ds.data_vars:
+            if name.startswith("BBCH") or name == "maturity_day":
+                ds[name].attrs.update(units="days since sowing", missing_value=-1)
+            elif name in alert_signals or name == "management_alerts":
+                ds[name].attrs.update(units="number of alerts")
+        ds.to_netcdf(fname + ".nc")
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Run phenology and alerts for all grid cells in the area.")
+    parser.add_argument("sowing_date", help="Sowing date as YYYY-MM-DD")
+    parser.add_argument("crop_no", type=int, help="The crop number")
+    parser.add_argument("output_dir", help="Output directory, also used for resuming an interrupted run")
+    parser.add_argument("--variety_no", type=int, default=-1, help="The variety number")
+    parser.add_argument("--season_no", type=int, default=-1, help="The season number")
+    parser.add_argument("--chunk-size", type=int, default=25, help="Number of rows/columns per chunk")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes.")
+    parser.add_argument("--run-date", default=None, help="Date of the run as YYYY-MM-DD for the range of "
+                                                         "trusted weather data, defaults to today.")
+    args = parser.parse_args(args)
+
+    sowing_date = dt.datetime.strptime(args.sowing_date, "%Y-%m-%d").date()
+    run_date = None
+    if args.run_date is not None:
+        run_date = dt.datetime.strptime(args.run_date, "%Y-%m-%d").date()
+    runner = AreaRunner(sowing_date, args.crop_no, args.variety_no, args.season_no, output_dir=args.output_dir,
+                        chunk_size=args.chunk_size, workers=args.workers, run_date=run_date)
+    runner.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,384 @@
+# -*- coding: utf-8 -*-
+# Copyright Alterra, Wageningen-UR
+# Allard de Wit (allard.dewit@wur.nl), March 2023
+"""Batch runner for simulating phenology, management and weather alerts for many plots.
+
+The plots are read from a CSV or Parquet file with the columns latitude, longitude, sowing_date,
+crop_no and optionally variety_no, season_no and plot_id. The plots are grouped by grid cell so
+that the weather data of each grid cell are loaded only once, and the grid cells are distributed
+over a pool of worker processes. Results are written incrementally to a JSONL file (one line per
+plot) or to a directory with Parquet files. A checkpoint file next to the output keeps track of
+the grid cells that have been written, so that an interrupted job can be resumed with `--resume`.
+
+Run it from the isidora directory as::
+
+    python -m phenology.batch_runner plots.csv results.jsonl --workers 8
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import datetime as dt
+import json
+import logging
+import os
+import time
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+from . import data_access
+from . import data_providers as dp
+from . import records
+from . import runners
+
+logger = logging.getLogger(__name__)
+
+
+def read_plots(fname):
+    """Reads the plots from a CSV or Parquet file and resolves their grid cells.
+
+    :param fname: file name, files ending in .parquet are read as Parquet, otherwise as CSV
+    :return: a DataFrame with one row per plot and the columns plot_id, latitude, longitude,
+        sowing_date, crop_no, variety_no, season_no, grid_no and elevation.
+    """
+    if fname.endswith(".parquet"):
+        df = pd.read_parquet(fname)
+    else:
+        df = pd.read_csv(fname)
+    df = df.rename(columns={"lat": "latitude", "lon": "longitude"})
+
+    missing = {"latitude", "longitude", "sowing_date", "crop_no"} - set(df.columns)
+    if missing:
+        msg = "Columns missing in %s: %s" % (fname, ", ".join(sorted(missing)))
+        raise ValueError(msg)
+    if "plot_id" not in df.columns:
+        df["plot_id"] = range(len(df))
+    for column in ("variety_no", "season_no"):
+        if column not in df.columns:
+            df[column] = -1
+    df["sowing_date"] = pd.to_datetime(df["sowing_date"]).dt.date
+
+    df["grid_no"], df["elevation"] = dp.get_grid_index().lookup_many(df.latitude.values, df.longitude.values)
+    return df
+
+
+def _plot_record(plot, result=None, error=None):
+    """Returns the output record of a plot with its results or the error."""
+    record = {"plot_id": plot["plot_id"],
+              "grid_no": int(plot["grid_no"]),
+              "latitude": float(plot["latitude"]),
+              "longitude": float(plot["longitude"]),
+              "sowing_date": plot["sowing_date"],
+              "crop_no": int(plot["crop_no"]),
+              "variety_no": int(plot["variety_no"]),
+              "season_no": int(plot["season_no"])}
+    if error is not None:
+        record["error"] = error
+    else:
+        for name in ("phenology", "weatheralerts", "managementalerts"):
+            record[name] = result[name]
+    return record
+
+
+def _weather_window(groups):
+    """Returns the first and last day of the weather data needed for simulating all plots.
+
+    :param groups: dict with lists of plots keyed on (crop_no, variety_no, season_no)
+    :return: a tuple (start_date, end_date), (None, None) for all weather data of the grid
+        cell when the simulation period of a crop cannot be determined.
+    """
+    session = data_access.get_session()
+    windows = []
+    for (crop_no, variety_no, season_no), group in groups.items():
+        try:
+            max_duration = dp.CropDataProvider(session, crop_no, variety_no)["MAX_DURATION"]
+        except Exception:
+            # Failing crops are reported by the runner for each plot
+            return None, None
+        windows.extend(dp.simulation_window(plot["sowing_date"], max_duration) for plot in group)
+    return min(w[0] for w in windows), max(w[1] for w in windows)
+
+
+def run_grid(grid_no, elevation, plots, phenology_engine=None, run_date=None):
+    """Runs all plots in a grid cell, the weather data of the grid cell are loaded only once.
+
+    This function is executed in the worker processes.
+
+    :param grid_no: the grid number
+    :param elevation: the elevation of the grid cell
+    :param plots: list of dicts with the plots in the grid cell
+    :param phenology_engine: the phenology engine, see `runners.sowing_dates_runner`
+    :param run_date: the date of the run for the weather alerts, see `runners.sowing_dates_runner`
+    :return: a list with an output record for each plot
+    """
+    groups = {}
+    for plot in plots:
+        key = (int(plot["crop_no"]), int(plot["variety_no"]), int(plot["season_no"]))
+        groups.setdefault(key, []).append(plot)
+
+    try:
+        start_date, end_date = _weather_window(groups)
+        wdp = dp.CombinedECMWFDarkSkyWeatherDataProvider(plots[0]["latitude"], plots[0]["longitude"],
+                                                         grid_no=grid_no, elevation=elevation,
+                                                         start_date=start_date, end_date=end_date)
+    except Exception as e:
+        msg = "Failed to retrieve weather data for grid %s: %s" % (grid_no, e)
+        return [_plot_record(plot, error=msg) for plot in plots]
+
+    output = []
+
+    for (crop_no, variety_no, season_no), group in groups.items():
+        sowing_dates = [plot["sowing_date"] for plot in group]
+        try:
+            results = runners.sowing_dates_runner(wdp, sowing_dates, crop_no, variety_no, season_no,
+                                                  phenology_engine=phenology_engine, run_date=run_date)
+            output.extend(_plot_record(plot, result) for plot, result in zip(group, results))
+        except Exception:
+            # Run the plots one by one to find which plots fail
+            for plot in group:
+                try:
+                    result, = runners.sowing_dates_runner(wdp, [plot["sowing_date"]], crop_no, variety_no,
+                                                          season_no, phenology_engine=phenology_engine,
+                                                          run_date=run_date)
+                    output.append(_plot_record(plot, result))
+                except Exception as e:
+                    output.append(_plot_record(plot, error=str(e)))
+    return output
+
+
+class JSONLWriter(object):
+    """Writes output records as lines of JSON to a file.
+
+    :param fname: the output file
+    :param position: position in the file up to which records have been written by a previous
+        run, the file is truncated to this position. None starts a new file.
+    """
+
+    def __init__(self, fname, position=None):
+        self.fname = fname
+        if position is None:
+            self._fp = open(fname, "wb")
+        else:
+            self._fp = open(fname, "r+b")
+            self._fp.truncate(position)
+            self._fp.seek(position)
+
+    def write(self, output_records):
+        """Writes the records and returns the position in the file after writing."""
+        lines = [records.dumps(r) + "\n" for r in output_records]
+        self._fp.write("".join(lines).encode("utf-8"))
+        self._fp.flush()
+        os.fsync(self._fp.fileno())
+        return self._fp.tell()
+
+    def close(self):
+        self._fp.close()
+
+
+class ParquetWriter(object):
+    """Writes output records as Parquet files (parts) into a directory.
+
+    :param dirname: the output directory
+    :param position: the number of parts written by a previous run, parts with a higher number
+        are removed. None starts a new output directory.
+    """
+
+    def __init__(self, dirname, position=None):
+        if pq is None:
+            msg = "Writing Parquet files requires the pyarrow package."
+            raise RuntimeError(msg)
+        self.dirname = dirname
+        os.makedirs(dirname, exist_ok=True)
+        self.nparts = 0 if position is None else position
+        for fname in os.listdir(dirname):
+            if fname.startswith("part-") and fname.endswith(".parquet") and \
+                    int(fname[5:-8]) >= self.nparts:
+                os.remove(os.path.join(dirname, fname))
+
+    def write(self, output_records):
+        """Writes the records into a new part and returns the number of parts written."""
+        rows = []
+        for r in output_records:
+            row = {name: r[name] for name in ("plot_id", "grid_no", "latitude", "longitude", "sowing_date",
+                                               "crop_no", "variety_no", "season_no")}
+            row["error"] = r.get("error")
+            for name in ("phenology", "weatheralerts", "managementalerts"):
+                row[name] = None if name not in r else records.dumps(r[name])
+            rows.append(row)
+        table = pa.Table.from_pandas(pd.DataFrame(rows), preserve_index=False)
+        pq.write_table(table, os.path.join(self.dirname, "part-%05i.parquet" % self.nparts))
+        self.nparts += 1
+        return self.nparts
+
+    def close(self):
+        pass
+
+
+class Checkpoint(object):
+    """Keeps track of the grid cells written to the output.
+
+    Each line in the checkpoint file contains the grid cells written and the position of
+    the output writer after writing them.
+
+    :param fname: the checkpoint file
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.grids = set()
+        self.position = None
+
+    def load(self):
+        """Loads the grid cells and the output position from an existing checkpoint file."""
+        if not os.path.exists(self.fname):
+            return
+        with open(self.fname) as fp:
+            for line in fp:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Incomplete last line of an interrupted run
+                    break
+                self.grids.update(entry["grids"])
+                self.position = entry["position"]
+
+    def reset(self):
+        if os.path.exists(self.fname):
+            os.remove(self.fname)
+
+    def add(self, grids, position):
+        """Records that the grid cells are written and the output writer is at position."""
+        with open(self.fname, "a") as fp:
+            fp.write(json.dumps({"grids": sorted(grids), "position": position}) + "\n")
+            fp.flush()
+            os.fsync(fp.fileno())
+        self.grids.update(grids)
+        self.position = position
+
+
+class BatchRunner(object):
+    """Runs the plots in a pool of worker processes and writes the results incrementally.
+
+    :param plots: DataFrame with plots, see `read_plots()`
+    :param output: the output file (JSONL) or directory (Parquet, when ending in .parquet)
+    :param workers: the number of worker processes, defaults to the number of CPUs
+    :param resume: resume from the checkpoint of an earlier run
+    :param flush_size: the number of records that are buffered before writing
+    :param phenology_engine: the phenology engine, see `runners.sowing_dates_runner`
+    :param run_date: the date of the run which determines the range of trusted weather data
+        for the weather alerts, defaults to today. All plots are run with the same run date.
+    """
+    progress_interval = 30
+
+    def __init__(self, plots, output, workers=None, resume=False, flush_size=1000, phenology_engine=None,
+                 run_date=None):
+        self.plots = plots
+        self.output = output
+        self.workers = workers or os.cpu_count()
+        self.flush_size = flush_size
+        self.phenology_engine = phenology_engine
+        self.run_date = dt.date.today() if run_date is None else run_date
+
+        self.checkpoint = Checkpoint(output.rstrip("/") + ".checkpoint")
+        if resume:
+            self.checkpoint.load()
+        else:
+            self.checkpoint.reset()
+        writer_class = ParquetWriter if output.endswith(".parquet") else JSONLWriter
+        self.writer = writer_class(output, self.checkpoint.position)
+
+        self._buffer = []
+        self._buffer_grids = set()
+        self.nplots_done = 0
+
+    def run(self):
+        """Runs all plots that are not yet in the checkpoint."""
+        todo = self.plots[~self.plots.grid_no.isin(self.checkpoint.grids)]
+        ntotal = len(todo)
+        logger.info("Running %i plots in %i grid cells (%i plots already done)" %
+                    (ntotal, todo.grid_no.nunique(), len(self.plots) - ntotal))
+
+        # Plots outside the grid cannot be simulated
+        outside = todo[todo.grid_no < 0]
+        if len(outside):
+            msg = "No grid cell found for location"
+            self._collect(-1, [_plot_record(plot, error=msg) for plot in outside.to_dict("records")])
+            todo = todo[todo.grid_no >= 0]
+
+        t_start = t_report = time.time()
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            futures = {}
+            for grid_no, plots in todo.groupby("grid_no"):
+                elevation = plots.elevation.iloc[0]
+                elevation = None if pd.isna(elevation) else float(elevation)
+                future = executor.submit(run_grid, int(grid_no), elevation, plots.to_dict("records"),
+                                         self.phenology_engine, self.run_date)
+                futures[future] = int(grid_no)
+
+            for future in as_completed(futures):
+                self._collect(futures[future], future.result())
+                if time.time() - t_report > self.progress_interval:
+                    t_report = time.time()
+                    self._report_progress(ntotal, t_start)
+
+        self._flush()
+        self.writer.close()
+        self._report_progress(ntotal, t_start)
+
+    def _collect(self, grid_no, output_records):
+        self._buffer.extend(output_records)
+        self._buffer_grids.add(grid_no)
+        self.nplots_done += len(output_records)
+        if len(self._buffer) >= self.flush_size:
+            self._flush()
+
+    def _flush(self):
+        """Writes the buffered records and records the grid cells in the checkpoint."""
+        if not self._buffer:
+            return
+        position = self.writer.write(self._buffer)
+        self.checkpoint.add(self._buffer_grids, position)
+        self._buffer = []
+        self._buffer_grids = set()
+
+    def _report_progress(self, ntotal, t_start):
+        elapsed = time.time() - t_start
+        rate = self.nplots_done / elapsed if elapsed > 0 else 0.
+        # Without plots done, e.g. when resuming a finished run, the remaining time is unknown
+        if rate > 0:
+            remaining = "%i seconds" % ((ntotal - self.nplots_done) / rate)
+        else:
+            remaining = "unknown time"
+        logger.info("%i/%i plots done, %.1f plots/s, %s remaining" %
+                    (self.nplots_done, ntotal, rate, remaining))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Run phenology, management and weather alerts for many plots.")
+    parser.add_argument("plots", help="CSV or Parquet file with latitude, longitude, sowing_date, crop_no "
+                                      "and optionally variety_no, season_no and plot_id.")
+    parser.add_argument("output", help="JSONL output file, or a directory for Parquet output when ending "
+                                       "in .parquet")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes.")
+    parser.add_argument("--resume", action="store_true", help="Resume an interrupted run.")
+    parser.add_argument("--flush-size", type=int, default=1000, help="Number of plots buffered before writing.")
+    parser.add_argument("--engine", choices=["numpy", "pcse"], default=None, help="Phenology engine.")
+    parser.add_argument("--run-date", default=None, help="Date of the run as YYYY-MM-DD for the range of "
+                                                         "trusted weather data, defaults to today.")
+    args = parser.parse_args(args)
+
+    run_date = None
+    if args.run_date is not None:
+        run_date = dt.datetime.strptime(args.run_date, "%Y-%m-%d").date()
+    plots = read_plots(args.plots)
+    runner = BatchRunner(plots, args.output, workers=args.workers, resume=args.resume,
+                         flush_size=args.flush_size, phenology_engine=args.engine, run_date=run_date)
+    runner.run()
+
+
+if __name__ == "__main__":
+    main()
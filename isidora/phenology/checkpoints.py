@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+# Copyright Alterra, Wageningen-UR
+# Allard de Wit (allard.dewit@wur.nl), March 2023
+"""Checkpoints for continuing the daily simulation of a crop from the last observed day.
+
+The simulation for a grid cell, sowing date and crop is repeated every day, although only the
+newest observed day and the weather forecast have changed. A `Checkpoint` holds the state of the
+`MainSimulator` (phenology, sent management messages, weather alert counters and the messages
+so far) at the last day with observed weather data. The next run restores that state and only
+simulates from the checkpoint day onwards.
+
+A checkpoint is only used when the weather data from the sowing date up to the checkpoint day
+and the crop parameters are unchanged, otherwise the simulation is done from the sowing date.
+Checkpoints are kept in a `CheckpointStore`, in memory and optionally as files in a directory
+so that they are shared between processes and survive restarts.
+
+The run date is not part of the fingerprint of the crop parameters. The weather alerts are
+evaluated on all days up to the alert horizon of a run (see `alert_horizon()`), so a checkpoint is
+valid for any run whose alert horizon is not before the checkpoint day. Checkpoints are only
+stored for days up to the alert horizon of the run.
+"""
+from collections import OrderedDict
+import datetime as dt
+import hashlib
+import logging
+import os
+import pickle
+import tempfile
+import threading
+
+import numpy as np
+
+import config
+from pcse.engine import Engine
+from . import data_providers as dp
+from .vectorized_phenology import get_weather_arrays
+
+logger = logging.getLogger(__name__)
+
+# Weather variables used by the simulation objects
+weather_variables = ("TMAX", "TMIN", "TEMP", "VAP", "WIND", "RAIN", "LAT")
+
+
+class Checkpoint(object):
+    """The state of the simulation at the end of a day.
+
+    :param day: the day of the checkpoint
+    :param snapshot: the state of the MainSimulator, see `MainSimulator.get_snapshot()`
+    :param finished: True if the simulation terminated at or before the checkpoint day
+    :param weather_fingerprint: fingerprint of the weather data from the sowing date to day
+    :param parameters_fingerprint: fingerprint of the crop parameters and alerts
+    """
+
+    def __init__(self, day, snapshot, finished, weather_fingerprint, parameters_fingerprint):
+        self.day = day
+        self.snapshot = snapshot
+        self.finished = finished
+        self.weather_fingerprint = weather_fingerprint
+        self.parameters_fingerprint = parameters_fingerprint
+
+
+class CheckpointStore(object):
+    """Least-recently-used store of checkpoints, optionally backed by files in a directory.
+
+    :param maxsize: the maximum number of checkpoints kept in memory
+    :param directory: the directory for storing checkpoints as files, None for memory only
+    """
+
+    def __init__(self, maxsize=None, directory=None):
+        self.maxsize = config.simulator.checkpoint_store_size if maxsize is None else maxsize
+        self.directory = directory
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+        self._checkpoints = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        name = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, name + ".pkl")
+
+    def get(self, key):
+        with self._lock:
+            checkpoint = self._checkpoints.get(key)
+            if checkpoint is not None:
+                self._checkpoints.move_to_end(key)
+                return checkpoint
+        if self.directory is None:
+            return None
+        try:
+            with open(self._path(key), "rb") as fp:
+                return pickle.load(fp)
+        except (IOError, OSError, pickle.UnpicklingError, EOFError):
+            return None
+
+    def set(self, key, checkpoint):
+        with self._lock:
+            self._checkpoints[key] = checkpoint
+            self._checkpoints.move_to_end(key)
+            while len(self._checkpoints) > self.maxsize:
+                self._checkpoints.popitem(last=False)
+        if self.directory is not None:
+            # Write to a temporary file first so that other processes never read a partial checkpoint
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "wb") as fp:
+                pickle.dump(checkpoint, fp, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self._path(key))
+
+    def discard(self, key):
+        with self._lock:
+            self._checkpoints.pop(key, None)
+        if self.directory is not None:
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def __len__(self):
+        return len(self._checkpoints)
+
+
+def last_observed_day(wdp):
+    """Returns the last day for which the weather data of the weather data provider are
+    observed data, None if unknown.
+
+    This is the last day of observed weather data in the database, or the day before the
+    issue day of the forecast when that is earlier.
+    """
+    days = []
+    if getattr(wdp, "weather_version", None) is not None:
+        days.append(wdp.weather_version)
+    if getattr(wdp, "forecast_issue_day", None) is not None:
+        days.append(wdp.forecast_issue_day - dt.timedelta(days=1))
+    return min(days) if days else None
+
+
+def weather_fingerprint(wdp, start_date, end_date):
+    """Returns a fingerprint of the weather data used by the simulation between start_date and
+    end_date (inclusive)."""
+    weather = get_weather_arrays(wdp, start_date, end_date)
+    h = hashlib.sha1()
+    for name in weather_variables:
+        h.update(np.ascontiguousarray(weather[name], dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+
+def parameters_fingerprint(cropd):
+    """Returns a fingerprint of the crop parameters, including the management and weather alerts.
+    The crop template is compiled from these, so it is not included. The run date is not included
+    either, the validity of a checkpoint for the run date is checked against `alert_horizon()`."""
+    items = sorted((name, repr(value)) for name, value in cropd.items()
+                   if name not in ("SNAPSHOT", "CROP_TEMPLATE", "RUN_DATE"))
+    return hashlib.sha1(repr(items).encode("utf-8")).hexdigest()
+
+
+def alert_horizon(cropd):
+    """Returns the last day at which all weather alerts are evaluated for the run date of the
+    crop parameters (RUN_DATE, defaults to today), see `GenericWeatherAlert.alert_horizon`.
+    """
+    run_date = cropd["RUN_DATE"] if "RUN_DATE" in cropd else dt.date.today()
+    return run_date + dt.timedelta(days=min(config.simulator.weather_alert_limit.values()))
+
+
+def _start_engine(wdp, sowing_date, crop, start_date, snapshot=None):
+    """Starts the PCSE Engine at start_date, continuing from the snapshot when given."""
+    cropd = dict(crop)
+    if snapshot is not None:
+        cropd["SNAPSHOT"] = snapshot
+    pprovider = dp.make_parameter_provider(sowing_date, cropd, crop_start_type=config.simulator.crop_start_type,
+                                           crop_end_type=config.simulator.crop_end_type, start_date=start_date)
+    return Engine(pprovider, wdp, config=config.simulator.simulator_config)
+
+
+def run_with_checkpoint(wdp, sowing_date, crop, key, store=None):
+    """Runs the simulation for the sowing date, starting from the checkpoint stored under key when
+    it is still valid, and stores a new checkpoint at the last observed day.
+
+    :param wdp: The weather data provider to be used
+    :param sowing_date: date object providing sowing date of the crop
+    :param crop: dict with the crop parameters, including MANAGEMENT_ALERTS and WEATHER_ALERTS
+    :param key: the key of the checkpoint in the store
+    :param store: the CheckpointStore, defaults to the store shared by all requests in this process
+    :return: a tuple with the BBCH dates, the weather messages and the management messages
+    """
+    if store is None:
+        store = get_checkpoint_store()
+
+    checkpoint_day = last_observed_day(wdp)
+    fingerprint = parameters_fingerprint(crop)
+    horizon = alert_horizon(crop)
+    checkpoint = store.get(key)
+    if checkpoint is not None:
+        if checkpoint.parameters_fingerprint != fingerprint or \
+                checkpoint_day is None or checkpoint.day > checkpoint_day or \
+                checkpoint.weather_fingerprint != weather_fingerprint(wdp, sowing_date, checkpoint.day):
+            logger.info("Weather data or crop parameters changed since checkpoint at %s for %s, "
+                        "simulating from the sowing date." % (checkpoint.day, key))
+            store.discard(key)
+            checkpoint = None
+        elif checkpoint.day > horizon:
+            # Weather alerts are not evaluated after the horizon of this run, which the checkpoint did
+            logger.info("Checkpoint at %s for %s is beyond the alert horizon %s of the run, "
+                        "simulating from the sowing date." % (checkpoint.day, key, horizon))
+            checkpoint = None
+
+    if checkpoint is not None and checkpoint.finished:
+        snapshot = checkpoint.snapshot
+        return snapshot["phenology"]["BBCH_DATES"], snapshot["WEATHER_MESSAGES"], snapshot["MANAGEMENT_MESSAGES"]
+
+    if checkpoint is None:
+        engine = _start_engine(wdp, sowing_date, crop, sowing_date)
+    else:
+        engine = _start_engine(wdp, sowing_date, crop, checkpoint.day, checkpoint.snapshot)
+
+    # Run up to the last observed day and store the state at that day
+    if checkpoint_day is not None and checkpoint_day > engine.day and checkpoint_day <= horizon:
+        engine.run(days=(checkpoint_day - engine.day).days)
+        # The state is taken after integration of the checkpoint day, the rates of that day
+        # are calculated again when continuing from the checkpoint.
+        checkpoint = Checkpoint(engine.day, engine.crop.get_snapshot(), engine.flag_terminate,
+                                weather_fingerprint(wdp, sowing_date, engine.day), fingerprint)
+        store.set(key, checkpoint)
+
+    engine.run_till_terminate()
+
+    return (engine.get_variable("BBCH_DATES"), engine.get_variable("WEATHER_MESSAGES"),
+            engine.get_variable("MANAGEMENT_MESSAGES"))
+
+
+# The checkpoint store shared by all requests in this process, created on first use
+_checkpoint_store = None
+
+
+def get_checkpoint_store():
+    """Returns the checkpoint store shared by all requests in this process.
+    """
+    global _checkpoint_store
+    if _checkpoint_store is None:
+        _checkpoint_store = CheckpointStore(directory=config.simulator.checkpoint_directory)
+    return _checkpoint_store
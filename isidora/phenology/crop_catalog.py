@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+# Copyright Alterra, Wageningen-UR
+# Allard de Wit (allard.dewit@wur.nl), March 2023
+"""In-memory catalog of the crop parameters and alerts.
+
+The tables with crops, varieties, seasons, crop and variety parameters and management and
+weather alerts are small and rarely edited, while every request needs them. The `CropCatalog`
+reads these tables in bulk, parses the parameter values once and keeps them in memory as a
+snapshot. The checksums of the tables are checked every `config.simulator.crop_catalog_check_interval`
+seconds and a new snapshot is loaded and swapped in when the tables have been edited.
+
+Use `get_crop_catalog()` to obtain the catalog for the current process.
+"""
+from collections import defaultdict
+import logging
+import threading
+import time
+from types import MappingProxyType
+
+import config
+from pcse import exceptions as exc
+from . import data_access
+from . import instrumentation
+from .crop_template import CropTemplate, _freeze, _thaw
+
+
+def fetch_crop_tables_version(connection):
+    """Retrieves the checksums of the tables with crop parameters and alerts.
+
+    Any change in the crop, variety, season, parameter or alert tables changes the checksums,
+    therefore they can be used to detect that results computed earlier are outdated.
+
+    :param connection: pymysql connection to the database
+    """
+    cur = connection.cursor()
+    try:
+        cur.execute("checksum table %s" % ", ".join(data_access.DataAccessSession.reflected_tables))
+        rows = cur.fetchall()
+    except Exception as e:
+        msg = "Failed to retrieve the version of the crop tables: %s" % e
+        raise exc.PCSEError(msg)
+    finally:
+        cur.close()
+
+    return tuple((r["Table"], r["Checksum"]) for r in rows)
+
+
+def _parse_parameters(rows, table):
+    """Parses the parameter values of rows from a parameter table into a dict."""
+    parameters = {}
+    for row in sorted(rows, key=lambda r: r.parameter_code):
+        try:
+            pvalue = eval(row.parameter_value)
+        except SyntaxError:
+            msg = "Failed parsing parameter: %s from table %s" % (row.parameter_value, table)
+            raise exc.PCSEError(msg)
+        parameters[row.parameter_code] = _freeze(pvalue)
+    return parameters
+
+
+class CropBundle(object):
+    """Immutable parameters and alerts of a crop, variety and season.
+
+    :param crop_no: The crop number
+    :param variety_no: The variety number
+    :param season_no: The season number
+    :param crop_name: The name of the crop
+    :param parameters: read-only mapping with the parsed crop and variety parameters
+    :param management_alerts: tuple with the rows of the management alerts
+    :param weather_alerts: tuple with the rows of the weather alerts
+    :param management_remark: remark on the management alerts, e.g. when generic alerts are used
+    :param weather_remark: remark on the weather alerts
+    """
+    __slots__ = ("crop_no", "variety_no", "season_no", "crop_name", "parameters", "management_alerts",
+                 "weather_alerts", "management_remark", "weather_remark", "_template")
+
+    def __init__(self, crop_no, variety_no, season_no, crop_name, parameters, management_alerts,
+                 weather_alerts, management_remark, weather_remark):
+        for name, value in zip(self.__slots__, (crop_no, variety_no, season_no, crop_name, parameters,
+                                                management_alerts, weather_alerts, management_remark,
+                                                weather_remark)):
+            object.__setattr__(self, name, value)
+        object.__setattr__(self, "_template", None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("CropBundle is immutable")
+
+    def crop_parameters(self):
+        """Returns a new dict with the crop parameters, which may be modified by the caller."""
+        cropd = {name: _thaw(value) for name, value in self.parameters.items()}
+        cropd["crop_name"] = self.crop_name
+        return cropd
+
+    @property
+    def template(self):
+        """The CropTemplate of the crop, variety and season, compiled on first use."""
+        template = self._template
+        if template is None:
+            # Compiling twice from concurrent threads gives identical templates, so no lock is needed
+            template = CropTemplate(self.parameters, self.management_alerts, self.weather_alerts)
+            object.__setattr__(self, "_template", template)
+        return template
+
+
+class _CatalogSnapshot(object):
+    """The contents of the crop tables at the time of loading."""
+
+    def __init__(self, session):
+        tables = session.tables
+
+        def fetch(name):
+            r = session.engine.execute(tables[name].select())
+            try:
+                return r.fetchall()
+            finally:
+                r.close()
+
+        self.crop_names = {r.crop_no: r.crop_name for r in fetch("crop")}
+        self.variety_names = {(r.crop_no, r.variety_no): r.variety_name for r in fetch("varieties")}
+        self.season_names = {r.season_no: r.season_name for r in fetch("season")}
+
+        rows = defaultdict(list)
+        for r in fetch("crop_parameter_value"):
+            rows[r.crop_no].append(r)
+        self.crop_parameters = {crop_no: _parse_parameters(crop_rows, "CROP_PARAMETER_VALUE")
+                                for crop_no, crop_rows in rows.items()}
+        rows = defaultdict(list)
+        for r in fetch("variety_parameter_value"):
+            rows[(r.crop_no, r.variety_no)].append(r)
+        self.variety_parameters = {key: _parse_parameters(variety_rows, "VARIETY_PARAMETER_VALUE")
+                                   for key, variety_rows in rows.items()}
+
+        self.alerts = {}
+        for name in ("management_alerts", "weather_alerts"):
+            rows = defaultdict(list)
+            for r in fetch(name):
+                rows[(r.crop_no, r.variety_no, r.season_no)].append(r)
+            self.alerts[name] = {key: tuple(alert_rows) for key, alert_rows in rows.items()}
+
+        self.bundles = {}
+
+
+class CropCatalog(object):
+    """Catalog of crop parameters and alerts, loaded in bulk and kept in memory.
+
+    :param engine: DataAccessSession or SqlAlchemy engine object providing DB access
+    :param check_interval: the interval (seconds) for checking if the crop tables have been
+        edited, defaults to `config.simulator.crop_catalog_check_interval`
+    """
+
+    def __init__(self, engine=None, check_interval=None):
+        self.session = data_access.get_session(engine)
+        self.check_interval = config.simulator.crop_catalog_check_interval \
+            if check_interval is None else check_interval
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self._lock = threading.Lock()
+        self._check_lock = threading.Lock()
+        self._snapshot = None
+        self._version = None
+        self._checked_at = None
+        self.loads = 0
+
+    def _fetch_version(self):
+        connection = self.session.weather_connection()
+        try:
+            return fetch_crop_tables_version(connection)
+        finally:
+            connection.close()
+
+    def _current(self):
+        """Returns the current snapshot, which is loaded again when the crop tables have been edited.
+
+        The checksums of the tables are only checked once every `self.check_interval` seconds, by
+        one thread at a time. The other threads keep using the current snapshot meanwhile, the new
+        snapshot is loaded outside the lock and swapped in when complete.
+        """
+        now = time.monotonic()
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot is not None and (now - self._checked_at) < self.check_interval:
+                return snapshot
+
+        # Without a snapshot there is nothing to serve, so wait for the thread that is loading it
+        if not self._check_lock.acquire(blocking=snapshot is None):
+            return snapshot
+        try:
+            with self._lock:
+                snapshot = self._snapshot
+                if snapshot is not None and (time.monotonic() - self._checked_at) < self.check_interval:
+                    return snapshot
+            try:
+                version = self._fetch_version()
+                if snapshot is not None and version == self._version:
+                    new_snapshot = snapshot
+                else:
+                    if snapshot is not None:
+                        self.logger.info("Crop tables have been edited, reloading the crop catalog.")
+                    with instrumentation.stage("crop_catalog"):
+                        new_snapshot = _CatalogSnapshot(self.session)
+            except Exception as e:
+                if snapshot is None:
+                    if isinstance(e, exc.PCSEError):
+                        raise
+                    msg = "Failed to load the crop catalog: %s" % e
+                    raise exc.PCSEError(msg)
+                self.logger.exception("Failed checking the crop tables, keeping the current crop catalog.")
+                with self._lock:
+                    self._checked_at = time.monotonic()
+                return snapshot
+
+            with self._lock:
+                if new_snapshot is not snapshot:
+                    self.loads += 1
+                self._snapshot = new_snapshot
+                self._version = version
+                self._checked_at = time.monotonic()
+            return new_snapshot
+        finally:
+            self._check_lock.release()
+
+    def reload(self):
+        """Loads the crop tables again at the next access."""
+        with self._lock:
+            self._snapshot = None
+
+    @property
+    def version(self):
+        """The checksums of the crop tables of the current snapshot, see `fetch_crop_tables_version()`.
+
+        The crop tables are checked for edits first, like for any other access to the catalog.
+        """
+        self._current()
+        with self._lock:
+            return self._version
+
+    def crop_name(self, crop_no):
+        """Returns the name of the crop for given crop_no."""
+        try:
+            return self._current().crop_names[crop_no]
+        except KeyError:
+            msg = "Failed deriving crop name for cropid %s" % crop_no
+            raise exc.PCSEError(msg)
+
+    def variety_name(self, crop_no, variety_no):
+        """Returns the name of the variety for given crop_no, variety_no."""
+        try:
+            return self._current().variety_names[(crop_no, variety_no)]
+        except KeyError:
+            msg = "Failed deriving variety name for crop_no, variety_no %s, %s" % (crop_no, variety_no)
+            raise exc.PCSEError(msg)
+
+    def season_name(self, season_no):
+        """Returns the name of the cropping season for given season_no."""
+        try:
+            return self._current().season_names[season_no]
+        except KeyError:
+            msg = "Failed deriving season name for season_no %s" % season_no
+            raise exc.PCSEError(msg)
+
+    def _alerts(self, snapshot, name, crop_no, variety_no, season_no):
+        """Returns the alerts for the crop, variety and season, or the generic alerts of the crop
+        when not available, together with a remark."""
+        alerts = snapshot.alerts[name]
+        rows = alerts.get((crop_no, variety_no, season_no), ())
+        remark = ""
+        if not rows:
+            remark = "No {0} available for varid {1} and seasonid {2}".format(name.replace("_", ""),
+                                                                              variety_no, season_no)
+            rows = alerts.get((crop_no, -1, -1), ())
+        return rows, remark
+
+    def bundle(self, crop_no, variety_no, season_no=-1):
+        """Returns the CropBundle for a crop, variety and season.
+
+        :param crop_no: The crop number
+        :param variety_no: The variety number, -1 for the generic variety
+        :param season_no: The season number, -1 for the generic season
+        """
+        crop_no, variety_no, season_no = int(crop_no), int(variety_no), int(season_no)
+        snapshot = self._current()
+        key = (crop_no, variety_no, season_no)
+        bundle = snapshot.bundles.get(key)
+        if bundle is not None:
+            return bundle
+
+        if crop_no not in snapshot.crop_names:
+            msg = "Failed deriving crop name for cropid %s" % crop_no
+            raise exc.PCSEError(msg)
+        if crop_no not in snapshot.crop_parameters:
+            msg = "No parameter value found for cropid=%s."
+            raise exc.PCSEError(msg % crop_no)
+        parameters = dict(snapshot.crop_parameters[crop_no])
+        # Variety parameters take precedence over the parameters of the crop
+        parameters.update(snapshot.variety_parameters.get((crop_no, variety_no), {}))
+        management_alerts, management_remark = self._alerts(snapshot, "management_alerts", *key)
+        weather_alerts, weather_remark = self._alerts(snapshot, "weather_alerts", *key)
+        bundle = CropBundle(crop_no, variety_no, season_no, snapshot.crop_names[crop_no],
+                            MappingProxyType(parameters), management_alerts, weather_alerts,
+                            management_remark, weather_remark)
+        snapshot.bundles[key] = bundle
+        return bundle
+
+
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+
+def get_crop_catalog(engine=None):
+    """Returns the crop catalog for this process.
+
+    :param engine: optional DataAccessSession or SqlAlchemy engine, by default the catalog for
+        `config.database.dbc` is returned.
+    """
+    session = data_access.get_session(engine)
+    key = str(session)
+    with _catalogs_lock:
+        catalog = _catalogs.get(key)
+        if catalog is None:
+            catalog = _catalogs[key] = CropCatalog(session)
+    return catalog
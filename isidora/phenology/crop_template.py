@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+# Copyright Alterra, Wageningen-UR
+# Allard de Wit (allard.dewit@wur.nl), March 2023
+"""Compiled crop model templates that are shared by all simulations of a crop, variety and season.
+
+A `CropTemplate` holds everything the simulation objects derive from the crop parameters and
+alerts: the BBCH stages sorted on their code, the temperature function of the phenology, the
+parsed weather alerts and the management rules indexed on BBCH code. A template is immutable,
+so it is built once (see `crop_catalog.CropBundle.template`) and can be shared between runs and
+threads. It is passed to the simulation objects as crop parameter CROP_TEMPLATE, when that is
+missing the simulation objects compile a template from the crop parameters themselves.
+"""
+from types import MappingProxyType
+
+from pcse.exceptions import PCSEError
+
+
+def bbch_stages(parameters):
+    """Returns the BBCH codes and their temperature sums in the order used by the phenology
+    models: sorted on the name of the BBCH code.
+
+    :param parameters: dict or ParameterProvider with crop parameters
+    :return: a tuple with the list of BBCH codes and a list with temperature sums
+    """
+    # BBCH_CODES and BBCH_TSUMS are set by the phenology simulation object from these
+    codes = sorted(name for name in parameters if name.startswith("BBCH")
+                   and name not in ("BBCH_CODES", "BBCH_TSUMS"))
+    tsums = [parameters[name] for name in codes]
+    return codes, tsums
+
+
+def _freeze(value):
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, dict):
+        return MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    return value
+
+
+def _thaw(value):
+    if isinstance(value, tuple):
+        return [_thaw(v) for v in value]
+    if isinstance(value, MappingProxyType):
+        return {k: _thaw(v) for k, v in value.items()}
+    return value
+
+
+def index_management_rules(management_alerts):
+    """Returns a read-only mapping of BBCH code onto a tuple with the management alerts for that
+    code, in the order of the table.
+
+    :param management_alerts: rows from the MANAGEMENT_ALERTS table
+    """
+    rules = {}
+    for rule in management_alerts:
+        rules.setdefault(rule.BBCH_code, []).append(rule)
+    return MappingProxyType({code: tuple(r) for code, r in rules.items()})
+
+
+class ParsedWeatherAlert(object):
+    """Parsed definition of a weather alert from the WEATHER_ALERTS table.
+
+    :param alert: row from the WEATHER_ALERTS table
+    """
+    __slots__ = ("signal", "parameters", "message_no", "message")
+
+    def __init__(self, alert):
+        try:
+            parameters = eval(alert.parameters)
+        except SyntaxError:
+            msg = "Failed parsing parameters of weather alert %s: %s" % (alert.message_no, alert.parameters)
+            raise PCSEError(msg)
+        object.__setattr__(self, "signal", alert.signal)
+        object.__setattr__(self, "parameters", _freeze(parameters))
+        object.__setattr__(self, "message_no", alert.message_no)
+        object.__setattr__(self, "message", alert.weather_msg)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("ParsedWeatherAlert is immutable")
+
+    def parameter_values(self):
+        """Returns a new dict with the parameter values for the weather alert simulation object,
+        including MESSAGE_NO and MESSAGE."""
+        parvalues = _thaw(self.parameters)
+        parvalues.update(MESSAGE_NO=self.message_no, MESSAGE=self.message)
+        return parvalues
+
+
+class CropTemplate(object):
+    """Immutable compiled crop model for a crop, variety and season.
+
+    :param parameters: dict or ParameterProvider with crop parameters
+    :param management_alerts: rows from the MANAGEMENT_ALERTS table
+    :param weather_alerts: rows from the WEATHER_ALERTS table
+
+    :ivar bbch_codes: tuple with the BBCH codes sorted on code
+    :ivar bbch_tsums: tuple with the temperature sums of the BBCH codes
+    :ivar temperature_function: tuple with the temperature function (AFGEN table) of the phenology
+    :ivar weather_alerts: tuple of ParsedWeatherAlert objects
+    :ivar management_alerts: tuple with the management alerts in the order of the table
+    :ivar management_rules: read-only mapping of BBCH code onto a tuple with the management
+        alerts for that code, in the order of the table
+    """
+    __slots__ = ("bbch_codes", "bbch_tsums", "temperature_function", "weather_alerts", "management_alerts",
+                 "management_rules")
+
+    def __init__(self, parameters, management_alerts=(), weather_alerts=()):
+        codes, tsums = bbch_stages(parameters)
+        if len(codes) < 2:
+            msg = "At least two BBCH stages are needed for simulating phenology, found: %s"
+            raise PCSEError(msg % codes)
+
+        TBASE, TOPT1, TOPT2, TMAX = [float(parameters[name]) for name in
+                                     ("PHENO_TBASE", "PHENO_TOPT1", "PHENO_TOPT2", "PHENO_TMAX")]
+        Tfunc = (TBASE, 0.,
+                 TOPT1, (TOPT1 - TBASE),
+                 TOPT2, (TOPT1 - TBASE),
+                 TMAX, 0.)
+
+        values = {"bbch_codes": tuple(codes),
+                  "bbch_tsums": tuple(float(t) for t in tsums),
+                  "temperature_function": Tfunc,
+                  "weather_alerts": tuple(ParsedWeatherAlert(alert) for alert in weather_alerts),
+                  "management_alerts": tuple(management_alerts),
+                  "management_rules": index_management_rules(management_alerts)}
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("CropTemplate is immutable")
+
+
+def get_crop_template(parameters):
+    """Returns the template in crop parameter CROP_TEMPLATE, or compiles a template from the crop
+    parameters and the alerts in MANAGEMENT_ALERTS and WEATHER_ALERTS when not available.
+
+    :param parameters: dict or ParameterProvider with crop parameters
+    """
+    if "CROP_TEMPLATE" in parameters:
+        return parameters["CROP_TEMPLATE"]
+    management_alerts = parameters["MANAGEMENT_ALERTS"] if "MANAGEMENT_ALERTS" in parameters else ()
+    weather_alerts = parameters["WEATHER_ALERTS"] if "WEATHER_ALERTS" in parameters else ()
+    return CropTemplate(parameters, management_alerts, weather_alerts)
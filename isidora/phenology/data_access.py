@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+# Copyright Alterra, Wageningen-UR
+# Allard de Wit (allard.dewit@wur.nl), March 2023
+"""Process-wide access to the database shared by the runners and the data providers.
+
+The `DataAccessSession` holds a pool of database connections, the tables that are reflected
+once when the session is created and the statements for retrieving the crop parameters and
+alerts, which are compiled once and then executed with different parameter values. Weather
+data are retrieved through stored procedures for which a pooled pymysql connection is provided
+by `DataAccessSession.weather_connection()`.
+
+Use `get_session()` to obtain the session for the current process.
+"""
+import os
+import threading
+
+import pymysql
+import sqlalchemy as sa
+from sqlalchemy import MetaData, select, and_, bindparam
+
+import config
+from . import instrumentation
+
+
+class PooledWeatherConnection(object):
+    """Wraps a pooled pymysql connection, cursors return rows as dicts and closing the
+    connection returns it to the pool.
+
+    :param connection: DBAPI connection checked out from the pool
+    """
+
+    def __init__(self, connection):
+        self._connection = connection
+
+    def cursor(self, streaming=False):
+        """Returns a cursor returning rows as dicts, or an unbuffered cursor returning rows as
+        tuples when streaming is True. The rows of an unbuffered cursor are read from the
+        server while fetching, so all rows must be fetched before executing the next query.
+        """
+        if streaming:
+            return self._connection.cursor(pymysql.cursors.SSCursor)
+        return self._connection.cursor(pymysql.cursors.DictCursor)
+
+    def close(self):
+        self._connection.close()
+
+
+class DataAccessSession(object):
+    """Database engine with a connection pool, reflected tables and prepared statements.
+
+    :param bind: SqlAlchemy connection string or engine, defaults to `config.database.dbc`
+    """
+    reflected_tables = ("crop", "varieties", "season", "crop_parameter_value", "variety_parameter_value",
+                        "management_alerts", "weather_alerts")
+
+    def __init__(self, bind=None):
+        if bind is None:
+            bind = config.database.dbc
+        if isinstance(bind, sa.engine.Engine):
+            self.engine = bind
+        else:
+            self.engine = sa.create_engine(bind, pool_size=config.database.pool_size,
+                                           max_overflow=config.database.max_overflow,
+                                           pool_recycle=config.database.pool_recycle,
+                                           pool_pre_ping=True)
+        self.pid = os.getpid()
+
+        self.metadata = MetaData(self.engine)
+        self.metadata.reflect(only=list(self.reflected_tables))
+        self.tables = self.metadata.tables
+        self.statements = self._prepare_statements()
+
+    def _prepare_statements(self):
+        """Builds and compiles the statements for retrieving crop parameters and alerts.
+        """
+        t = self.tables
+        statements = {
+            "crop": select([t["crop"]], t["crop"].c.crop_no == bindparam("crop_no")),
+            "variety": select([t["varieties"]], and_(t["varieties"].c.crop_no == bindparam("crop_no"),
+                                                     t["varieties"].c.variety_no == bindparam("variety_no"))),
+            "season": select([t["season"]], t["season"].c.season_no == bindparam("season_no")),
+            "crop_parameter_value": select([t["crop_parameter_value"]],
+                                           t["crop_parameter_value"].c.crop_no == bindparam("crop_no"),
+                                           order_by=t["crop_parameter_value"].c.parameter_code),
+            "variety_parameter_value": select([t["variety_parameter_value"]],
+                                              and_(t["variety_parameter_value"].c.crop_no == bindparam("crop_no"),
+                                                   t["variety_parameter_value"].c.variety_no == bindparam("variety_no")),
+                                              order_by=t["variety_parameter_value"].c.parameter_code),
+        }
+        for name in ("management_alerts", "weather_alerts"):
+            tbl = t[name]
+            statements[name] = select([tbl], and_(tbl.c.crop_no == bindparam("crop_no"),
+                                                  tbl.c.variety_no == bindparam("variety_no"),
+                                                  tbl.c.season_no == bindparam("season_no")))
+
+        return {name: stmt.compile(dialect=self.engine.dialect) for name, stmt in statements.items()}
+
+    def execute(self, statement, **params):
+        """Executes one of the prepared statements with given parameter values.
+
+        :param statement: name of the statement, see `self.statements`
+        :param params: parameter values for the statement
+        :return: a ResultProxy
+        """
+        return self.engine.execute(self.statements[statement], **params)
+
+    def fetchall(self, statement, **params):
+        """Executes one of the prepared statements and returns all rows.
+        """
+        r = self.execute(statement, **params)
+        try:
+            return r.fetchall()
+        finally:
+            r.close()
+
+    def fetchone(self, statement, **params):
+        """Executes one of the prepared statements and returns the first row or None.
+        """
+        r = self.execute(statement, **params)
+        try:
+            return r.fetchone()
+        finally:
+            r.close()
+
+    def weather_connection(self):
+        """Returns a pymysql connection from the pool for calling the stored procedures
+        that provide the weather data. Closing the connection returns it to the pool.
+        """
+        return PooledWeatherConnection(self.engine.raw_connection())
+
+    def pool_status(self):
+        """Returns the statistics of the connection pool as a dict.
+        """
+        pool = self.engine.pool
+        stats = {"pool": pool.status()}
+        for name in ("size", "checkedin", "checkedout", "overflow"):
+            value = getattr(pool, name, None)
+            if callable(value):
+                stats[name] = value()
+        return stats
+
+    def dispose(self):
+        """Closes all connections in the pool, needed after forking a new process because
+        connections cannot be shared between processes.
+        """
+        self.engine.dispose()
+        self.pid = os.getpid()
+
+    def __str__(self):
+        return str(self.engine.url)
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(engine=None):
+    """Returns the data access session for this process.
+
+    :param engine: optional SqlAlchemy engine or DataAccessSession, by default the session for
+        `config.database.dbc` is returned.
+    """
+    if isinstance(engine, DataAccessSession):
+        session = engine
+    else:
+        key = config.database.dbc if engine is None else str(engine.url)
+        with _sessions_lock:
+            session = _sessions.get(key)
+            if session is None:
+                with instrumentation.stage("db_session"):
+                    session = _sessions[key] = DataAccessSession(engine)
+
+    # Connections in the pool were inherited from the parent process
+    if session.pid != os.getpid():
+        with instrumentation.stage("db_session"):
+            session.dispose()
+
+    return session
@@ -5,245 +5,493 @@
 """Data providers for crop simulation related data such as weather, crop and agromanagement.
 """
 import datetime as dt
-import json
 from decimal import Decimal
-import logging
 
 from dotmap import DotMap
-import pymysql
+import numpy as np
 import pandas as pd
 from pandas.core.frame import DataFrame
-from sqlalchemy import MetaData, select, Table, and_
-import requests
 
 import config
 from pcse import exceptions as exc
-from pcse.base_classes import WeatherDataProvider, WeatherDataContainer
-from pcse.util import check_date, ea_from_tdew, wind10to2
+from pcse.base_classes import WeatherDataProvider, WeatherDataContainer, ParameterProvider
+from pcse.util import check_date, wind10to2
 
+from .grid_index import GridIndex
+from .vectorized_phenology import daylength_table
+from .weather_alerts_simulator import humidity
+from . import data_access
+from . import crop_catalog
+from .crop_catalog import fetch_crop_tables_version
+from . import forecast_store
+from . import instrumentation
 
-def fetch_crop_name(engine, crop_no, _cache={}):
+
+def fetch_crop_name(engine, crop_no):
     """Retrieves the name of the crop from the CROP table for
     given crop_no.
 
-    :param engine: SqlAlchemy engine object providing DB access
+    :param engine: DataAccessSession or SqlAlchemy engine object providing DB access
     :param crop_no: integer cropid
     """
-    if crop_no not in _cache:
-        metadata = MetaData(engine)
-        table_crop = Table("crop", metadata, autoload=True)
-        r = select([table_crop],
-                   table_crop.c.crop_no == crop_no).execute()
-        row = r.fetchone()
-        r.close()
-        if row is None:
-            msg = "Failed deriving crop name for cropid %s" % crop_no
-            raise exc.PCSEError(msg)
-        _cache[crop_no] = row.crop_name
-    return _cache[crop_no]
+    return crop_catalog.get_crop_catalog(engine).crop_name(crop_no)
 
 
-def fetch_variety_name(engine, crop_no, variety_no, _cache={}):
+def fetch_variety_name(engine, crop_no, variety_no):
     """Retrieves the name of the crop from the VARIETIES table for
     given crop_no, variety_no.
 
-    :param engine: SqlAlchemy engine object providing DB access
+    :param engine: DataAccessSession or SqlAlchemy engine object providing DB access
     :param crop_no: integer cropid
     :param variety_no: integer varietyid
     """
-    if (crop_no, variety_no) not in _cache:
-        metadata = MetaData(engine)
-        table_varieties = Table("varieties", metadata, autoload=True)
-        r = select([table_varieties], and_(table_varieties.c.crop_no == crop_no,
-                                           table_varieties.c.variety_no == variety_no)
-                   ).execute()
-        row = r.fetchone()
-        r.close()
-        if row is None:
-            msg = "Failed deriving variety name for crop_no, variety_no %s, %s" % (crop_no, variety_no)
-            raise exc.PCSEError(msg)
-        _cache[(crop_no, variety_no)] = row.variety_name
-    return _cache[(crop_no, variety_no)]
+    return crop_catalog.get_crop_catalog(engine).variety_name(crop_no, variety_no)
 
 
-def fetch_season_name(engine, season_no, _cache={}):
+def fetch_season_name(engine, season_no):
     """Retrieves the name of the cropping seasons from the SEASON table for
     given season_no.
 
-    :param engine: SqlAlchemy engine object providing DB access
+    :param engine: DataAccessSession or SqlAlchemy engine object providing DB access
     :param season_no: integer season id
     """
-    if season_no not in _cache:
-        metadata = MetaData(engine)
-        table_season = Table("season", metadata, autoload=True)
-        r = select([table_season],
-                   table_season.c.season_no == season_no).execute()
-        row = r.fetchone()
-        r.close()
-        if row is None:
-            msg = "Failed deriving season name for season_no %s" % season_no
-            raise exc.PCSEError(msg)
-        _cache[season_no] = row.season_name
-    return _cache[season_no]
+    return crop_catalog.get_crop_catalog(engine).season_name(season_no)
 
 
 def fetch_management_alerts(engine, crop_no, variety_no, season_no):
-    """Retrieves the management_alerts from the database
+    """Retrieves the management_alerts from the crop catalog
     
-    :param engine: SqlAlchemy engine object providing DB access
+    :param engine: DataAccessSession or SqlAlchemy engine object providing DB access
     :param crop_no: integer cropid (from url query string)
     :param variety_no: integer varid (from url query string)
     :param season_no: integer seasonid (from url query string)
     """
-    metadata = MetaData(engine)
-    remark = ""
-    tbl = Table("management_alerts", metadata, autoload=True)
-    r = select([tbl], and_(tbl.c.crop_no==crop_no,
-                           tbl.c.variety_no==variety_no,
-                           tbl.c.season_no==season_no)).execute()
-    rows = r.fetchall()
-    r.close()
-    
-    if not rows:
-        # no management alerts for varid? get cropid alerts only
-        remark = 'No managementalerts available for varid {0} and seasonid {2}'.format(variety_no, crop_no, season_no)
-        rs = select([tbl], and_(tbl.c.crop_no==crop_no,
-                           tbl.c.variety_no==-1,
-                           tbl.c.season_no==-1)).execute()
-        rows = rs.fetchall()
-        rs.close()
-    
-    return rows, remark
+    with instrumentation.stage("management_alerts") as s:
+        bundle = crop_catalog.get_crop_catalog(engine).bundle(crop_no, variety_no, season_no)
+        s.rows = len(bundle.management_alerts)
+    return list(bundle.management_alerts), bundle.management_remark
 
 
 def fetch_weather_alerts(engine, crop_no, variety_no, season_no):
-    """Retrieves the weather_alerts from the database
+    """Retrieves the weather_alerts from the crop catalog
     
-    :param engine: SqlAlchemy engine object providing DB access
+    :param engine: DataAccessSession or SqlAlchemy engine object providing DB access
     :param crop_no: integer cropid (from url query string)
     :param variety_no: integer varid (from url query string)
     :param season_no: integer seasonid (from url query string)
     """
-    metadata = MetaData(engine)
-    remark= ""
-    tbl = Table("weather_alerts", metadata, autoload=True)
-    r = select([tbl], and_(tbl.c.crop_no==crop_no,
-                           tbl.c.variety_no==variety_no,
-                           tbl.c.season_no==season_no)).execute()
-    rows = r.fetchall()
-    r.close()
-    
-    if not rows:
-        # no weatheralerts for varid? get cropid alerts only
-        remark = 'No weatheralerts available for varid {0} and seasonid {2}'.format(variety_no, crop_no, season_no)
-        rs = select([tbl], and_(tbl.c.crop_no==crop_no,
-                           tbl.c.variety_no==-1,
-                           tbl.c.season_no==-1)).execute()
-        rows = rs.fetchall()
-        rs.close()
-    
-    return rows,remark
+    with instrumentation.stage("weather_alerts") as s:
+        bundle = crop_catalog.get_crop_catalog(engine).bundle(crop_no, variety_no, season_no)
+        s.rows = len(bundle.weather_alerts)
+    return list(bundle.weather_alerts), bundle.weather_remark
+
+
+def fetch_crop_template(engine, crop_no, variety_no, season_no):
+    """Retrieves the compiled CropTemplate from the crop catalog, see `crop_template`.
+
+    :param engine: DataAccessSession or SqlAlchemy engine object providing DB access
+    :param crop_no: integer cropid (from url query string)
+    :param variety_no: integer varid (from url query string)
+    :param season_no: integer seasonid (from url query string)
+    """
+    with instrumentation.stage("crop_template"):
+        return crop_catalog.get_crop_catalog(engine).bundle(crop_no, variety_no, season_no).template
 
 
 class CropDataProvider(dict):
-    """Retrieves the crop parameters for the given grid_no, crop_no and year
-    from the tables CROP_CALENDAR, CROP_PARAMETER_VALUE and VARIETY_PARAMETER_VALUE.
+    """Provides the crop parameters for the given crop_no and variety_no from the
+    tables CROP_PARAMETER_VALUE and VARIETY_PARAMETER_VALUE, as held by the crop catalog.
 
-    :param engine: SqlAlchemy engine object providing DB access
+    :param engine: DataAccessSession or SqlAlchemy engine object providing DB access
     :param crop_no: integer cropid, maps to the CROP_NO column in the table.
     :param variety_no: integer varietyid, maps to the VARIETY_NO column in the table.
+
+    The parameters are copied from the catalog, so they can be modified without affecting
+    other requests.
     """
 
     def __init__(self, engine, crop_no, variety_no):
         dict.__init__(self)
 
-        self.crop_no = int(crop_no)
-        self.variety_no = int(variety_no)
-        self.crop_name = fetch_crop_name(engine, self.crop_no)
-        self.db_resource = str(engine)[7:-1]
-
-        metadata = MetaData(engine)
-
-        # get parameters from db
-        self._fetch_crop_parameter_values(metadata, self.crop_no)
-        # variety not mandatory
-        self._fetch_variety_parameter_values(metadata, self.crop_no, self.variety_no)
-
-        # Finally add crop name
-        self["crop_name"] = self.crop_name
-        
-    def _fetch_crop_parameter_values(self, metadata, crop_no):
-        """Derived the crop parameter values from the CROP_PARAMETER_VALUE
-        table for given crop_no and add directly to dict self[].
-        
-        :param metadata: metadata containing db engine definition.
-        :param crop_no: integer cropid, maps to the CROP_NO column in the table.
-        """
+        with instrumentation.stage("crop_data") as s:
+            session = data_access.get_session(engine)
+            self.crop_no = int(crop_no)
+            self.variety_no = int(variety_no)
+            self.db_resource = str(session)
+
+            bundle = crop_catalog.get_crop_catalog(session).bundle(self.crop_no, self.variety_no)
+            self.crop_name = bundle.crop_name
+            # includes the crop name
+            self.update(bundle.crop_parameters())
+            s.rows = len(self)
 
-        # Pull single value parameters from CROP_PARAMETER_VALUE
-        table_crop_pv = Table('crop_parameter_value', metadata, autoload=True)
-        r = select([table_crop_pv], table_crop_pv.c.crop_no == crop_no,order_by=table_crop_pv.c.parameter_code).execute()
-        rows = r.fetchall()
-        if not rows:
-            msg = "No parameter value found for cropid=%s."
-            raise exc.PCSEError(msg % self.crop_no)
-        for row in rows:
-            try:
-                pvalue = eval(row.parameter_value)
-            except SyntaxError:
-                msg = "Failed parsing parameter: %s from table CROP_PARAMETER_VALUE" % row.parameter_value
-                raise exc.PCSEError(msg)
-            pcode = row.parameter_code
-            self[pcode] = pvalue
-
-    def _fetch_variety_parameter_values(self, metadata, crop_no, variety_no):
-        """Derived the crop parameter values from the VARIETY_PARAMETER_VALUE
-        table for given crop_no & variety_on and add directly to dict self[].
-         
-        :param metadata: metadata containing db engine definition.
-        :param crop_no: integer cropid, maps to the CROP_NO column in the table.
-        :param variety_no: integer varietyid, maps to the VARIETY_NO column in the table.
-        """
 
-        # Pull single value parameters from CROP_PARAMETER_VALUE
-        table_crop_vpv = Table('variety_parameter_value', metadata, autoload=True)
-        r = select([table_crop_vpv], and_(table_crop_vpv.c.crop_no == crop_no,
-                                         table_crop_vpv.c.variety_no == variety_no),
-                    order_by=table_crop_vpv.c.parameter_code).execute()
-        rows = r.fetchall()
-        for row in rows:
-            try:
-                pvalue = eval(row.parameter_value)
-            except SyntaxError:
-                msg = "Failed parsing parameter: %s for table VARIETY_PARAMETER_VALUE" % row.parameter_value
-                raise exc.PCSEError(msg)
-            pcode = row.parameter_code
-            self[pcode] = pvalue
-
-
-def make_timerdata(date, cropd, crop_start_type=None, crop_end_type=None):
+def connect_weather_db():
+    """Returns a connection from the pool of the data access session, we use pymysql here for
+    calling stored procedures. Closing the connection returns it to the pool.
+
+    :return: a pymysql connection returning rows as dicts
+    """
+    return data_access.get_session().weather_connection()
+
+
+def fetch_grid_index(connection):
+    """Retrieves the grid definition from the 'grid' table and builds an in-memory index on it.
+
+    :param connection: pymysql connection to the weather database
+    :return: a GridIndex instance
+    """
+    cur = connection.cursor()
+    try:
+        cur.execute("select grid_no, latitude, longitude, elevation from grid")
+        rows = cur.fetchall()
+    except Exception as e:
+        msg = "Failed to retrieve the grid definition: %s" % e
+        raise exc.PCSEError(msg)
+    finally:
+        cur.close()
+
+    elevation = [float("nan") if r["elevation"] is None else r["elevation"] for r in rows]
+    grid_index = GridIndex(grid_no=[r["grid_no"] for r in rows],
+                           latitude=[r["latitude"] for r in rows],
+                           longitude=[r["longitude"] for r in rows],
+                           elevation=elevation, cell_size=config.cell_size)
+    return grid_index
+
+
+# The in-memory index on the grid definition used by this process, loaded on first use
+_grid_index = None
+
+
+def get_grid_index():
+    """Returns the in-memory index on the grid definition, the index is loaded from the
+    database at the first call. Call this function at startup to avoid loading
+    the index during the first request.
+    """
+    global _grid_index
+    if _grid_index is None:
+        connection = connect_weather_db()
+        try:
+            _grid_index = fetch_grid_index(connection)
+        finally:
+            connection.close()
+    return _grid_index
+
+
+def reload_grid_index():
+    """Discards the in-memory grid index, so that it is loaded again from the 'grid' table at
+    the next call of `get_grid_index()`, e.g. after the grid definition has been edited.
+    """
+    global _grid_index
+    _grid_index = None
+
+
+def fetch_grid_location(latitude, longitude):
+    """Retrieves the grid_no and elevation for given latitude/longitude from the in-memory grid index.
+
+    :param latitude: Latitude of location
+    :param longitude: Longitude of location
+    :return: a tuple of (grid_no, elevation)
+    """
+    try:
+        with instrumentation.stage("grid_location"):
+            grid_no, elevation = get_grid_index().lookup(latitude, longitude)
+    except Exception as e:
+        msg = "Failed deriving grid info for lat %s, lon %s :%s" % (latitude, longitude, e)
+        raise exc.PCSEError(msg)
+
+    return grid_no, elevation
+
+
+def fetch_weather_version(connection):
+    """Retrieves the last day for which observed weather data have been loaded into the database.
+
+    The daily load of observed weather data moves this day forward, therefore it can be used to
+    detect that weather data retrieved earlier from the database are outdated.
+
+    :param connection: pymysql connection to the weather database
+    :return: date of the most recent record in 'grid_weather_observed'
+    """
+    cur = connection.cursor()
+    try:
+        with instrumentation.stage("weather_version"):
+            cur.execute("select max(day) as day from grid_weather_observed")
+            row = cur.fetchone()
+    except Exception as e:
+        msg = "Failed to retrieve the version of the observed weather data: %s" % e
+        raise exc.PCSEError(msg)
+    finally:
+        cur.close()
+
+    return row["day"]
+
+
+def weather_data_version(wdp):
+    """Returns the version of the weather data held by a weather data provider.
+
+    The version consists of the last day of observed weather data and the issue day of the
+    weather forecast, supplemented with the period covered by the weather data for
+    providers that do not define these.
+
+    :param wdp: a weather data provider
+    :return: a tuple identifying the version of the weather data
+    """
+    return (getattr(wdp, "weather_version", None), getattr(wdp, "forecast_issue_day", None),
+            wdp.first_date, wdp.last_date)
+
+
+def current_forecast_issue_day():
+    """Returns the issue day of the most recent weather forecast in the forecast store, or the
+    current day in the local time zone of the area of interest when the store is empty.
+    """
+    issue_day = forecast_store.get_forecast_store().latest_issue_day()
+    if issue_day is None:
+        now = dt.datetime.utcnow() + dt.timedelta(seconds=config.weather.SECONDS_from_UTC)
+        issue_day = now.date()
+    return issue_day
+
+
+def make_timerdata(date, cropd, crop_start_type=None, crop_end_type=None, start_date=None):
     """generate timer data for the model pcse simulation
 
     :param date: starting date of the crop growth simulation
     :param cropd: crop data dict with the maximum duration of crop growth simulation
     :param crop_start_type: Start type of the simulation, either 'sowing' or 'emergence'
     :param crop_end_type: End type of the simulation, either 'maturity' or 'harvest'
+    :param start_date: the day at which the simulation starts, defaults to date. A later day is
+        used for continuing a simulation from a snapshot, the end of the simulation remains the same.
     """
-    max_dur = int(cropd.pop("MAX_DURATION"))
+    max_dur = int(cropd["MAX_DURATION"])
     gp = dt.timedelta(days=max_dur)
+    if start_date is None:
+        start_date = date
 
     r = {"CAMPAIGNYEAR": date.year,
-         "START_DATE": date,
+         "START_DATE": start_date,
          "END_DATE": date + gp,
          "CROP_START_TYPE": crop_start_type,
-         "CROP_START_DATE": date,
+         "CROP_START_DATE": start_date,
          "CROP_END_TYPE": crop_end_type,
          "CROP_END_DATE": date + gp,
-         "MAX_DURATION": max_dur}
+         "MAX_DURATION": max_dur - (start_date - date).days}
 
     return r
 
 
+def make_parameter_provider(date, cropd, crop_start_type=None, crop_end_type=None, start_date=None):
+    """Returns the ParameterProvider for a PCSE simulation of the crop, see `make_timerdata()`
+    for the parameters.
+
+    The crop parameters are not modified, MAX_DURATION is only passed in the timer data.
+    """
+    timerdata = make_timerdata(date, cropd, crop_start_type, crop_end_type, start_date)
+    cropdata = {name: value for name, value in cropd.items() if name != "MAX_DURATION"}
+    return ParameterProvider(cropdata=cropdata, soildata={}, sitedata={}, timerdata=timerdata)
+
+
+def simulation_window(sowing_date, max_duration):
+    """Returns the first and last day of the weather data needed for simulating a crop, which
+    is the period from START_DATE to END_DATE of `make_timerdata()`.
+
+    :param sowing_date: starting date of the crop growth simulation
+    :param max_duration: maximum duration of crop growth simulation in days
+    :return: a tuple (start_date, end_date)
+    """
+    return sowing_date, sowing_date + dt.timedelta(days=int(max_duration))
+
+
+# Columns of the grid weather tables retrieved by the columnar fetch, in this order
+grid_weather_columns = ("maximum_temperature", "minimum_temperature", "vapour_pressure", "windspeed",
+                        "rainfall", "calculated_radiation", "et0")
+
+# Adding a float literal makes MySQL return DOUBLE instead of DECIMAL values, so that no Decimal
+# objects are created. TO_DAYS() - 365 is the proleptic Gregorian ordinal of the day as used by Python.
+_observed_query = ("select to_days(day) - 365, %s from grid_weather_observed "
+                   "where grid_no=%%s and day between %%s and %%s" %
+                   ", ".join("%s + 0e0" % name for name in grid_weather_columns))
+# The LTA day is stored as mmdd, the modulo also gives mmdd if it is stored as a date
+_lta_query = ("select mod(day + 0, 10000), %s from grid_weather_lta where grid_no=%%s" %
+              ", ".join("%s + 0e0" % name for name in grid_weather_columns))
+
+
+class GridWeatherColumns(object):
+    """Weather data of a grid cell as float64 arrays for consecutive days, in the units used by PCSE.
+
+    :param first_day: date of the first day
+    :param columns: dict with an array for each of `GridWeatherColumns.variables`, NaN for days
+        without weather data
+    """
+    variables = ("TMAX", "TMIN", "VAP", "WIND", "RAIN", "IRRAD", "ET0", "ES0", "E0")
+
+    def __init__(self, first_day, columns):
+        self.first_day = first_day
+        self.columns = columns
+        self.available = ~np.isnan(columns["TMAX"])
+
+    @classmethod
+    def from_database(cls, first_day, values):
+        """Converts the weather data in the units of the database into the units used by PCSE.
+
+        :param first_day: date of the first day
+        :param values: (days x columns) array with the `grid_weather_columns` for consecutive days
+        """
+        tmax, tmin, vap, windspeed, rainfall, radiation, et0 = values.T
+        columns = {"TMAX": tmax,
+                   "TMIN": tmin,
+                   "VAP": vap,
+                   "WIND": wind10to2(windspeed),  # reference height 10 -> 2
+                   "RAIN": rainfall / 10.,  # mm to cm
+                   "IRRAD": radiation * 1000.,  # kJ to J
+                   "ET0": et0 / 10.,  # mm to cm
+                   "ES0": et0 / 10.,  # mm to cm
+                   "E0": et0 / 10.}  # mm to cm
+        return cls(first_day, {name: np.ascontiguousarray(columns[name]) for name in cls.variables})
+
+    def __len__(self):
+        return len(self.available)
+
+    @property
+    def last_day(self):
+        return self.first_day + dt.timedelta(days=len(self) - 1)
+
+    def to_frame(self):
+        """Returns the weather data as DataFrame indexed on DAY, without the days lacking weather data.
+        """
+        days = pd.date_range(self.first_day, periods=len(self), freq="D")
+        frame = pd.DataFrame(self.columns, index=pd.Index(days, name="DAY"))
+        return frame[self.available]
+
+
+def _fetch_into_buffer(cur, capacity, convert=None, batch_size=1000):
+    """Streams the rows of the query executed on the cursor into a preallocated float64 array.
+
+    :param cur: cursor with an executed query, rows consisting of numbers
+    :param capacity: the expected number of rows, the array grows when more rows are returned
+    :param convert: function converting a row into a tuple of numbers, if needed
+    :return: a (rows x columns) array
+    """
+    buffer = None
+    n = 0
+    while True:
+        rows = cur.fetchmany(batch_size)
+        if not rows:
+            break
+        if convert is not None:
+            rows = [convert(row) for row in rows]
+        if buffer is None:
+            buffer = np.empty((max(capacity, len(rows)), len(rows[0])))
+        elif n + len(rows) > len(buffer):
+            grown = np.empty((max(2 * len(buffer), n + len(rows)), buffer.shape[1]))
+            grown[:n] = buffer[:n]
+            buffer = grown
+        buffer[n:n + len(rows)] = rows
+        n += len(rows)
+    if buffer is None:
+        return np.empty((0, len(grid_weather_columns) + 1))
+    return buffer[:n]
+
+
+def _consecutive_days(ordinals, values, first=None, last=None):
+    """Places the values of the given day ordinals into an array for consecutive days, keeping
+    the first record in case of duplicate days.
+
+    :return: a (days x columns) array, NaN for days without values
+    """
+    ordinals = ordinals.astype(np.int64)
+    first = ordinals.min() if first is None else first
+    last = ordinals.max() if last is None else last
+    consecutive = np.full((last - first + 1, values.shape[1]), np.nan)
+    _, keep = np.unique(ordinals, return_index=True)
+    keep = keep[(ordinals[keep] >= first) & (ordinals[keep] <= last)]
+    consecutive[ordinals[keep] - first] = values[keep]
+    return consecutive
+
+
+def fetch_grid_weather_window(connection, grid_no, start_date, end_date):
+    """Retrieves the weather data of a grid cell for the days from start_date up to and including end_date.
+
+    Like the stored procedure 'get_grid_weather', observed weather data are used where available
+    and the long term average (LTA) weather data for the remaining days. Only the observed weather
+    data within the window and the LTA weather data of the grid cell are retrieved, instead of the
+    years of weather data returned by 'get_grid_weather'. The rows are streamed from an unbuffered
+    cursor directly into float64 arrays.
+
+    :param connection: pymysql connection to the weather database
+    :param grid_no: the grid number
+    :param start_date: first day of the window
+    :param end_date: last day of the window
+    :return: a GridWeatherColumns instance covering the window
+    """
+    first, last = start_date.toordinal(), end_date.toordinal()
+    ndays = last - first + 1
+    with instrumentation.stage("grid_weather") as s:
+        cur = connection.cursor(streaming=True)
+        try:
+            cur.execute(_observed_query, (grid_no, start_date, end_date))
+            observed = _fetch_into_buffer(cur, ndays)
+            nrows = len(observed)
+            values = _consecutive_days(observed[:, 0], observed[:, 1:], first, last)
+            missing = np.isnan(values[:, 0])
+            if missing.any():
+                cur.execute(_lta_query, (grid_no,))
+                lta = _fetch_into_buffer(cur, 366)
+                nrows += len(lta)
+                lta = _consecutive_days(lta[:, 0], lta[:, 1:], 0, 1231)
+                # The LTA of 28 February is used for 29 February when it is not available
+                if np.isnan(lta[229, 0]):
+                    lta[229] = lta[228]
+                days = pd.date_range(start_date, periods=ndays, freq="D")
+                mmdd = (days.month * 100 + days.day).to_numpy()
+                values[missing] = lta[mmdd[missing]]
+        except Exception as e:
+            msg = "Failed to retrieve grid weather data for grid %s between %s and %s: %s" % \
+                  (grid_no, start_date, end_date, e)
+            raise exc.PCSEError(msg)
+        finally:
+            cur.close()
+        s.rows = nrows
+        s.bytes = values.nbytes
+
+    return GridWeatherColumns.from_database(start_date, values)
+
+
+def fetch_grid_weather(connection, grid_no):
+    """Retrieves the weather data of a grid cell from stored procedure 'get_grid_weather', see
+    `config.simulator.historic_years` and `config.simulator.future_years`.
+
+    :param connection: pymysql connection to the weather database
+    :param grid_no: the grid number
+    :return: a GridWeatherColumns instance
+    """
+    with instrumentation.stage("grid_weather") as s:
+        cur = connection.cursor(streaming=True)
+        try:
+            cur.execute("call get_grid_weather(%s,%s,%s)", (grid_no, config.simulator.historic_years,
+                                                            config.simulator.future_years))
+            names = [d[0] for d in cur.description]
+            iday = names.index("day")
+            icolumns = [names.index(name) for name in grid_weather_columns]
+
+            def convert(row):
+                day = row[iday]
+                return (np.nan if day is None else check_date(day).toordinal(),) + tuple(row[i] for i in icolumns)
+
+            rows = _fetch_into_buffer(cur, 2 * 366, convert)
+            rows = rows[~np.isnan(rows[:, 0])]
+            if len(rows) == 0:
+                raise ValueError("no rows returned")
+            values = _consecutive_days(rows[:, 0], rows[:, 1:])
+        except Exception as e:
+            msg = "Failed to retrieve grid weather data for grid %s: %s" % (grid_no, e)
+            raise exc.PCSEError(msg)
+        finally:
+            cur.close()
+        s.rows = len(rows)
+        s.bytes = values.nbytes
+
+    return GridWeatherColumns.from_database(dt.date.fromordinal(int(rows[:, 0].min())), values)
+
+
 class GridWeatherDataProvider(WeatherDataProvider):
     """Retrieves meteodata from the GRID_WEATHER table in a CGMS (like) database.
 
@@ -264,39 +512,24 @@ class GridWeatherDataProvider(WeatherDataProvider):
         self.elevation = 25
 
         # set DB connect, we use pymysql here for calling stored procedures
-        self.connection = pymysql.connect(host=config.database.myhost, user=config.database.myuser,
-                                          password=config.database.mypwd, db=config.database.mydb,
-                                          port=config.database.port,
-                                          cursorclass=pymysql.cursors.DictCursor, autocommit=True)
-
-        # Get location info (lat/lon/elevation)
-        self._fetch_location_from_db()
+        self.connection = connect_weather_db()
+        try:
+            # Get location info (lat/lon/elevation)
+            self._fetch_location_from_db()
 
-        # Retrieved meteo data
-        self._fetch_grid_weather_from_db()
+            # Retrieved meteo data
+            self._fetch_grid_weather_from_db()
+        finally:
+            # Return the pooled connection also when retrieving the weather data failed
+            self.connection.close()
 
         # Add description for print()
         self.description = ["Weather data derived for area %s" % config.area_name]
 
-        self.connection.close()
-
     def _fetch_location_from_db(self):
-        """Retrieves grid_no from 'grid' table via  a stored procedure and
+        """Retrieves grid_no from the in-memory index on the 'grid' table and
         assigns it to self.grid_no"""
-        # Pull grid nr from database
-
-        try:
-            cur = self.connection.cursor()
-            cur.execute("call get_grid(%s,%s,%s)" % (self.latitude, self.longitude, config.cell_size));
-            row = cur.fetchall()
-            cur.close()
-            if row is ():
-                raise Exception("no rows found")
-        except Exception as e:
-            msg = "Failed deriving grid info for lat %s, lon %s :%s" % (self.latitude, self.longitude, e)
-            raise exc.PCSEError(msg)
-
-        self.grid_no = row[0]['grid_no']
+        self.grid_no, _ = fetch_grid_location(self.latitude, self.longitude)
 
     def _fetch_grid_weather_from_db(self):
         """Retrieves the meteo data from stored procedure 'grid_weather'.
@@ -304,8 +537,8 @@ class GridWeatherDataProvider(WeatherDataProvider):
 
         try:
             cur = self.connection.cursor()
-            cur.execute("call get_grid_weather(%s,%s,%s)" % (self.grid_no, config.simulator.historic_years,
-                                                             config.simulator.future_years));
+            cur.execute("call get_grid_weather(%s,%s,%s)", (self.grid_no, config.simulator.historic_years,
+                                                            config.simulator.future_years))
             rows = DataFrame(cur.fetchall())
             cur.close()
 
@@ -341,17 +574,30 @@ class GridWeatherDataProvider(WeatherDataProvider):
 
 class CombinedECMWFDarkSkyWeatherDataProvider(WeatherDataProvider):
     """Retrieves meteodata from the GRID_WEATHER_OBSERVED table in the database
-    and combines it with a weather forecast from DarkSky plus a climatology
+    and combines it with the weather forecast from the forecast store plus a climatology
     for the remaining part of the year.
 
     :param latitude: Latitude of location to retrieve weather data
     :param longitude: Longitude of location to retrieve weather data
+    :param grid_no: grid_no of the location, if already known this avoids retrieving it again.
+    :param elevation: elevation of the grid, must be provided together with grid_no
+    :param start_date: first day of the weather data to retrieve
+    :param end_date: last day of the weather data to retrieve, the window is extended to the last
+        day of the weather forecast when that is later.
+
+    Without start_date and end_date, all weather data returned by the stored procedure
+    'get_grid_weather' are retrieved (see `config.simulator.historic_years` and
+    `config.simulator.future_years`). Use `simulation_window()` for the window needed by a simulation.
     """
-    relevant_darksky_variables = ("precipIntensity", "dewPoint", "humidity", "pressure", "windSpeed",
-                                  "cloudCover", "visibility", "temperatureMin", "temperatureMax")
     weather_data = None
+    _weather_index = None
+
+    forecast_issue_day = None
+    weather_version = None
+    window = None
+    grid_weather = None
 
-    def __init__(self, latitude, longitude):
+    def __init__(self, latitude, longitude, grid_no=None, elevation=None, start_date=None, end_date=None):
 
         WeatherDataProvider.__init__(self)
 
@@ -359,155 +605,253 @@ class CombinedECMWFDarkSkyWeatherDataProvider(WeatherDataProvider):
         self.longitude = float(longitude)
         self.elevation = -999
 
-        # set DB connect, we use pymysql here for calling stored procedures
-        c = config.database.default_user
-        self.connection = pymysql.connect(host=c.host, user=c.user, password=c.pwd, db=c.db,
-                                          port=c.port, cursorclass=pymysql.cursors.DictCursor,
-                                          autocommit=True)
+        # Get location info (lat/lon/elevation), unless the grid was already resolved by the caller
+        if grid_no is None:
+            self._fetch_location_from_db()
+        else:
+            self.grid_no = grid_no
+            self.elevation = elevation
+
+        self.forecast_issue_day, forecast = forecast_store.get_forecast_store().get_forecast(self.grid_no)
 
-        # Get location info (lat/lon/elevation)
-        self._fetch_location_from_db()
+        # set DB connect, we use pymysql here for calling stored procedures
+        self.connection = connect_weather_db()
+        try:
+            # Retrieved meteo data
+            self.weather_version = fetch_weather_version(self.connection)
+            if start_date is not None and end_date is not None:
+                self.window = (check_date(start_date), max(check_date(end_date), forecast.index[-1].date()))
+            self._fetch_grid_weather_from_db()
+        finally:
+            # Return the pooled connection also when retrieving the weather data failed
+            self.connection.close()
 
-        # Retrieved meteo data
-        self._fetch_grid_weather_from_db()
-        self._integrate_DarkSky_forecast()
+        self._integrate_DarkSky_forecast(forecast)
         self._compute_derived_variables()
+        self._freeze_weather_data()
 
         # Add description for print()
         self.description = ["Weather data derived for area %s" % config.area_name]
 
-        self.connection.close()
-
     def _fetch_location_from_db(self):
-        """Retrieves grid_no from 'grid' table via  a stored procedure and
+        """Retrieves grid_no and elevation from the in-memory index on the 'grid' table and
         assigns it to self.grid_no"""
-        # Pull grid nr from database
-
-        cur = self.connection.cursor()
-        try:
-            cur.execute("call get_grid(%s,%s,%s)" % (self.latitude, self.longitude, config.cell_size))
-            row = cur.fetchall()
-            if row is ():
-                raise Exception("no rows found")
-            self.grid_no = row[0]['grid_no']
-            cur.execute("select elevation from grid where grid_no=%i" % self.grid_no)
-            row = cur.fetchone()
-            self.elevation = row["elevation"]
-        except Exception as e:
-            msg = "Failed deriving grid info for lat %s, lon %s :%s" % (self.latitude, self.longitude, e)
-            raise exc.PCSEError(msg)
-        finally:
-            cur.close()
+        self.grid_no, self.elevation = fetch_grid_location(self.latitude, self.longitude)
 
     def _fetch_grid_weather_from_db(self):
-        """Retrieves the meteo data from stored procedure 'grid_weather'.
+        """Retrieves the meteo data within the window of the provider, or from stored procedure
+        'grid_weather' when no window is defined.
         """
-        try:
-            cur = self.connection.cursor()
-            cur.execute("call get_grid_weather(%s,%s,%s)" % (self.grid_no, config.simulator.historic_years,
-                                                             config.simulator.future_years))
-            rows = cur.fetchall()
-            grid_weather_data = pd.DataFrame(rows)
-            self.weather_data = pd.DataFrame({"DAY": pd.to_datetime(grid_weather_data.day),
-                                              "TMAX": grid_weather_data.maximum_temperature.astype(float),
-                                              "TMIN": grid_weather_data.minimum_temperature.astype(float),
-                                              "VAP": grid_weather_data.vapour_pressure.astype(float),
-                                              "WIND": (grid_weather_data.windspeed.astype(float)).apply(wind10to2),  # reference height 10 -> 2
-                                              "RAIN": grid_weather_data.rainfall.astype(float)/10.,  # mm to cm
-                                              "IRRAD": grid_weather_data.calculated_radiation.astype(float) * 1000.,  # kJ to J
-                                              "ET0": grid_weather_data.et0.astype(float)/10.,  # mm to cm
-                                              "ES0": grid_weather_data.et0.astype(float)/10.,  # mm to cm
-                                              "E0": grid_weather_data.et0.astype(float)/10.  # mm to cm
-                                              }).set_index("DAY")
-
-        except Exception as e:
-            msg = "Failed to retrieve grid weather data for grid %i" % self.grid_no
-            logging.exception(msg)
+        if self.window is not None:
+            self.grid_weather = fetch_grid_weather_window(self.connection, self.grid_no, *self.window)
+        else:
+            self.grid_weather = fetch_grid_weather(self.connection, self.grid_no)
+        if not self.grid_weather.available.any():
+            msg = "No grid weather data available for grid %s" % self.grid_no
             raise exc.PCSEError(msg)
-        finally:
-            cur.close()
+        self.weather_data = self.grid_weather.to_frame()
 
-    def _integrate_DarkSky_forecast(self):
-        """Integrates the DarkSky forecast into the grid weather data from the database by overwriting
-        the relevant days/variables with data from DarkSky.
+    def _integrate_DarkSky_forecast(self, forecast):
+        """Integrates the weather forecast into the grid weather data from the database by overwriting
+        the relevant days/variables with the forecast for the grid cell.
+
+        The forecast is read from the local forecast store, which is filled once per issue day for
+        all grid cells by `forecast_sources.ingest_forecast()`. Therefore, no requests are made to
+        external services for retrieving the forecast.
+
+        :param forecast: DataFrame with the forecast for the grid cell from the forecast store
+
+        Only the days after the last day of observed weather data (`self.weather_version`) are
+        taken from the forecast, observed weather data are never overwritten by the forecast of an
+        issue day that was ingested before the observed data were loaded.
         """
-        forecast = self._call_darksky_forecast_api()
-        pcse_forecast = pd.DataFrame({"DAY": pd.to_datetime(forecast.day),
-                                      "TMAX": forecast.temperatureMax.astype(float),
-                                      "TMIN": forecast.temperatureMin.astype(float),
-                                      "VAP": (forecast.dewPoint.apply(ea_from_tdew)).astype(float) * 10., # kPa to hPa
-                                      "WIND": forecast.windSpeed.astype(float),
-                                      "RAIN": forecast.precipIntensity.astype(float) * 24/10.  # Convert from mm/hr to cm/day
-                                      }).set_index("DAY")
-        self.weather_data.update(pcse_forecast, overwrite=True)
+        if self.weather_version is not None:
+            if self.forecast_issue_day is not None and self.forecast_issue_day <= self.weather_version:
+                self.logger.warning("Forecast issued at %s is older than the observed weather data until "
+                                    "%s, only its days after the observed data are used." %
+                                    (self.forecast_issue_day, self.weather_version))
+            forecast = forecast[forecast.index > pd.Timestamp(self.weather_version)]
+        self.weather_data.update(forecast, overwrite=True)
 
         # Add latitude/longitude columns
         self.weather_data["LAT"] = self.latitude
         self.weather_data["LON"] = self.longitude
 
     def _compute_derived_variables(self):
-        """Computes the TEMP and DTEMP values for the entire data frame with weather data.
+        """Computes the derived weather variables for the entire data frame with weather data at
+        once, so that the simulation objects can take them from the driving variables:
+
+        - TEMP and DTEMP: daily average and daytime temperature [C]
+        - SVAP: daily average saturated vapour pressure [kPa] from TMAX and TMIN
+        - RH: relative humidity [%] from SVAP and VAP
+        - DAYLENGTH: photoperiodic daylength [hours]
+        - DOY: day of the year
         """
-        self.weather_data["TEMP"] = (self.weather_data.TMAX + self.weather_data.TMIN)/2.0
-        self.weather_data["DTEMP"] = (self.weather_data.TMAX + self.weather_data.TEMP)/2.0
-
-    def _call_darksky_forecast_api(self):
-        """queries the darksky forecast data for given location
-
-        No caching is performed as the forecast has to be retrieved every day again anyway.
-
-        :param location: the object specifying the location of the site
-        :return: a list with dicts containing weather data
+        wd = self.weather_data
+        wd["TEMP"] = (wd.TMAX + wd.TMIN)/2.0
+        wd["DTEMP"] = (wd.TMAX + wd.TEMP)/2.0
+        wd["SVAP"], wd["RH"] = humidity(wd.TMAX.to_numpy(), wd.TMIN.to_numpy(), wd.VAP.to_numpy())
+        doy = wd.index.dayofyear.to_numpy()
+        wd["DOY"] = doy
+        # The daylength only depends on the day of the year, it is looked up in a table per latitude
+        wd["DAYLENGTH"] = daylength_table(float(self.latitude))[doy]
+
+    def _freeze_weather_data(self):
+        """Freezes the weather data frame into a lookup table that maps the day ordinal onto the
+        weather record for that day. This makes retrieving the weather for a given day a constant
+        time operation instead of a scan over the entire data frame.
+        """
+        weather_index = {}
+        days = [d.toordinal() for d in self.weather_data.index.date]
+        for day, row in zip(days, self.weather_data.itertuples(index=False)):
+            # Keep the first record in case of duplicate days, similar to a scan over the data frame
+            weather_index.setdefault(day, row)
+        self._weather_index = weather_index
+        self._first_ordinal = min(weather_index)
+        self._last_ordinal = max(weather_index)
+
+        # Columns with weather variables for consecutive days starting at the first day, days
+        # that are missing in the data frame are NaN.
+        wd = self.weather_data[~self.weather_data.index.duplicated(keep="first")]
+        wd = wd.reindex(pd.date_range(self.first_date, self.last_date, freq="D"))
+        self._weather_columns = {name: wd[name].to_numpy(dtype=float) for name in wd.columns}
+        self._weather_available = wd.notna().all(axis=1).to_numpy()
+
+    def get_weather_arrays(self, start_date, end_date):
+        """Returns the weather data for consecutive days from start_date up to and including end_date.
+
+        :param start_date: first day of the period
+        :param end_date: last day of the period
+        :return: a dict with an array for each weather variable (e.g. TMAX, TMIN, TEMP, LAT)
         """
-        f_URL = config.weather.DARKSKY_forecast_api.format(latitude=self.latitude,
-                                                           longitude=self.longitude)
-        r = requests.get(f_URL)
-        if r.status_code != 200:
-            msg = "Failed to retrieve weather forecast data from DarkSky for lat/lon %s/%s"
-            raise RuntimeError(msg % (self.latitude, self.longitude))
-        daily_weather = self._parse_darksky_forecast_response(r.text)
-        return pd.DataFrame(daily_weather)
-
-    def _parse_darksky_forecast_response(self, json_response):
-        """Parses the DarkSky forecast response.
+        start = check_date(start_date).toordinal() - self._first_ordinal
+        end = check_date(end_date).toordinal() - self._first_ordinal + 1
+        if start < 0 or end > len(self._weather_available) or not self._weather_available[start:end].all():
+            msg = "No weather data available for all days between %s and %s"
+            raise KeyError(msg % (start_date, end_date))
+        return {name: values[start:end] for name, values in self._weather_columns.items()}
+
+    def covers(self, start_date, end_date):
+        """Returns True if the window of the provider includes the period from start_date up to
+        and including end_date, a provider without window covers any period. A period without
+        start_date or end_date stands for all weather data of the grid cell.
         """
-        r = json.loads(json_response)
-        daily_weather = []
-        issue_day = None
+        if self.window is None:
+            return True
+        if start_date is None or end_date is None:
+            return False
+        return self.window[0] <= start_date and end_date <= self.window[1]
+
+    def __call__(self, day):
+        d = check_date(day)
         try:
-            for i, daily_data in enumerate(r["daily"]["data"]):
-                utc_time = dt.datetime.utcfromtimestamp(daily_data["time"])
-                if issue_day is None:
-                    issue_day = (utc_time + dt.timedelta(seconds=config.weather.SECONDS_from_UTC)).date()
-                t = {"day": issue_day + dt.timedelta(days=i), "latitude": self.latitude,
-                     "longitude": self.longitude}
-                for variable, value in daily_data.items():
-                    if variable in self.relevant_darksky_variables:
-                        t[variable] = float(value)
-                daily_weather.append(t)
+            return self._weather_index[d.toordinal()]
         except KeyError:
-            msg = "No DarkSky forecast available"
-            raise RuntimeError(msg)
+            raise KeyError("cannot find day '%s'" % d)
+
+    @property
+    def first_date(self):
+        return dt.date.fromordinal(self._first_ordinal)
+
+    @property
+    def last_date(self):
+        return dt.date.fromordinal(self._last_ordinal)
+
+    @property
+    def missing(self):
+        return 0
+
 
-        return daily_weather
+class EnsembleWeatherDataProvider(WeatherDataProvider):
+    """Weather data with an ensemble forecast (e.g. GEFS) for a grid cell.
+
+    The observed weather data and climatology are taken from a `CombinedECMWFDarkSkyWeatherDataProvider`,
+    the days covered by the ensemble forecast are replaced by the weather of each ensemble member.
+    The weather data of all members are available as (members x days) arrays through
+    `get_ensemble_arrays()`. Retrieving the weather for a single day with `wdp(day)` or with
+    `get_weather_arrays()` returns the deterministic weather of the underlying provider, so the
+    provider can also be used for runs that do not support ensembles.
+
+    :param wdp: a CombinedECMWFDarkSkyWeatherDataProvider for the grid cell
+    :param forecast: a DataFrame with the columns MEMBER, DAY and the forecasted weather
+        variables TMAX, TMIN, VAP, WIND and RAIN in the same units as the weather data of wdp.
+    """
+    ensemble_variables = ("TMAX", "TMIN", "VAP", "WIND", "RAIN")
+
+    def __init__(self, wdp, forecast):
+        WeatherDataProvider.__init__(self)
+
+        self.wdp = wdp
+        self.latitude = wdp.latitude
+        self.longitude = wdp.longitude
+        self.elevation = wdp.elevation
+        self.grid_no = wdp.grid_no
+        self.weather_version = wdp.weather_version
+
+        self.members = sorted(forecast.MEMBER.unique())
+        if not self.members:
+            msg = "No ensemble members found in the forecast for grid %s" % self.grid_no
+            raise exc.PCSEError(msg)
+        days = pd.to_datetime(forecast.DAY).dt.date
+        self.forecast_issue_day = min(days)
+        self._build_ensemble_columns(forecast, days)
+
+        self.description = ["Ensemble weather data (%i members) derived for area %s" %
+                            (len(self.members), config.area_name)]
+
+    def _build_ensemble_columns(self, forecast, days):
+        """Fills (members x days) arrays with the weather of the underlying provider and replaces the
+        days covered by the forecast with the weather of each member.
+        """
+        nmembers = len(self.members)
+        day_index = np.array([d.toordinal() for d in days]) - self.wdp._first_ordinal
+        member_index = np.searchsorted(self.members, forecast.MEMBER.to_numpy())
+        # Forecasted days beyond the period of the underlying weather data are ignored
+        ndays = len(self.wdp._weather_available)
+        in_range = (day_index >= 0) & (day_index < ndays)
+
+        columns = {}
+        for name in self.ensemble_variables:
+            values = np.tile(self.wdp._weather_columns[name], (nmembers, 1))
+            values[member_index[in_range], day_index[in_range]] = forecast[name].to_numpy(dtype=float)[in_range]
+            columns[name] = values
+        columns["TEMP"] = (columns["TMAX"] + columns["TMIN"])/2.0
+        columns["DTEMP"] = (columns["TMAX"] + columns["TEMP"])/2.0
+        columns["SVAP"], columns["RH"] = humidity(columns["TMAX"], columns["TMIN"], columns["VAP"])
+        self._ensemble_columns = columns
+
+    def get_ensemble_arrays(self, start_date, end_date):
+        """Returns the weather data of all ensemble members for consecutive days from start_date up
+        to and including end_date.
+
+        :param start_date: first day of the period
+        :param end_date: last day of the period
+        :return: a dict with a (members x days) array for each weather variable. Variables that are
+            not part of the ensemble (e.g. LAT, IRRAD) are the same for all members.
+        """
+        weather = self.wdp.get_weather_arrays(start_date, end_date)
+        start = check_date(start_date).toordinal() - self.wdp._first_ordinal
+        end = check_date(end_date).toordinal() - self.wdp._first_ordinal + 1
+        shape = (len(self.members), end - start)
+        arrays = {name: np.broadcast_to(values, shape) for name, values in weather.items()}
+        for name, values in self._ensemble_columns.items():
+            arrays[name] = values[:, start:end]
+        return arrays
+
+    def get_weather_arrays(self, start_date, end_date):
+        return self.wdp.get_weather_arrays(start_date, end_date)
 
     def __call__(self, day):
-        d = check_date(day)
-        ix = self.weather_data.index == str(d)
-        if any(ix):
-            for row in self.weather_data[ix].itertuples(index=False):
-                return row
-        else:
-            raise KeyError("cannot find day '%s'" % d)
+        return self.wdp(day)
 
     @property
     def first_date(self):
-        return self.weather_data.index.min()
+        return self.wdp.first_date
 
     @property
     def last_date(self):
-        return self.weather_data.index.max()
+        return self.wdp.last_date
 
     @property
     def missing(self):
-        return 0
\ No newline at end of file
+        return 0
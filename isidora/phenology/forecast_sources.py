@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+# Copyright Alterra, Wageningen-UR
+# Allard de Wit (allard.dewit@wur.nl), March 2023
+"""Sources of gridded weather forecasts and their ingestion into the forecast store.
+
+A forecast source reads the forecast of an issue day for the area of interest as daily values
+on the grid of the source. `ingest_forecast()` interpolates the forecast onto the centroids
+of all grid cells and writes it into the local forecast store (see `forecast_store`), from
+which the weather data providers read the forecast of their grid cell. Ingestion runs once per
+issue day, e.g. from cron after the forecast has been downloaded::
+
+    python -m phenology.forecast_sources 2023-06-15 --source gfs
+
+New sources are added by subclassing `ForecastSource` and registering them in `sources`.
+"""
+import argparse
+import datetime as dt
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+try:
+    import xarray as xr
+except ImportError:
+    xr = None
+
+import config
+from pcse.exceptions import PCSEError
+from pcse.util import wind10to2
+from . import data_providers as dp
+from . import forecast_store
+from .weather_alerts_simulator import SatVapourPressure
+
+logger = logging.getLogger(__name__)
+
+
+class ForecastSource(object):
+    """Base class for sources of gridded weather forecasts.
+    """
+    name = None
+
+    def read(self, issue_day):
+        """Reads the forecast of an issue day.
+
+        :param issue_day: date object with the issue day of the forecast
+        :return: a tuple (first_day, latitudes, longitudes, arrays) with the first forecasted
+            day, the latitudes and longitudes of the grid of the source and a dict with a
+            (days x latitudes x longitudes) array for each of `forecast_store.forecast_variables`
+        """
+        raise NotImplementedError
+
+
+class GFSNetCDFSource(ForecastSource):
+    """Reads the 3-hourly 0.25 degree GFS forecast downloaded as NetCDF file (see the weather
+    documentation) and aggregates it into daily values in the local time of the area of interest.
+
+    Only complete local days are used. Temperatures are converted from Kelvin to Celsius,
+    vapour pressure is derived from the dew point temperature, wind speed is converted from
+    10m to 2m and rainfall is converted from the 6-hourly accumulation buckets of GFS into
+    daily totals in cm/day.
+
+    :param directory: the directory with the GFS downloads, defaults to
+        `config.weather.GFS_download_directory`
+    :param file_template: the file name of the downloads as strftime template, defaults to
+        `config.weather.GFS_forecast_file`
+    """
+    name = "gfs"
+    steps_per_day = 8
+
+    def __init__(self, directory=None, file_template=None):
+        self.directory = config.weather.GFS_download_directory if directory is None else directory
+        self.file_template = config.weather.GFS_forecast_file if file_template is None else file_template
+
+    def read(self, issue_day):
+        if xr is None:
+            msg = "xarray is needed for reading GFS forecast files."
+            raise PCSEError(msg)
+        fname = os.path.join(self.directory, issue_day.strftime(self.file_template))
+        if not os.path.exists(fname):
+            msg = "GFS forecast file not found: %s" % fname
+            raise PCSEError(msg)
+
+        with xr.open_dataset(fname) as ds:
+            lat = ds["lat"].values
+            lon = ds["lon"].values
+            ilat = np.flatnonzero((lat >= config.lat_bnds[0] - 1.) & (lat <= config.lat_bnds[1] + 1.))
+            ilon = np.flatnonzero((lon >= config.lon_bnds[0] - 1.) & (lon <= config.lon_bnds[1] + 1.))
+            ds = ds.isel(lat=ilat, lon=ilon)
+            utc_times = pd.to_datetime(ds["time"].values)
+            tmax = ds["tmax2m"].values - 273.15
+            tmin = ds["tmin2m"].values - 273.15
+            tdew = ds["dpt2m"].values - 273.15
+            wind = np.sqrt(ds["ugrd10m"].values**2 + ds["vgrd10m"].values**2)
+            rain = self._deaccumulate(ds["apcpsfc"].values, utc_times)
+            lat, lon = lat[ilat], lon[ilon]
+
+        # Group the time steps into complete days in local time
+        local_days = (utc_times + pd.Timedelta(seconds=config.weather.SECONDS_from_UTC)).normalize()
+        days = [day for day in local_days.unique() if (local_days == day).sum() == self.steps_per_day]
+        if not days:
+            msg = "No complete days found in GFS forecast file %s" % fname
+            raise PCSEError(msg)
+
+        arrays = {name: [] for name in forecast_store.forecast_variables}
+        for day in days:
+            ix = np.flatnonzero(local_days == day)
+            arrays["TMAX"].append(tmax[ix].max(axis=0))
+            arrays["TMIN"].append(tmin[ix].min(axis=0))
+            arrays["VAP"].append(SatVapourPressure(tdew[ix]).mean(axis=0) * 10.)  # kPa to hPa
+            arrays["WIND"].append(wind10to2(wind[ix].mean(axis=0)))
+            arrays["RAIN"].append(rain[ix].sum(axis=0) / 10.)  # mm to cm
+        arrays = {name: np.stack(values) for name, values in arrays.items()}
+
+        # Daily steps must be consecutive days
+        first_day = days[0].date()
+        expected = pd.date_range(days[0], periods=len(days), freq="D")
+        if not (pd.DatetimeIndex(days) == expected).all():
+            msg = "Days in GFS forecast file %s are not consecutive" % fname
+            raise PCSEError(msg)
+
+        return first_day, lat, lon, arrays
+
+    @staticmethod
+    def _deaccumulate(values, utc_times):
+        """Converts the GFS precipitation, accumulated over 6-hourly buckets, into 3-hourly amounts.
+
+        The value at forecast hours 6, 12, 18, ... is the amount since the start of the bucket,
+        so the amount of the preceding 3 hours is subtracted.
+        """
+        hours = ((utc_times - utc_times[0]) / pd.Timedelta(hours=1)).to_numpy()
+        amounts = np.array(values, dtype=np.float64)
+        for i in range(1, len(hours)):
+            if hours[i] % 6 == 0 and hours[i] - hours[i - 1] == 3:
+                amounts[i] = values[i] - values[i - 1]
+        return np.maximum(amounts, 0.)
+
+
+sources = {GFSNetCDFSource.name: GFSNetCDFSource}
+
+
+def interpolate_to_points(latitudes, longitudes, values, point_latitudes, point_longitudes):
+    """Bilinear interpolation of gridded values onto points.
+
+    :param latitudes: array with the latitudes of the grid, ascending or descending
+    :param longitudes: array with the longitudes of the grid, ascending or descending
+    :param values: (days x latitudes x longitudes) array
+    :param point_latitudes: array with the latitudes of the points
+    :param point_longitudes: array with the longitudes of the points
+    :return: (days x points) array, NaN for points outside the grid
+    """
+    if latitudes[0] > latitudes[-1]:
+        latitudes, values = latitudes[::-1], values[:, ::-1, :]
+    if longitudes[0] > longitudes[-1]:
+        longitudes, values = longitudes[::-1], values[:, :, ::-1]
+
+    def weights(axis, points):
+        i = np.clip(np.searchsorted(axis, points, side="right") - 1, 0, len(axis) - 2)
+        w = (points - axis[i]) / (axis[i + 1] - axis[i])
+        outside = (points < axis[0]) | (points > axis[-1])
+        return i, w, outside
+
+    i, wy, out_lat = weights(latitudes, point_latitudes)
+    j, wx, out_lon = weights(longitudes, point_longitudes)
+    result = (values[:, i, j] * (1 - wy) * (1 - wx) +
+              values[:, i + 1, j] * wy * (1 - wx) +
+              values[:, i, j + 1] * (1 - wy) * wx +
+              values[:, i + 1, j + 1] * wy * wx)
+    result[:, out_lat | out_lon] = np.nan
+    return result
+
+
+def ingest_forecast(issue_day=None, source=None, store=None):
+    """Reads the forecast of an issue day from the source and stores it for all grid cells.
+
+    :param issue_day: date object with the issue day, defaults to the current day in the local
+        time of the area of interest
+    :param source: a ForecastSource, defaults to the source defined by `config.weather.forecast_source`
+    :param store: a ForecastStore, defaults to the forecast store of this process
+    """
+    if issue_day is None:
+        issue_day = (dt.datetime.utcnow() + dt.timedelta(seconds=config.weather.SECONDS_from_UTC)).date()
+    if source is None:
+        source = sources[config.weather.forecast_source]()
+    if store is None:
+        store = forecast_store.get_forecast_store()
+
+    first_day, latitudes, longitudes, arrays = source.read(issue_day)
+    grid_index = dp.get_grid_index()
+    gridded = {}
+    for name, values in arrays.items():
+        gridded[name] = interpolate_to_points(latitudes, longitudes, values,
+                                              grid_index.latitude, grid_index.longitude).T
+    nmissing = np.isnan(gridded["TMAX"]).all(axis=1).sum()
+    if nmissing == len(grid_index):
+        msg = "Forecast issued at %s from source %s covers none of the grid cells" % (issue_day, source.name)
+        raise PCSEError(msg)
+    if nmissing:
+        logger.warning("No forecast for %i of %i grid cells, these are outside the forecast grid." %
+                       (nmissing, len(grid_index)))
+    store.write(issue_day, first_day, grid_index.grid_no, gridded, source=source.name)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Ingest the weather forecast for all grid cells.")
+    parser.add_argument("issue_day", nargs="?", default=None, help="Issue day as YYYY-MM-DD, defaults to today")
+    parser.add_argument("--source", default=None, choices=sorted(sources), help="The forecast source")
+    args = parser.parse_args(args)
+
+    issue_day = None
+    if args.issue_day is not None:
+        issue_day = dt.datetime.strptime(args.issue_day, "%Y-%m-%d").date()
+    source = None if args.source is None else sources[args.source]()
+    ingest_forecast(issue_day, source)
+
+
+if __name__ == "__main__":
+    main()
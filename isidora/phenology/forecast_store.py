@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+# Copyright Alterra, Wageningen-UR
+# Allard de Wit (allard.dewit@wur.nl), March 2023
+"""Local store of the weather forecast for all grid cells.
+
+The forecast is ingested once per issue day for the entire grid (see `forecast_sources`) and
+stored in a directory per issue day, holding a (grid cells x days) array for each weather
+variable as a NumPy file. The arrays are memory-mapped when read, so retrieving the forecast
+for a grid cell only reads the rows of that grid cell from disk and no requests are made to
+external services.
+
+Layout of the store::
+
+    <directory>/<issue day as YYYYMMDD>/meta.json
+                                       /grid_no.npy
+                                       /TMAX.npy, TMIN.npy, VAP.npy, WIND.npy, RAIN.npy
+"""
+import datetime as dt
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+import numpy as np
+import pandas as pd
+
+import config
+from pcse.exceptions import PCSEError
+from . import instrumentation
+
+# Forecasted weather variables, in the units of the weather data in the database:
+# TMAX/TMIN [C], VAP [hPa], WIND [m/s at 2m], RAIN [cm/day]
+forecast_variables = ("TMAX", "TMIN", "VAP", "WIND", "RAIN")
+
+
+class ForecastStore(object):
+    """Local store of gridded weather forecasts, one directory per issue day.
+
+    :param directory: the directory of the store, defaults to `config.weather.forecast_store_directory`
+    :param keep_issues: the number of issue days kept in the store, defaults to
+        `config.weather.forecast_store_keep_issues`
+    """
+
+    def __init__(self, directory=None, keep_issues=None):
+        self.directory = config.weather.forecast_store_directory if directory is None else directory
+        self.keep_issues = config.weather.forecast_store_keep_issues if keep_issues is None else keep_issues
+        os.makedirs(self.directory, exist_ok=True)
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self._lock = threading.Lock()
+        self._issues = {}
+        self._listing = None
+        self._listing_mtime = None
+
+    def _issue_dir(self, issue_day):
+        return os.path.join(self.directory, issue_day.strftime("%Y%m%d"))
+
+    def issue_days(self):
+        """Returns the sorted list of issue days available in the store."""
+        # The listing only changes when an issue is added or removed, which changes the mtime
+        mtime = os.stat(self.directory).st_mtime
+        with self._lock:
+            if self._listing is not None and mtime == self._listing_mtime:
+                return self._listing
+        days = []
+        for name in os.listdir(self.directory):
+            try:
+                day = dt.datetime.strptime(name, "%Y%m%d").date()
+            except ValueError:
+                continue
+            if os.path.exists(os.path.join(self.directory, name, "meta.json")):
+                days.append(day)
+        days.sort()
+        with self._lock:
+            self._listing, self._listing_mtime = days, mtime
+        return days
+
+    def latest_issue_day(self):
+        """Returns the most recent issue day in the store, None if the store is empty."""
+        days = self.issue_days()
+        return days[-1] if days else None
+
+    def write(self, issue_day, first_day, grid_no, arrays, source=None):
+        """Writes the forecast of an issue day into the store, replacing an existing forecast
+        for that issue day.
+
+        :param issue_day: date object with the issue day of the forecast
+        :param first_day: date object with the first forecasted day
+        :param grid_no: array with the grid numbers
+        :param arrays: dict with a (grid cells x days) array for each forecast variable, NaN
+            where no forecast is available
+        :param source: name of the forecast source
+        """
+        grid_no = np.asarray(grid_no, dtype=np.int64)
+        order = np.argsort(grid_no)
+        ndays = None
+        # Write into a temporary directory first, so that readers never see a partial forecast
+        tmp_dir = tempfile.mkdtemp(dir=self.directory, suffix=".tmp")
+        try:
+            np.save(os.path.join(tmp_dir, "grid_no.npy"), grid_no[order])
+            for name in forecast_variables:
+                values = np.asarray(arrays[name], dtype=np.float64)[order]
+                ndays = values.shape[1]
+                np.save(os.path.join(tmp_dir, name + ".npy"), values)
+            meta = {"issue_day": issue_day.strftime("%Y-%m-%d"),
+                    "first_day": first_day.strftime("%Y-%m-%d"),
+                    "ndays": ndays,
+                    "source": source}
+            with open(os.path.join(tmp_dir, "meta.json"), "w") as fp:
+                json.dump(meta, fp)
+
+            issue_dir = self._issue_dir(issue_day)
+            if os.path.exists(issue_dir):
+                shutil.rmtree(issue_dir)
+            os.rename(tmp_dir, issue_dir)
+        except Exception:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+
+        with self._lock:
+            self._issues.pop(issue_day, None)
+        self.logger.info("Stored forecast issued at %s for %i grid cells and %s days." %
+                         (issue_day, len(grid_no), ndays))
+        self._prune()
+
+    def _prune(self):
+        """Removes the oldest issue days beyond the number of issues to keep."""
+        for issue_day in self.issue_days()[:-self.keep_issues]:
+            shutil.rmtree(self._issue_dir(issue_day), ignore_errors=True)
+            with self._lock:
+                self._issues.pop(issue_day, None)
+
+    def _open(self, issue_day):
+        """Returns the memory-mapped arrays of an issue day, opened once per process and again
+        when the issue day was ingested again."""
+        issue_dir = self._issue_dir(issue_day)
+        meta_fname = os.path.join(issue_dir, "meta.json")
+        try:
+            mtime = os.stat(meta_fname).st_mtime
+        except OSError:
+            msg = "No weather forecast issued at %s available in the forecast store" % issue_day
+            raise PCSEError(msg)
+        with self._lock:
+            issue = self._issues.get(issue_day)
+        if issue is not None and issue["mtime"] == mtime:
+            return issue
+
+        with open(meta_fname) as fp:
+            meta = json.load(fp)
+        issue = {"mtime": mtime,
+                 "first_day": dt.datetime.strptime(meta["first_day"], "%Y-%m-%d").date(),
+                 "grid_no": np.load(os.path.join(issue_dir, "grid_no.npy")),
+                 "arrays": {name: np.load(os.path.join(issue_dir, name + ".npy"), mmap_mode="r")
+                            for name in forecast_variables}}
+        with self._lock:
+            self._issues[issue_day] = issue
+        return issue
+
+    def get_forecast(self, grid_no, issue_day=None):
+        """Returns the forecast for a grid cell.
+
+        :param grid_no: the grid number
+        :param issue_day: the issue day of the forecast, defaults to the most recent issue day
+        :return: a tuple with the issue day and a DataFrame indexed on DAY with a column for each
+            forecast variable
+        """
+        if issue_day is None:
+            issue_day = self.latest_issue_day()
+            if issue_day is None:
+                msg = ("No weather forecast available in the forecast store at %s, ingest the forecast "
+                       "with 'python -m phenology.forecast_sources' first." % self.directory)
+                raise PCSEError(msg)
+
+        with instrumentation.stage("forecast") as s:
+            issue = self._open(issue_day)
+            i = int(np.searchsorted(issue["grid_no"], grid_no))
+            if i >= len(issue["grid_no"]) or issue["grid_no"][i] != grid_no:
+                msg = "No weather forecast issued at %s available for grid %s" % (issue_day, grid_no)
+                raise PCSEError(msg)
+
+            columns = {name: np.array(values[i]) for name, values in issue["arrays"].items()}
+            days = pd.date_range(issue["first_day"], periods=len(columns["TMAX"]), freq="D")
+            forecast = pd.DataFrame(columns, index=pd.Index(days, name="DAY"))
+            s.rows = len(forecast)
+            s.bytes = sum(values.nbytes for values in columns.values())
+        return issue_day, forecast
+
+
+# The forecast store used by this process, created on first use
+_forecast_store = None
+
+
+def get_forecast_store():
+    """Returns the forecast store used by this process.
+    """
+    global _forecast_store
+    if _forecast_store is None:
+        _forecast_store = ForecastStore()
+    return _forecast_store
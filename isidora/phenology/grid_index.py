@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+# Copyright Alterra, Wageningen-UR
+# Allard de Wit (allard.dewit@wur.nl), March 2023
+"""In-memory spatial index on the grid definition for mapping latitude/longitude onto grid cells.
+
+The index replaces the `get_grid` stored procedure in the database. For a regular grid
+(the normal case) the grid cell is found by snapping the latitude/longitude onto the rows
+and columns of the grid. For irregular grids the nearest grid centroid is searched with
+a KD-tree (if scipy is available) or with a brute-force search otherwise.
+"""
+import numpy as np
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+
+class GridIndex(object):
+    """Spatial index on the grid centroids.
+
+    :param grid_no: array of grid numbers
+    :param latitude: array with the latitude of the grid centroids
+    :param longitude: array with the longitude of the grid centroids
+    :param elevation: array with the elevation of the grid cells (NaN when unknown)
+    :param cell_size: the size of the grid cells in decimal degrees
+    """
+    # Tolerance relative to the cell size for deciding that a centroid lies on a regular grid
+    regular_tolerance = 0.01
+
+    def __init__(self, grid_no, latitude, longitude, elevation, cell_size):
+        self.grid_no = np.asarray(grid_no, dtype=np.int64)
+        self.latitude = np.asarray(latitude, dtype=np.float64)
+        self.longitude = np.asarray(longitude, dtype=np.float64)
+        self.elevation = np.asarray(elevation, dtype=np.float64)
+        self.cell_size = float(cell_size)
+
+        if len(self.grid_no) == 0:
+            raise RuntimeError("Cannot build a grid index from an empty grid definition.")
+
+        self.lat0 = self.latitude.min()
+        self.lon0 = self.longitude.min()
+        self.is_regular = self._build_regular_index()
+        if not self.is_regular:
+            self._build_nearest_index()
+
+    def __len__(self):
+        return len(self.grid_no)
+
+    def _to_rows_cols(self, latitude, longitude):
+        """Snaps latitude/longitude onto the rows and columns of a regular grid.
+        """
+        rows = np.floor((latitude - self.lat0)/self.cell_size + 0.5).astype(np.int64)
+        cols = np.floor((longitude - self.lon0)/self.cell_size + 0.5).astype(np.int64)
+        return rows, cols
+
+    def _build_regular_index(self):
+        """Builds a 2D array with the position of each grid cell in the grid definition.
+
+        :return: False if the grid centroids do not lie on a regular grid.
+        """
+        rows, cols = self._to_rows_cols(self.latitude, self.longitude)
+        tolerance = self.regular_tolerance * self.cell_size
+        if np.any(np.abs(self.lat0 + rows * self.cell_size - self.latitude) > tolerance) or \
+                np.any(np.abs(self.lon0 + cols * self.cell_size - self.longitude) > tolerance):
+            return False
+
+        positions = np.full((rows.max() + 1, cols.max() + 1), -1, dtype=np.int64)
+        positions[rows, cols] = np.arange(len(self.grid_no))
+        self._positions = positions
+        return True
+
+    def _build_nearest_index(self):
+        """Builds the index for searching the nearest grid centroid on irregular grids.
+        """
+        self._points = np.column_stack([self.latitude, self.longitude])
+        self._tree = None if cKDTree is None else cKDTree(self._points)
+
+    def _find_positions(self, latitude, longitude):
+        """Returns the position of the grid cells in the grid definition, -1 if not found.
+        """
+        if self.is_regular:
+            rows, cols = self._to_rows_cols(latitude, longitude)
+            nrows, ncols = self._positions.shape
+            inside = (rows >= 0) & (rows < nrows) & (cols >= 0) & (cols < ncols)
+            positions = np.full(latitude.shape, -1, dtype=np.int64)
+            positions[inside] = self._positions[rows[inside], cols[inside]]
+            return positions
+
+        points = np.column_stack([latitude, longitude])
+        if self._tree is not None:
+            distance, positions = self._tree.query(points)
+        else:
+            positions = np.empty(len(points), dtype=np.int64)
+            distance = np.empty(len(points), dtype=np.float64)
+            for i, point in enumerate(points):
+                d = np.hypot(*(self._points - point).T)
+                positions[i] = np.argmin(d)
+                distance[i] = d[positions[i]]
+        positions = np.asarray(positions, dtype=np.int64)
+        positions[distance > self.cell_size] = -1
+        return positions
+
+    def lookup_many(self, latitudes, longitudes):
+        """Finds the grid cells for many locations at once.
+
+        :param latitudes: sequence of latitudes
+        :param longitudes: sequence of longitudes
+        :return: a tuple of arrays (grid_no, elevation), grid_no is -1 and elevation is NaN
+            for locations outside the grid.
+        """
+        latitudes = np.atleast_1d(np.asarray(latitudes, dtype=np.float64))
+        longitudes = np.atleast_1d(np.asarray(longitudes, dtype=np.float64))
+        positions = self._find_positions(latitudes, longitudes)
+        found = positions >= 0
+        grid_no = np.full(positions.shape, -1, dtype=np.int64)
+        grid_no[found] = self.grid_no[positions[found]]
+        elevation = np.full(positions.shape, np.nan, dtype=np.float64)
+        elevation[found] = self.elevation[positions[found]]
+        return grid_no, elevation
+
+    def lookup(self, latitude, longitude):
+        """Finds the grid cell for given latitude/longitude.
+
+        :param latitude: Latitude of location
+        :param longitude: Longitude of location
+        :return: a tuple of (grid_no, elevation), elevation is None when unknown.
+        """
+        grid_no, elevation = self.lookup_many([latitude], [longitude])
+        if grid_no[0] < 0:
+            raise KeyError("no grid cell found")
+        elevation = None if np.isnan(elevation[0]) else float(elevation[0])
+        return int(grid_no[0]), elevation
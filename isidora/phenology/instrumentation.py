@@ -0,0 +1,350 @@
+# -*- coding: utf-8 -*-
+# Copyright Alterra, Wageningen-UR
+# Allard de Wit (allard.dewit@wur.nl), March 2023
+"""Timing of the stages of the simulation requests.
+
+The runners are decorated with `timed_request` and the data providers time their stages
+with `stage()`, counting the rows and bytes they retrieve where relevant::
+
+    with instrumentation.stage("management_alerts") as s:
+        alerts = ...
+        s.rows = len(alerts)
+
+The durations, rows and bytes of the stages are aggregated per process by the `MetricsRegistry`
+into histograms and counters, which are exposed in Prometheus text format: written to
+`config.simulator.metrics_file` and/or served by `start_metrics_server()`. A fraction
+`config.simulator.timing_sample_rate` of the requests is sampled, the runner then adds the
+breakdown of the request into stages to its results under the key "timings".
+
+Stages include the time of the stages nested within them, e.g. "weather" includes "grid_weather"
+and "forecast", so the durations of the stages of a request do not add up to its duration.
+"""
+from bisect import bisect_left
+import functools
+import http.server
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# The timings of the request handled by the current thread
+_local = threading.local()
+
+
+class Histogram(object):
+    """Histogram with fixed upper bounds of the buckets, like a Prometheus histogram.
+
+    :param buckets: the upper bounds of the buckets, a bucket for +Inf is added
+    """
+
+    def __init__(self, buckets):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self):
+        """Returns a list of (upper bound, cumulative count) including the bucket for +Inf."""
+        result, total = [], 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+class MetricsRegistry(object):
+    """Aggregates the durations of requests and stages of this process.
+
+    :param buckets: upper bounds (seconds) of the buckets of the histograms, defaults to
+        `config.simulator.latency_buckets`
+    """
+
+    def __init__(self, buckets=None):
+        self.buckets = config.simulator.latency_buckets if buckets is None else buckets
+        self._lock = threading.Lock()
+        self._request_durations = {}
+        self._request_errors = {}
+        self._stage_durations = {}
+        self._stage_errors = {}
+        self._stage_rows = {}
+        self._stage_bytes = {}
+        self._written_at = None
+
+    def _histogram(self, histograms, name):
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms[name] = Histogram(self.buckets)
+        return histogram
+
+    def observe_request(self, runner, seconds, failed=False):
+        """Records the duration of a request handled by a runner."""
+        with self._lock:
+            self._histogram(self._request_durations, runner).observe(seconds)
+            if failed:
+                self._request_errors[runner] = self._request_errors.get(runner, 0) + 1
+
+    def observe_stage(self, name, seconds, rows=None, nbytes=None, failed=False):
+        """Records the duration and the number of rows and bytes retrieved of a stage."""
+        with self._lock:
+            self._histogram(self._stage_durations, name).observe(seconds)
+            if failed:
+                self._stage_errors[name] = self._stage_errors.get(name, 0) + 1
+            if rows is not None:
+                self._stage_rows[name] = self._stage_rows.get(name, 0) + rows
+            if nbytes is not None:
+                self._stage_bytes[name] = self._stage_bytes.get(name, 0) + nbytes
+
+    def prometheus_text(self):
+        """Returns the metrics in the Prometheus text exposition format."""
+        lines = []
+
+        def histograms(metric, label, values, help_text):
+            lines.append("# HELP %s %s" % (metric, help_text))
+            lines.append("# TYPE %s histogram" % metric)
+            for name, histogram in sorted(values.items()):
+                for bound, count in histogram.cumulative_counts():
+                    lines.append('%s_bucket{%s="%s",le="%s"} %i' % (metric, label, _escape(name),
+                                                                   _format_value(bound), count))
+                lines.append('%s_sum{%s="%s"} %s' % (metric, label, _escape(name), _format_value(histogram.sum)))
+                lines.append('%s_count{%s="%s"} %i' % (metric, label, _escape(name), histogram.count))
+
+        def counters(metric, label, values, help_text):
+            lines.append("# HELP %s %s" % (metric, help_text))
+            lines.append("# TYPE %s counter" % metric)
+            for name, value in sorted(values.items()):
+                lines.append('%s{%s="%s"} %i' % (metric, label, _escape(name), value))
+
+        with self._lock:
+            histograms("isidora_request_duration_seconds", "runner", self._request_durations,
+                       "Duration of the requests per runner.")
+            counters("isidora_request_errors_total", "runner", self._request_errors,
+                     "Requests that raised an exception per runner.")
+            histograms("isidora_stage_duration_seconds", "stage", self._stage_durations,
+                       "Duration of the stages of the requests.")
+            counters("isidora_stage_errors_total", "stage", self._stage_errors,
+                     "Stages that raised an exception.")
+            counters("isidora_stage_rows_total", "stage", self._stage_rows,
+                     "Rows retrieved or produced by the stages.")
+            counters("isidora_stage_bytes_total", "stage", self._stage_bytes,
+                     "Bytes retrieved or produced by the stages.")
+        return "\n".join(lines) + "\n"
+
+    def write(self, fname):
+        """Writes the metrics in Prometheus text format to fname, e.g. for the textfile collector
+        of the Prometheus node exporter. The file is replaced atomically.
+        """
+        directory = os.path.dirname(os.path.abspath(fname))
+        fd, tmp_fname = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as fp:
+                fp.write(self.prometheus_text())
+            os.replace(tmp_fname, fname)
+        except Exception:
+            os.remove(tmp_fname)
+            raise
+
+    def write_if_due(self):
+        """Writes the metrics to `config.simulator.metrics_file` once every
+        `config.simulator.metrics_write_interval` seconds. "{pid}" in the file name is replaced
+        by the process id, so that every (uWSGI) worker writes its own file.
+        """
+        fname = config.simulator.metrics_file
+        if fname is None:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if self._written_at is not None and \
+                    (now - self._written_at) < config.simulator.metrics_write_interval:
+                return
+            self._written_at = now
+        self.write(fname.format(pid=os.getpid()))
+
+
+class RequestTimings(object):
+    """The durations of the stages of a request, aggregated per stage.
+
+    :param runner: the name of the runner handling the request
+    :param sampled: True if the timings are added to the results of the runner
+    """
+
+    def __init__(self, runner, sampled=False):
+        self.runner = runner
+        self.sampled = sampled
+        self.stages = {}
+        self._started = time.perf_counter()
+
+    def add(self, name, seconds, rows=None, nbytes=None):
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = {"seconds": 0., "calls": 0, "rows": None, "bytes": None}
+        stage["seconds"] += seconds
+        stage["calls"] += 1
+        if rows is not None:
+            stage["rows"] = (stage["rows"] or 0) + rows
+        if nbytes is not None:
+            stage["bytes"] = (stage["bytes"] or 0) + nbytes
+
+    @property
+    def seconds(self):
+        """The duration of the request until now."""
+        return time.perf_counter() - self._started
+
+    def as_dict(self):
+        """Returns the timings as a dict that can be serialized into JSON."""
+        stages = []
+        for name, stage in self.stages.items():
+            d = {"stage": name, "seconds": round(stage["seconds"], 6), "calls": stage["calls"]}
+            if stage["rows"] is not None:
+                d["rows"] = stage["rows"]
+            if stage["bytes"] is not None:
+                d["bytes"] = stage["bytes"]
+            stages.append(d)
+        return {"runner": self.runner, "seconds": round(self.seconds, 6), "stages": stages}
+
+    def attach(self, results):
+        """Adds the timings to the results of a runner under the key "timings" when the request
+        is sampled. Timings are added to dict results or, for runners returning a tuple
+        (`notebook_runner`), to its first item.
+        """
+        if not self.sampled:
+            return
+        if isinstance(results, tuple) and results:
+            results = results[0]
+        if isinstance(results, dict):
+            results["timings"] = self.as_dict()
+
+
+class Stage(object):
+    """Context manager timing a stage of the current request, see `stage()`.
+
+    :ivar rows: number of rows retrieved or produced by the stage, set by the caller
+    :ivar bytes: number of bytes retrieved or produced by the stage, set by the caller
+    """
+    __slots__ = ("name", "rows", "bytes", "_started")
+
+    def __init__(self, name):
+        self.name = name
+        self.rows = None
+        self.bytes = None
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = time.perf_counter() - self._started
+        try:
+            get_metrics_registry().observe_stage(self.name, seconds, self.rows, self.bytes, exc_type is not None)
+            timings = getattr(_local, "timings", None)
+            if timings is not None:
+                timings.add(self.name, seconds, self.rows, self.bytes)
+        except Exception:
+            logger.exception("Failed to record the metrics of stage %s" % self.name)
+        return False
+
+
+def stage(name):
+    """Returns a context manager timing the stage `name` of the current request. Stages outside
+    a request are only aggregated in the metrics of the process.
+
+    :param name: the name of the stage, e.g. "grid_weather"
+    """
+    return Stage(name)
+
+
+def current_timings():
+    """Returns the RequestTimings of the request handled by the current thread, or None."""
+    return getattr(_local, "timings", None)
+
+
+def timed_request(runner):
+    """Decorator for runners which records the duration of the request and its stages and adds
+    the timings to the results of sampled requests, see `RequestTimings.attach()`.
+
+    Runners called by another runner are part of the request of the calling runner.
+    """
+    @functools.wraps(runner)
+    def wrapper(*args, **kwargs):
+        if getattr(_local, "timings", None) is not None:
+            return runner(*args, **kwargs)
+
+        sampled = random.random() < config.simulator.timing_sample_rate
+        timings = _local.timings = RequestTimings(runner.__name__, sampled)
+        failed = True
+        try:
+            results = runner(*args, **kwargs)
+            failed = False
+        finally:
+            _local.timings = None
+            # Failures of the instrumentation are logged, they never change the outcome of the request
+            try:
+                registry = get_metrics_registry()
+                registry.observe_request(timings.runner, timings.seconds, failed)
+                registry.write_if_due()
+            except Exception:
+                logger.exception("Failed to record the metrics of a request to %s" % timings.runner)
+        timings.attach(results)
+        return results
+
+    return wrapper
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body = get_metrics_registry().prometheus_text().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port, address="127.0.0.1"):
+    """Serves the metrics of this process in Prometheus text format from a background thread.
+
+    :param port: the port of the HTTP server
+    :param address: the address to listen on, defaults to localhost only
+    :return: the HTTPServer, call its shutdown() method to stop it
+    """
+    server = http.server.ThreadingHTTPServer((address, port), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True)
+    thread.start()
+    return server
+
+
+# The metrics registry of this process, created on first use
+_metrics_registry = None
+
+
+def get_metrics_registry():
+    """Returns the metrics registry of this process.
+    """
+    global _metrics_registry
+    if _metrics_registry is None:
+        _metrics_registry = MetricsRegistry()
+    return _metrics_registry
@@ -10,6 +10,7 @@ from pcse.traitlets import AfgenTrait, Instance, List
 from .phenology_simulator import GenericBBCHPhenology
 from .management_alerts_simulator import ManagementRules
 from .weather_alerts_simulator import WeatherAlerts
+from .records import AlertMessage
 from . import signals
 
    
@@ -46,6 +47,14 @@ class MainSimulator(SimulationObject):
         self.phenology = GenericBBCHPhenology(day, kiosk, parameters)
         self.management = ManagementRules(day, kiosk, parameters)
         self.weatheralert = WeatherAlerts(day, kiosk, parameters)
+
+        # Continue from the state of an earlier simulation, see `checkpoints`
+        if "SNAPSHOT" in parameters:
+            self.restore_snapshot(parameters["SNAPSHOT"])
+
+        # Count calls and time of the simulation objects, see `profiling`
+        if "PROFILER" in parameters:
+            parameters["PROFILER"].attach(self)
         
     def calc_rates(self, day, drv):
         """Calculate the rates of change given the current states and driving
@@ -68,35 +77,59 @@ class MainSimulator(SimulationObject):
         self.management.integrate(day, delt)
         self.weatheralert.integrate(day, delt)
     
+    def get_snapshot(self):
+        """Returns the state of the simulation as a dict, which can be passed as crop parameter
+        SNAPSHOT for continuing the simulation from that state.
+        """
+        return {"phenology": self.phenology.get_snapshot(),
+                "management": self.management.get_snapshot(),
+                "weatheralert": self.weatheralert.get_snapshot(),
+                "WEATHER_MESSAGES": list(self.states.WEATHER_MESSAGES),
+                "MANAGEMENT_MESSAGES": list(self.states.MANAGEMENT_MESSAGES)}
+
+    def restore_snapshot(self, snapshot):
+        """Restores the state of the simulation from a snapshot taken with `get_snapshot()`.
+
+        :param snapshot: dict with the state of the simulation
+        """
+        self.phenology.restore_snapshot(snapshot["phenology"])
+        self.management.restore_snapshot(snapshot["management"])
+        self.weatheralert.restore_snapshot(snapshot["weatheralert"])
+
+        self.states.unlock()
+        self.states.WEATHER_MESSAGES = list(snapshot["WEATHER_MESSAGES"])
+        self.states.MANAGEMENT_MESSAGES = list(snapshot["MANAGEMENT_MESSAGES"])
+        self.states.lock()
+
     # Weather alerts
     def _on_TMAX_STRESS(self, day=None, signal=None, crop_no=None,
                         variety_no=None, message_no=None,
                         mday=None, message=None):
-        self.states.WEATHER_MESSAGES.append(day.strftime('{"day":"%Y-%m-%d",') + '"msg_id":'+'"'+str(message_no)+'",' + '"msg":' + '"'+message+'"}')
+        self.states.WEATHER_MESSAGES.append(AlertMessage(day, message_no, message))
             
     def _on_RAIN_STRESS(self, day=None, signal=None, crop_no=None,
                         variety_no=None, message_no=None,
                         mday=None, message=None):
-        self.states.WEATHER_MESSAGES.append(day.strftime('{"day":"%Y-%m-%d",') + '"msg_id":'+'"'+str(message_no)+'",' + '"msg":' + '"'+message+'"}')
+        self.states.WEATHER_MESSAGES.append(AlertMessage(day, message_no, message))
         
     def _on_RH_STRESS(self, day=None, signal=None, crop_no=None,
                         variety_no=None, message_no=None,
                         mday=None, message=None):
-        self.states.WEATHER_MESSAGES.append(day.strftime('{"day":"%Y-%m-%d",') + '"msg_id":'+'"'+str(message_no)+'",' + '"msg":' + '"'+message+'"}')
+        self.states.WEATHER_MESSAGES.append(AlertMessage(day, message_no, message))
     
     def _on_TMIN_STRESS(self, day=None, signal=None, crop_no=None,
                         variety_no=None, message_no=None,
                         mday=None, message=None):
-        self.states.WEATHER_MESSAGES.append(day.strftime('{"day":"%Y-%m-%d",') + '"msg_id":'+'"'+str(message_no)+'",' + '"msg":' + '"'+message+'"}')
+        self.states.WEATHER_MESSAGES.append(AlertMessage(day, message_no, message))
         
     def _on_FOG_STRESS(self, day=None, signal=None, crop_no=None,
                         variety_no=None, message_no=None,
                         mday=None, message=None):
-        self.states.WEATHER_MESSAGES.append(day.strftime('{"day":"%Y-%m-%d",') + '"msg_id":'+'"'+str(message_no)+'",' + '"msg":' + '"'+message+'"}')
+        self.states.WEATHER_MESSAGES.append(AlertMessage(day, message_no, message))
     
     # Management alerts
     def _on_MANAGEMENT_EVENT(self, day=None, signal=None, crop_no=None, 
                                       variety_no=None, message_no=None, 
                                       mday=None, message=None):
-        # Send management message to JSON output
-        self.states.MANAGEMENT_MESSAGES.append(mday.strftime('{"day":"%Y-%m-%d",') + '"msg_id":'+'"'+str(message_no)+'",' + '"msg":' + '"'+message+'"}')
+        # Send management message to output
+        self.states.MANAGEMENT_MESSAGES.append(AlertMessage(mday, message_no, message))
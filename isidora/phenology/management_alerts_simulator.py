@@ -11,12 +11,18 @@ from pcse.traitlets import Instance
 from pcse.base_classes import SimulationObject, ParamTemplate
 from pcse.decorators import prepare_rates, prepare_states
 from . import signals
+from .crop_template import get_crop_template
 
 
 # Generic Management advisories
 class ManagementRules(SimulationObject):
-    """defines management alerts simulation object"""
-    processed_message_ids = []
+    """defines management alerts simulation object
+
+    The management rules are indexed on BBCH code in the crop template and only evaluated when
+    the phenology signals that the crop enters the next BBCH stage. The initial BBCH stage is
+    evaluated on the first day of the simulation.
+    """
+    processed_message_ids = Instance(set)
     
     class Parameters(ParamTemplate):
         """Extra parameters needed in management model class"""
@@ -31,8 +37,12 @@ class ManagementRules(SimulationObject):
         :param parameters: dict including alert parameter values (from `dataproviders.get_management_alerts`)
            under the dictionary key 'MANAGEMENT_ALERTS'
         """
-        self.processed_message_ids = []     
+        self.processed_message_ids = set()
         self.params = self.Parameters(parameters)
+        self._rules = get_crop_template(parameters).management_rules
+        # The initial stage is evaluated at the first integration, unless a new stage is entered
+        self._initial_stage_pending = True
+        self._connect_signal(self._on_BBCH_STAGE_CHANGE, signal=signals.BBCH_STAGE_CHANGE)
     
     @prepare_rates
     def calc_rates(self, day, drv):
@@ -52,20 +62,46 @@ class ManagementRules(SimulationObject):
         :param day: current day of pcse simulation
         :param delt: integer for calculating every delt days; in this case 1
         """
-        
-        # Read list management alerts from database
-        for rule in self.params.MANAGEMENT_ALERTS:
-            if rule.BBCH_code == self.kiosk["BBCH_CURRENT_STAGE"]:
-                # Check if management message has not been sent before
-                if rule.message_no not in self.processed_message_ids:
-                    self.processed_message_ids.append(rule.message_no)
-                    # Day_of_message_sending = day - datetime.timedelta(days = rule.offset_days)
-                    day_of_message_sending = day + datetime.timedelta(days = rule.offset_days)
-                    # Send message
-                    self._send_signal(day=day,
-                                      signal=signals.MANAGEMENT_EVENT, 
-                                      crop_no=rule.crop_no, 
-                                      variety_no=rule.variety_no, 
-                                      message_no=rule.message_no, 
-                                      mday=day_of_message_sending, 
-                                      message=rule.management_msg)
\ No newline at end of file
+        if self._initial_stage_pending:
+            self._initial_stage_pending = False
+            self._evaluate_stage(day, self.kiosk["BBCH_CURRENT_STAGE"])
+
+    def _on_BBCH_STAGE_CHANGE(self, day=None, stage=None):
+        # The phenology is integrated before the management rules on the same day
+        self._initial_stage_pending = False
+        self._evaluate_stage(day, stage)
+
+    def _evaluate_stage(self, day, stage):
+        """Sends the management messages of the rules for the BBCH stage that have not been sent before.
+
+        :param day: the day at which the stage is entered
+        :param stage: the BBCH code of the stage
+        """
+        for rule in self._rules.get(stage, ()):
+            # Check if management message has not been sent before
+            if rule.message_no not in self.processed_message_ids:
+                self.processed_message_ids.add(rule.message_no)
+                day_of_message_sending = day + datetime.timedelta(days = rule.offset_days)
+                # Send message
+                self._send_signal(day=day,
+                                  signal=signals.MANAGEMENT_EVENT, 
+                                  crop_no=rule.crop_no, 
+                                  variety_no=rule.variety_no, 
+                                  message_no=rule.message_no, 
+                                  mday=day_of_message_sending, 
+                                  message=rule.management_msg)
+
+    def get_snapshot(self):
+        """Returns the state of the management rules as a dict, see `restore_snapshot()`.
+        """
+        return {"processed_message_ids": list(self.processed_message_ids)}
+
+    def restore_snapshot(self, snapshot):
+        """Restores the management messages that have been sent from a snapshot taken with
+        `get_snapshot()`.
+
+        :param snapshot: dict with the state of the management rules
+        """
+        self.processed_message_ids = set(snapshot["processed_message_ids"])
+        # The rules of the current stage have been evaluated before the snapshot was taken
+        self._initial_stage_pending = False
@@ -13,6 +13,10 @@ from pcse.decorators import prepare_rates, prepare_states
 from pcse import signals
 from pcse.util import daylength, limit
 
+from .crop_template import get_crop_template
+from .records import BBCHRecord
+from .signals import BBCH_STAGE_CHANGE
+
 
 class GenericBBCHPhenology(SimulationObject):
     """defines geobis phenology simulation object"""
@@ -54,37 +58,22 @@ class GenericBBCHPhenology(SimulationObject):
         :param kiosk: variable kiosk of this PCSE instance
         :param parametervalues: dict with crop parameter values
         """
-        
-        BBCH_CODES = []
-        BBCH_TSUMS = []
-        
-        # Looping over parameter values
-        for name, value in parametervalues.items():
-            if name.startswith("BBCH"):
-                BBCH_CODES.append(name)
-                BBCH_TSUMS.append(value)
-       
-        parametervalues.set_override("BBCH_CODES", BBCH_CODES, check=False)
-        parametervalues.set_override("BBCH_TSUMS", BBCH_TSUMS, check=False)
-        
+
+        # The BBCH stages and the temperature function are compiled once in the crop template
+        template = get_crop_template(parametervalues)
+        parametervalues.set_override("BBCH_CODES", template.bbch_codes, check=False)
+        parametervalues.set_override("BBCH_TSUMS", template.bbch_tsums, check=False)
+
         self.params = self.Parameters(parametervalues)
         self.rates = self.RateVariables(kiosk)
+        self._PHENO_TF = list(template.temperature_function)
 
-        # Generate temperature function from cardinal temperatures
-        p = self.params
-        Tfunc = [p.PHENO_TBASE,0.,
-                 p.PHENO_TOPT1, (p.PHENO_TOPT1 - p.PHENO_TBASE),
-                 p.PHENO_TOPT2, (p.PHENO_TOPT1 - p.PHENO_TBASE),
-                 p.PHENO_TMAX, 0.]
-        self._PHENO_TF = Tfunc
-
-        bbch_current_stage = self.params.BBCH_CODES.pop(0)
-        # Pop list twice for correct length!!
-        bbch_current_tsum = self.params.BBCH_TSUMS.pop(0)
-        bbch_current_tsum = self.params.BBCH_TSUMS.pop(0)
-
-        bbch_dates = ['{"day":"%s","bbch":"%s","t_sum":%s}' % \
-                      (day.strftime('%Y-%m-%d'), bbch_current_stage, 0.)]
+        # Index of the current BBCH stage, the target is the temperature sum of the next stage
+        self._stage = 0
+        bbch_current_stage = self.params.BBCH_CODES[0]
+        bbch_current_tsum = self.params.BBCH_TSUMS[1]
+
+        bbch_dates = [BBCHRecord(day, bbch_current_stage, 0.)]
         self.states = self.StateVariables(kiosk, DVS=0., BBCH_DATES=bbch_dates,
                                           BBCH_CURRENT_STAGE=bbch_current_stage,
                                           BBCH_TARGET_TSUM=bbch_current_tsum,
@@ -105,7 +94,10 @@ class GenericBBCHPhenology(SimulationObject):
         # Reduction factor for photoperiod
         r.RF_PHOTO = 1.0
         if p.PHENO_IDSL >= 1:
-            DAYLP = daylength(day, drv.LAT)
+            # Daylength is a derived variable of the weather data provider when available
+            DAYLP = getattr(drv, "DAYLENGTH", None)
+            if DAYLP is None:
+                DAYLP = daylength(day, drv.LAT)
             r.RF_PHOTO = limit(0., 1., (DAYLP - p.PHENO_DLC) / (p.PHENO_DLO - p.PHENO_DLC))
 
         # Effective temperature from piecewise linear function based on cardinal temperatures
@@ -170,20 +162,46 @@ class GenericBBCHPhenology(SimulationObject):
         self.states.DVS += self.rates.DVR * delt
         
         if self.states.DVS >= self.states.BBCH_TARGET_TSUM:
-            if self.params.BBCH_TSUMS:
-                self.states.BBCH_CURRENT_STAGE = self.params.BBCH_CODES.pop(0)
-                self.states.BBCH_TARGET_TSUM = self.params.BBCH_TSUMS.pop(0)
+            self._stage += 1
+            self.states.BBCH_CURRENT_STAGE = self.params.BBCH_CODES[self._stage]
+            self._send_signal(signal=BBCH_STAGE_CHANGE, day=day, stage=self.states.BBCH_CURRENT_STAGE)
+            if self._stage + 1 < len(self.params.BBCH_TSUMS):
+                self.states.BBCH_TARGET_TSUM = self.params.BBCH_TSUMS[self._stage + 1]
             else:
-                self.states.BBCH_CURRENT_STAGE = self.params.BBCH_CODES.pop(0)
                 self._send_signal(signal=signals.crop_finish, day=day)
                 self._send_signal(signals.terminate)
 
-            self.states.BBCH_DATES.append('{"day":"%s","bbch":"%s","t_sum":%s}' %
-                                          (day.strftime('%Y-%m-%d'),self.states.BBCH_CURRENT_STAGE,
-                                           str(round(self.states.DVS,1))))        
+            self.states.BBCH_DATES.append(BBCHRecord(day, self.states.BBCH_CURRENT_STAGE,
+                                                     round(self.states.DVS, 1)))
         # Update all state variables of this and any sub-SimulationObjects
         self.touch()      
                                       
+    def get_snapshot(self):
+        """Returns the state of the phenology as a dict, which can be restored with `restore_snapshot()`.
+        """
+        s = self.states
+        return {"DVS": s.DVS,
+                "BBCH_CURRENT_STAGE": s.BBCH_CURRENT_STAGE,
+                "BBCH_TARGET_TSUM": s.BBCH_TARGET_TSUM,
+                "BBCH_DATES": list(s.BBCH_DATES),
+                "BBCH_CODES": list(self.params.BBCH_CODES[self._stage + 1:]),
+                "BBCH_TSUMS": list(self.params.BBCH_TSUMS[self._stage + 2:])}
+
+    def restore_snapshot(self, snapshot):
+        """Restores the state of the phenology from a snapshot taken with `get_snapshot()`.
+
+        :param snapshot: dict with the state of the phenology
+        """
+        # The snapshot holds the BBCH stages after the current stage
+        self._stage = len(self.params.BBCH_CODES) - 1 - len(snapshot["BBCH_CODES"])
+
+        self.states.unlock()
+        self.states.DVS = snapshot["DVS"]
+        self.states.BBCH_CURRENT_STAGE = snapshot["BBCH_CURRENT_STAGE"]
+        self.states.BBCH_TARGET_TSUM = snapshot["BBCH_TARGET_TSUM"]
+        self.states.BBCH_DATES = list(snapshot["BBCH_DATES"])
+        self.states.lock()
+
     @prepare_states
     def finalize(self, day):
         """do some final calculations when the simulation is finishing.
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+# Copyright Alterra, Wageningen-UR
+# Allard de Wit (allard.dewit@wur.nl), March 2023
+"""Profiling of the simulation objects in the daily loop of the PCSE Engine.
+
+A `SimulationProfiler` is passed to a run as crop parameter PROFILER, e.g. through the profiler
+argument of `runners.GPRE_service_runner`. `MainSimulator` then attaches the profiler, which wraps
+`calc_rates`, `integrate` and the signal handlers of every simulation object in the run with
+counters of the number of calls and the cumulative and maximum time. Runs without profiler are
+not affected.
+
+After the run, `SimulationProfiler.report()` gives a table per component (e.g.
+"GenericBBCHPhenology.calc_rates") and `SimulationProfiler.collapsed_stacks()` gives the exclusive
+time per call stack in the collapsed format of flamegraph.pl and speedscope::
+
+    MainSimulator.integrate;WeatherAlerts.integrate;RainStressThreshold.integrate 1830
+
+The profiler can also be run from the isidora directory for a single location::
+
+    python -m phenology.profiling 20.5 96.1 2023-06-01 1 --collapsed run.folded
+"""
+import argparse
+import datetime as dt
+import time
+
+from pcse.base_classes import SimulationObject
+from pcse.pydispatch import dispatcher, robustapply
+
+
+class _CallStats(object):
+    __slots__ = ("calls", "total", "exclusive", "max")
+
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.
+        self.exclusive = 0.
+        self.max = 0.
+
+
+class SimulationProfiler(object):
+    """Counts the calls and the time spent in the simulation objects of a run.
+
+    Times are measured per call stack, frames are named after the class of the simulation object
+    and the method, e.g. "WeatherAlerts.integrate". The signal handlers called while sending a
+    signal appear as frames below the method sending the signal.
+    """
+
+    def __init__(self):
+        self._stats = {}
+        self._stack = []
+
+    def _profiled(self, frame, func):
+        """Returns a function calling func which records its time under frame."""
+        stats = self._stats
+        stack = self._stack
+        perf_counter = time.perf_counter
+
+        def profiled(*args, **kwargs):
+            parent = stack[-1] if stack else None
+            # The entry on the stack holds the path of the frame and the time of its children
+            entry = [frame if parent is None else parent[0] + ";" + frame, 0.]
+            stack.append(entry)
+            started = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = perf_counter() - started
+                stack.pop()
+                if parent is not None:
+                    parent[1] += elapsed
+                s = stats.get(entry[0])
+                if s is None:
+                    s = stats[entry[0]] = _CallStats()
+                s.calls += 1
+                s.total += elapsed
+                s.exclusive += elapsed - entry[1]
+                if elapsed > s.max:
+                    s.max = elapsed
+
+        return profiled
+
+    def attach(self, simobj):
+        """Wraps calc_rates, integrate and the signal handlers of simobj and of all simulation
+        objects below it.
+
+        :param simobj: the top-level SimulationObject of the run, e.g. MainSimulator
+        """
+        simobjs = _simulation_objects(simobj)
+        for obj in simobjs:
+            name = obj.__class__.__name__
+            for method in ("calc_rates", "integrate"):
+                setattr(obj, method, self._profiled("%s.%s" % (name, method), getattr(obj, method)))
+
+        # Signal handlers are reconnected in their original order, the wrappers are kept alive by
+        # the simulation objects because the dispatcher only holds weak references.
+        kiosk = simobj.kiosk
+        ids = {id(obj) for obj in simobjs}
+        for signal in list(dispatcher.connections.get(id(kiosk), {})):
+            receivers = list(dispatcher.liveReceivers(dispatcher.getReceivers(kiosk, signal)))
+            if not any(id(getattr(r, "__self__", None)) in ids for r in receivers):
+                continue
+            for receiver in receivers:
+                dispatcher.disconnect(receiver, signal, sender=kiosk)
+            for receiver in receivers:
+                obj = getattr(receiver, "__self__", None)
+                if id(obj) in ids:
+                    handler = self._profiled("%s.%s" % (obj.__class__.__name__, receiver.__name__),
+                                             _handler_caller(receiver))
+                    obj._profiled_handlers = getattr(obj, "_profiled_handlers", []) + [handler]
+                    receiver = handler
+                dispatcher.connect(receiver, signal, sender=kiosk)
+
+    def stats(self):
+        """Returns a list of dicts with the calls, the total, exclusive and maximum time (seconds)
+        per component, summed over the call stacks of the component and sorted on total time.
+        """
+        components = {}
+        for path, s in self._stats.items():
+            frames = path.split(";")
+            c = components.get(frames[-1])
+            if c is None:
+                c = components[frames[-1]] = _CallStats()
+            c.calls += s.calls
+            # Time of a component calling itself is only counted at the outermost call
+            if frames[-1] not in frames[:-1]:
+                c.total += s.total
+            c.exclusive += s.exclusive
+            c.max = max(c.max, s.max)
+        return [{"component": name, "calls": c.calls, "total": c.total, "exclusive": c.exclusive, "max": c.max}
+                for name, c in sorted(components.items(), key=lambda item: -item[1].total)]
+
+    def report(self):
+        """Returns the per component statistics as a text table."""
+        lines = ["%-45s %8s %11s %11s %10s %10s" % ("component", "calls", "total [ms]", "self [ms]",
+                                                    "mean [us]", "max [us]")]
+        for s in self.stats():
+            lines.append("%-45s %8i %11.3f %11.3f %10.1f %10.1f" %
+                         (s["component"], s["calls"], s["total"] * 1e3, s["exclusive"] * 1e3,
+                          s["total"] / s["calls"] * 1e6, s["max"] * 1e6))
+        return "\n".join(lines)
+
+    def collapsed_stacks(self):
+        """Returns the exclusive time (microseconds) per call stack in the collapsed stack format
+        used by flame graph tools, one line per stack."""
+        return "".join("%s %i\n" % (path, round(s.exclusive * 1e6)) for path, s in sorted(self._stats.items()))
+
+    def write_collapsed_stacks(self, fname):
+        """Writes the collapsed stacks to fname, see `collapsed_stacks()`."""
+        with open(fname, "w") as fp:
+            fp.write(self.collapsed_stacks())
+
+
+def _handler_caller(handler):
+    # The dispatcher only passes the arguments a handler accepts, the wrapper accepts all of them
+    def call(*args, **named):
+        return robustapply.robustApply(handler, *args, **named)
+    return call
+
+
+def _simulation_objects(simobj):
+    """Returns simobj and all simulation objects below it, including those held in lists such as
+    the weather alerts of `WeatherAlerts`."""
+    found = []
+    seen = set()
+    todo = [simobj]
+    while todo:
+        obj = todo.pop(0)
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        found.append(obj)
+        for value in obj.__dict__["_trait_values"].values():
+            if isinstance(value, SimulationObject):
+                todo.append(value)
+            elif isinstance(value, (list, tuple)):
+                todo.extend(v for v in value if isinstance(v, SimulationObject))
+    return found
+
+
+def main(args=None):
+    from . import runners
+    from . import weather_cache
+    from . import data_access
+    from . import data_providers as dp
+
+    parser = argparse.ArgumentParser(description="Profile the simulation objects of a run for a single location.")
+    parser.add_argument("latitude", type=float)
+    parser.add_argument("longitude", type=float)
+    parser.add_argument("sowing_date", help="Sowing date as YYYY-MM-DD")
+    parser.add_argument("crop_no", type=int)
+    parser.add_argument("--variety-no", type=int, default=-1)
+    parser.add_argument("--season-no", type=int, default=-1)
+    parser.add_argument("--collapsed", help="Write the collapsed stacks to this file")
+    args = parser.parse_args(args)
+
+    sowing_date = dt.datetime.strptime(args.sowing_date, "%Y-%m-%d").date()
+    crop = dp.CropDataProvider(data_access.get_session(), args.crop_no, args.variety_no)
+    wdp = weather_cache.get_weather_provider(args.latitude, args.longitude,
+                                             *dp.simulation_window(sowing_date, crop["MAX_DURATION"]))
+    profiler = SimulationProfiler()
+    runners.GPRE_service_runner(wdp, sowing_date, args.crop_no, args.variety_no, args.season_no,
+                                profiler=profiler)
+    print(profiler.report())
+    if args.collapsed:
+        profiler.write_collapsed_stacks(args.collapsed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+# Copyright Alterra, Wageningen-UR
+# Allard de Wit (allard.dewit@wur.nl), March 2023
+"""Records for the BBCH dates and the alert messages produced by the simulation, and their
+probabilities for runs with an ensemble forecast.
+
+The simulation objects emit these records, the runners convert them into the JSON data
+structure with `as_dict()`. Serialization into JSON text is done once by `dumps()` or in
+chunks by `iterencode()` for streaming the output. The fast `orjson` encoder is used
+when it is available.
+"""
+import datetime as dt
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from . import instrumentation
+
+
+class BBCHRecord(object):
+    """The day at which a BBCH stage is reached.
+
+    :param day: date object
+    :param bbch: the BBCH code, e.g. BBCH_10
+    :param t_sum: the temperature sum at that day
+    """
+    __slots__ = ("day", "bbch", "t_sum")
+
+    def __init__(self, day, bbch, t_sum):
+        self.day = day
+        self.bbch = bbch
+        self.t_sum = t_sum
+
+    def as_dict(self):
+        return {"day": self.day.strftime("%Y-%m-%d"), "bbch": self.bbch, "t_sum": self.t_sum}
+
+    def __eq__(self, other):
+        return isinstance(other, BBCHRecord) and \
+            (self.day, self.bbch, self.t_sum) == (other.day, other.bbch, other.t_sum)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "BBCHRecord(%s, %s, %s)" % (self.day, self.bbch, self.t_sum)
+
+
+class AlertMessage(object):
+    """A weather or management alert message.
+
+    :param day: date object with the day of the message
+    :param msg_id: the message number
+    :param msg: the message text
+    """
+    __slots__ = ("day", "msg_id", "msg")
+
+    def __init__(self, day, msg_id, msg):
+        self.day = day
+        self.msg_id = msg_id
+        self.msg = msg
+
+    def as_dict(self):
+        return {"day": self.day.strftime("%Y-%m-%d"), "msg_id": str(self.msg_id), "msg": self.msg}
+
+    def __eq__(self, other):
+        return isinstance(other, AlertMessage) and \
+            (self.day, self.msg_id, self.msg) == (other.day, other.msg_id, other.msg)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "AlertMessage(%s, %s, %r)" % (self.day, self.msg_id, self.msg)
+
+
+class BBCHProbability(object):
+    """The distribution of the day at which a BBCH stage is reached over the members of an
+    ensemble forecast.
+
+    :param bbch: the BBCH code, e.g. BBCH_10
+    :param day: date object with the median day over the members reaching the stage
+    :param earliest: date object with the earliest day
+    :param latest: date object with the latest day
+    :param probability: the fraction of the members in which the stage is reached
+    """
+    __slots__ = ("bbch", "day", "earliest", "latest", "probability")
+
+    def __init__(self, bbch, day, earliest, latest, probability):
+        self.bbch = bbch
+        self.day = day
+        self.earliest = earliest
+        self.latest = latest
+        self.probability = probability
+
+    def as_dict(self):
+        return {"day": self.day.strftime("%Y-%m-%d"), "bbch": self.bbch,
+                "earliest": self.earliest.strftime("%Y-%m-%d"), "latest": self.latest.strftime("%Y-%m-%d"),
+                "probability": self.probability}
+
+    def __repr__(self):
+        return "BBCHProbability(%s, %s, %s, %s, %s)" % (self.bbch, self.day, self.earliest, self.latest,
+                                                         self.probability)
+
+
+class AlertProbability(object):
+    """A weather or management alert message with the fraction of the members of an ensemble
+    forecast in which it is sent.
+
+    :param day: date object with the day of the message
+    :param msg_id: the message number
+    :param msg: the message text
+    :param probability: the fraction of the members in which the message is sent
+    """
+    __slots__ = ("day", "msg_id", "msg", "probability")
+
+    def __init__(self, day, msg_id, msg, probability):
+        self.day = day
+        self.msg_id = msg_id
+        self.msg = msg
+        self.probability = probability
+
+    def as_dict(self):
+        return {"day": self.day.strftime("%Y-%m-%d"), "msg_id": str(self.msg_id), "msg": self.msg,
+                "probability": self.probability}
+
+    def __repr__(self):
+        return "AlertProbability(%s, %s, %r, %s)" % (self.day, self.msg_id, self.msg, self.probability)
+
+
+def _default(obj):
+    """Converts records and dates for the JSON encoder."""
+    if isinstance(obj, (BBCHRecord, AlertMessage, BBCHProbability, AlertProbability)):
+        return obj.as_dict()
+    if isinstance(obj, dt.date):
+        return obj.strftime("%Y-%m-%d")
+    raise TypeError("Object of type %s is not JSON serializable" % type(obj).__name__)
+
+
+_encoder = json.JSONEncoder(default=_default, separators=(",", ":"), ensure_ascii=False)
+
+
+def dumps(obj):
+    """Serializes obj, which may contain records and dates, into a JSON string.
+    """
+    with instrumentation.stage("json") as s:
+        if orjson is not None:
+            text = orjson.dumps(obj, default=_default, option=orjson.OPT_PASSTHROUGH_DATETIME).decode("utf-8")
+        else:
+            text = _encoder.encode(obj)
+        s.bytes = len(text)
+    return text
+
+
+def iterencode(obj):
+    """Serializes obj, which may contain records and dates, into chunks of JSON text.
+    """
+    return _encoder.iterencode(obj)
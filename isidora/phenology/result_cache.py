@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+# Copyright Alterra, Wageningen-UR
+# Allard de Wit (allard.dewit@wur.nl), March 2023
+"""Cache for the results of `runners.GPRE_service_runner`.
+
+The results of a run are fully determined by the weather data of the grid cell, the sowing
+date, the crop, variety and season and the date of the run (weather alerts are only sent within
+the range of trusted weather data relative to the current day). Results are therefore cached
+under the key (grid_no, sowing_date, crop_no, variety_no, season_no, weather version, run date).
+
+Results are stored as JSON strings in a backend, currently an in-memory LRU backend
+(`MemoryBackend`) and an on-disk backend (`DiskBackend`) which can be shared between processes
+are available. The cache is cleared when a change in the crop tables or a new load of observed
+weather data is detected in the database.
+"""
+from collections import OrderedDict
+import datetime as dt
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import config
+from . import crop_catalog
+from . import data_providers as dp
+from . import records
+from . import instrumentation
+
+
+class MemoryBackend(object):
+    """Least-recently-used in-memory storage of results.
+
+    :param maxsize: the maximum number of results stored
+    """
+
+    def __init__(self, maxsize=None):
+        self.maxsize = config.simulator.result_cache_size if maxsize is None else maxsize
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            value = self._results.get(key)
+            if value is not None:
+                self._results.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._results[key] = value
+            self._results.move_to_end(key)
+            while len(self._results) > self.maxsize:
+                self._results.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+
+    def __len__(self):
+        return len(self._results)
+
+
+class DiskBackend(object):
+    """Storage of results as files in a directory, which can be shared between processes.
+
+    :param directory: the directory for storing the results
+    """
+
+    def __init__(self, directory=None):
+        self.directory = config.simulator.result_cache_directory if directory is None else directory
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, key):
+        name = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, name + ".json")
+
+    def get(self, key):
+        try:
+            with open(self._path(key), "r", encoding="utf-8") as fp:
+                return fp.read()
+        except (IOError, OSError):
+            return None
+
+    def set(self, key, value):
+        # Write to a temporary file first so that other processes never read a partial result
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as fp:
+            fp.write(value)
+        os.replace(tmp_path, self._path(key))
+
+    def clear(self):
+        for fname in os.listdir(self.directory):
+            if fname.endswith(".json"):
+                try:
+                    os.remove(os.path.join(self.directory, fname))
+                except OSError:
+                    pass
+
+    def __len__(self):
+        return len([fname for fname in os.listdir(self.directory) if fname.endswith(".json")])
+
+
+backends = {"memory": MemoryBackend,
+            "disk": DiskBackend}
+
+
+class ResultCache(object):
+    """Cache of runner results with hit-ratio metrics.
+
+    :param backend: the backend for storing results, defaults to the backend defined by
+        `config.simulator.result_cache_backend`
+    :param version_check_interval: the interval (seconds) for checking if the observed weather
+        data have changed, defaults to `config.simulator.result_cache_check_interval`
+    """
+
+    def __init__(self, backend=None, version_check_interval=None):
+        self.backend = backends[config.simulator.result_cache_backend]() if backend is None else backend
+        self.version_check_interval = config.simulator.result_cache_check_interval \
+            if version_check_interval is None else version_check_interval
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self._lock = threading.Lock()
+        self._versions = None
+        self._version_checked_at = None
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def make_key(wdp, sowing_date, crop_no, variety_no, season_no, run_date=None):
+        """Returns the key for the results of a run.
+
+        :param wdp: the weather data provider of the run
+        :param run_date: the date of the run, defaults to today
+        """
+        if run_date is None:
+            run_date = dt.date.today()
+        return (wdp.grid_no, sowing_date, crop_no, variety_no, season_no, dp.weather_data_version(wdp), run_date)
+
+    def get_or_run(self, key, runner, *args, **kwargs):
+        """Returns the cached results for key or calls `runner(*args, **kwargs)` and caches its results.
+        """
+        self._check_versions()
+
+        with instrumentation.stage("result_cache") as s:
+            value = self.backend.get(key)
+            if value is not None:
+                s.bytes = len(value)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if value is not None:
+            return json.loads(value)
+
+        results = runner(*args, **kwargs)
+        self.backend.set(key, records.dumps(results))
+        return results
+
+    def _check_versions(self):
+        """Clears the cache when a change in the crop tables or a new load of observed weather
+        data is found.
+
+        Edits of the crop tables are taken from the crop catalog, see `CropCatalog.version`, so
+        the cache is cleared when the catalog loads the edited crop tables. The database is only
+        checked for new observed weather data once every `self.version_check_interval` seconds.
+        """
+        crop_version = crop_catalog.get_crop_catalog().version
+        now = time.monotonic()
+        with self._lock:
+            weather_version = None if self._versions is None else self._versions[1]
+            check_weather = self._version_checked_at is None or \
+                (now - self._version_checked_at) >= self.version_check_interval
+            if check_weather:
+                self._version_checked_at = now
+
+        if check_weather:
+            connection = dp.connect_weather_db()
+            try:
+                weather_version = dp.fetch_weather_version(connection)
+            finally:
+                connection.close()
+        versions = (crop_version, weather_version)
+        with self._lock:
+            if versions != self._versions:
+                if self._versions is not None:
+                    self.logger.info("Crop tables or observed weather data changed, clearing result cache.")
+                    self.invalidations += 1
+                    self.backend.clear()
+                self._versions = versions
+
+    def clear(self):
+        """Removes all results from the cache.
+        """
+        self.backend.clear()
+
+    @property
+    def hit_ratio(self):
+        """The fraction of requests that were served from the cache."""
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.
+
+    def stats(self):
+        """Returns a dict with the hits, misses, hit ratio and invalidations of the cache.
+        """
+        with self._lock:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "hit_ratio": self.hit_ratio,
+                    "invalidations": self.invalidations,
+                    "size": len(self.backend)}
+
+
+# The cache shared by all requests in this process, created on first use
+_result_cache = None
+
+
+def get_result_cache():
+    """Returns the result cache shared by all requests in this process.
+    """
+    global _result_cache
+    if _result_cache is None:
+        _result_cache = ResultCache()
+    return _result_cache
@@ -2,25 +2,57 @@
 # Copyright Alterra, Wageningen-UR
 # Wouter Meijninger (wouter.meijninger@wur.nl), Jappe Franke (jappe.franke@wur.nl),
 # Allard de Wit (allard.dewit@wur.nl), January 2018
-"""Defines runners that can run the actual crop simulation. Currently two runners are implemented:
+"""Defines runners that can run the actual crop simulation. Currently seven runners are implemented:
 
 - `notebook_runner` which can be imported in Jupyter notebook and is useful for interactive exploratory
   analysis. It returns tje JSON results structure as well as a pandas dataframe with simulation results.
 - `web_runner` which is used to run behind a webserver and returns the JSON structure as understood by
   web browsers.
+- `phenology_runner` which only simulates the crop phenology, by default using the vectorized
+  phenology model which is much faster than the PCSE Engine.
+- `cached_service_runner` which is `GPRE_service_runner` with caching of its results.
+- `incremental_service_runner` which is `GPRE_service_runner` continuing from a checkpoint of the
+  simulation at the last observed day, for plots that are simulated every day.
+- `sowing_window_runner` which simulates phenology, management and weather alerts for a range of
+  sowing dates in one call (or for a list of sowing dates with `sowing_dates_runner`).
+- `ensemble_runner` which simulates phenology, management and weather alerts for all members of
+  an ensemble weather forecast and returns the probabilities of the BBCH dates and alerts.
+
+The runners record the durations of the stages of each request, see `instrumentation`.
 """
-import json
+import datetime as dt
 
-import sqlalchemy as sa
 import pandas as pd
 
 import config
 from . import data_providers as dp
+from . import weather_cache
+from . import data_access
+from . import vectorized_phenology
+from . import vectorized_alerts
+from . import thermal_time
+from . import result_cache
+from . import checkpoints
+from . import instrumentation
 from pcse.engine import Engine
-from pcse.base_classes import ParameterProvider
 
 
-def notebook_runner(latitude=None, longitude=None, sowing_date=None, crop_no=None, variety_no=-1, season_no=-1):
+def _combine_alerts(palerts, walerts, malerts):
+    """Combines the phenology, weather and management records into one JSON data structure.
+
+    Use `records.dumps()` or `records.iterencode()` for serializing it into JSON text.
+    """
+    with instrumentation.stage("results") as s:
+        alerts = {"phenology": [r.as_dict() for r in palerts],
+                  "weatheralerts": [r.as_dict() for r in walerts],
+                  "managementalerts": [r.as_dict() for r in malerts]}
+        s.rows = sum(len(records) for records in alerts.values())
+    return alerts
+
+
+@instrumentation.timed_request
+def notebook_runner(latitude=None, longitude=None, sowing_date=None, crop_no=None, variety_no=-1, season_no=-1,
+                    run_date=None, profiler=None):
     """Make a run for given longitude, latitude, sowing date, crop_no and variety_no.
 
     :param latitude: latitude of the site
@@ -30,30 +62,40 @@ def notebook_runner(latitude=None, longitude=None, sowing_date=None, crop_no=Non
     :param variety_no: the variety number (varid) as defined in the database
     :param season_no: the season number (seasonid) as defined in the database for distinguishing between
         different cropping seasons.
+    :param run_date: the date of the run which determines the range of trusted weather data
+        for the weather alerts, defaults to today.
+    :param profiler: optional `profiling.SimulationProfiler` counting the calls and time of the
+        simulation objects in the run.
     :return: The JSON data structure and the output from the PCSE Engine as a pandas dataframe
     """
 
-    # create a db connection
-    DBengine = sa.create_engine(config.database.dbc)
+    # get the pooled db connection of this process
+    DBengine = data_access.get_session()
 
-    # Pull in data from the database
-    wdp = dp.CombinedECMWFDarkSkyWeatherDataProvider(latitude, longitude)
+    # Pull in data from the database, weather data are shared among all locations in the grid cell
     crop = dp.CropDataProvider(DBengine, crop_no, variety_no)
+    wdp = weather_cache.get_weather_provider(latitude, longitude,
+                                             *dp.simulation_window(sowing_date, crop["MAX_DURATION"]))
 
     management_alerts, mremark = dp.fetch_management_alerts(DBengine, crop_no, variety_no, season_no)
     crop["MANAGEMENT_ALERTS"] = management_alerts
 
     weather_alerts, wremark = dp.fetch_weather_alerts(DBengine, crop_no, variety_no, season_no)
     crop["WEATHER_ALERTS"] = weather_alerts
+    crop["CROP_TEMPLATE"] = dp.fetch_crop_template(DBengine, crop_no, variety_no, season_no)
+    if run_date is not None:
+        crop["RUN_DATE"] = run_date
+    if profiler is not None:
+        crop["PROFILER"] = profiler
 
     # generate timer parameters based on sowing_date
-    timerdata = dp.make_timerdata(sowing_date, crop, crop_start_type=config.simulator.crop_start_type,
-                                  crop_end_type=config.simulator.crop_end_type)
-    pprovider = ParameterProvider(cropdata=crop, soildata={}, sitedata={}, timerdata=timerdata)
+    pprovider = dp.make_parameter_provider(sowing_date, crop, crop_start_type=config.simulator.crop_start_type,
+                                           crop_end_type=config.simulator.crop_end_type)
 
     # Run the simulation for phenology
-    engine = Engine(pprovider, wdp, config=config.simulator.simulator_config)
-    engine.run_till_terminate()
+    with instrumentation.stage("simulation"):
+        engine = Engine(pprovider, wdp, config=config.simulator.simulator_config)
+        engine.run_till_terminate()
     df = pd.DataFrame(engine.get_output())
     df.index = pd.to_datetime(df.day)
 
@@ -62,28 +104,15 @@ def notebook_runner(latitude=None, longitude=None, sowing_date=None, crop_no=Non
     walerts = engine.get_variable("WEATHER_MESSAGES")
     malerts = engine.get_variable("MANAGEMENT_MESSAGES")
 
-    # get phenology + management + weather alert messages and add them to json
-    palerts = ',\n'.join(palerts)
-    palerts = '"phenology":[\n%s\n]' % palerts
-
-    malerts = ',\n'.join(malerts)
-    malerts = '\n"managementalerts":[\n%s\n]' % malerts
-
-    walerts = ',\n'.join(walerts)
-    walerts = '\n"weatheralerts":[\n%s\n]' % walerts
-
-    # add messages together
-    alerts = [palerts, walerts, malerts]
-    alerts = filter(None, alerts)
-    alerts = '{' + ','.join(alerts) + '}'
-
-    # Replace quotes and let YAML parse it
-    alerts = json.loads(alerts)
+    # get phenology + management + weather alert messages as JSON
+    alerts = _combine_alerts(palerts, walerts, malerts)
 
     return alerts, df
 
 
-def GPRE_service_runner(wdp, sowing_date, crop_no=None, variety_no=-1, season_no=-1):
+@instrumentation.timed_request
+def GPRE_service_runner(wdp, sowing_date, crop_no=None, variety_no=-1, season_no=-1, run_date=None,
+                        profiler=None):
     """Make a run for given longitude, latitude, sowing date, crop_no and variety_no.
 
     :param wdp: The weather data provider to be used
@@ -91,15 +120,20 @@ def GPRE_service_runner(wdp, sowing_date, crop_no=None, variety_no=-1, season_no
     :param crop_no: The crop number
     :param variety_no: The variety number (defaults to -1, generic variety)
     :param season_no: The season number (defaults to -1: generic season)
+    :param run_date: the date of the run which determines the range of trusted weather data
+        for the weather alerts, defaults to today.
+    :param profiler: optional `profiling.SimulationProfiler` counting the calls and time of the
+        simulation objects in the run.
     :return: The JSON data structure on phenology, management and weather alerts
 
     Note that this function does not pull the weather data but expects a weather dataprovider
     as an input parameter. This allows for some optimization avoiding expensive cal
-    to databases and internet resources.
+    to databases and internet resources. Use `weather_cache.get_weather_provider()` to obtain
+    a weather dataprovider that is shared among all requests for the same grid cell.
     """
 
-    # create a db connection
-    DBengine = sa.create_engine(config.database.dbc)
+    # get the pooled db connection of this process
+    DBengine = data_access.get_session()
 
     crop = dp.CropDataProvider(DBengine, crop_no, variety_no)
 
@@ -108,37 +142,275 @@ def GPRE_service_runner(wdp, sowing_date, crop_no=None, variety_no=-1, season_no
 
     weather_alerts, wremark = dp.fetch_weather_alerts(DBengine, crop_no, variety_no, season_no)
     crop["WEATHER_ALERTS"] = weather_alerts
+    crop["CROP_TEMPLATE"] = dp.fetch_crop_template(DBengine, crop_no, variety_no, season_no)
+    if run_date is not None:
+        crop["RUN_DATE"] = run_date
+    if profiler is not None:
+        crop["PROFILER"] = profiler
 
     # generate timer parameters based on sowing_date
-    timerdata = dp.make_timerdata(sowing_date, crop, crop_start_type=config.simulator.crop_start_type,
-                                  crop_end_type=config.simulator.crop_end_type)
-    pprovider = ParameterProvider(cropdata=crop, soildata={}, sitedata={}, timerdata=timerdata)
+    pprovider = dp.make_parameter_provider(sowing_date, crop, crop_start_type=config.simulator.crop_start_type,
+                                           crop_end_type=config.simulator.crop_end_type)
 
     # Run the simulation for phenology
-    engine = Engine(pprovider, wdp, config=config.simulator.simulator_config)
-    engine.run_till_terminate()
+    with instrumentation.stage("simulation"):
+        engine = Engine(pprovider, wdp, config=config.simulator.simulator_config)
+        engine.run_till_terminate()
 
     # get results from model run
     palerts = engine.get_variable("BBCH_DATES")
     walerts = engine.get_variable("WEATHER_MESSAGES")
     malerts = engine.get_variable("MANAGEMENT_MESSAGES")
 
-    # get phenology + management + weather alert messages and add them to json
-    palerts = ',\n'.join(palerts)
-    palerts = '"phenology":[\n%s\n]' % palerts
+    # get phenology + management + weather alert messages as JSON
+    alerts = _combine_alerts(palerts, walerts, malerts)
+
+    return alerts
+
+
+@instrumentation.timed_request
+def cached_service_runner(wdp, sowing_date, crop_no=None, variety_no=-1, season_no=-1, run_date=None):
+    """Same as `GPRE_service_runner` but the results are taken from the result cache when
+    available, see `result_cache`.
+
+    :param wdp: The weather data provider to be used
+    :param sowing_date: date object providing sowing date of the crop
+    :param crop_no: The crop number
+    :param variety_no: The variety number (defaults to -1, generic variety)
+    :param season_no: The season number (defaults to -1: generic season)
+    :param run_date: the date of the run which determines the range of trusted weather data
+        for the weather alerts, defaults to today.
+    :return: The JSON data structure on phenology, management and weather alerts
+    """
+    if config.simulator.result_cache_backend is None or getattr(wdp, "grid_no", None) is None:
+        return GPRE_service_runner(wdp, sowing_date, crop_no, variety_no, season_no, run_date)
+
+    cache = result_cache.get_result_cache()
+    key = cache.make_key(wdp, sowing_date, crop_no, variety_no, season_no, run_date)
+    return cache.get_or_run(key, GPRE_service_runner, wdp, sowing_date, crop_no, variety_no, season_no, run_date)
 
-    malerts = ',\n'.join(malerts)
-    malerts = '\n"managementalerts":[\n%s\n]' % malerts
 
-    walerts = ',\n'.join(walerts)
-    walerts = '\n"weatheralerts":[\n%s\n]' % walerts
+@instrumentation.timed_request
+def incremental_service_runner(wdp, sowing_date, crop_no=None, variety_no=-1, season_no=-1, run_date=None):
+    """Same as `GPRE_service_runner` but the simulation continues from a checkpoint at the last
+    observed day of an earlier run when available, see `checkpoints`.
+
+    :param wdp: The weather data provider to be used
+    :param sowing_date: date object providing sowing date of the crop
+    :param crop_no: The crop number
+    :param variety_no: The variety number (defaults to -1, generic variety)
+    :param season_no: The season number (defaults to -1: generic season)
+    :param run_date: the date of the run which determines the range of trusted weather data
+        for the weather alerts, defaults to today.
+    :return: The JSON data structure on phenology, management and weather alerts
+    """
+    if getattr(wdp, "grid_no", None) is None:
+        return GPRE_service_runner(wdp, sowing_date, crop_no, variety_no, season_no, run_date)
+
+    # get the pooled db connection of this process
+    DBengine = data_access.get_session()
+
+    crop = dp.CropDataProvider(DBengine, crop_no, variety_no)
+
+    management_alerts, mremark = dp.fetch_management_alerts(DBengine, crop_no, variety_no, season_no)
+    crop["MANAGEMENT_ALERTS"] = management_alerts
+
+    weather_alerts, wremark = dp.fetch_weather_alerts(DBengine, crop_no, variety_no, season_no)
+    crop["WEATHER_ALERTS"] = weather_alerts
+    crop["CROP_TEMPLATE"] = dp.fetch_crop_template(DBengine, crop_no, variety_no, season_no)
+    if run_date is not None:
+        crop["RUN_DATE"] = run_date
+
+    key = (wdp.grid_no, sowing_date, crop_no, variety_no, season_no)
+    with instrumentation.stage("simulation"):
+        palerts, walerts, malerts = checkpoints.run_with_checkpoint(wdp, sowing_date, crop, key)
+
+    # get phenology + management + weather alert messages as JSON
+    alerts = _combine_alerts(palerts, walerts, malerts)
+
+    return alerts
+
 
-    # add messages together
-    alerts = [palerts, walerts, malerts]
-    alerts = filter(None, alerts)
-    alerts = '{' + ','.join(alerts) + '}'
+@instrumentation.timed_request
+def phenology_runner(wdp, sowing_date, crop_no=None, variety_no=-1, phenology_engine=None):
+    """Make a run for the crop phenology only for given sowing date, crop_no and variety_no.
+
+    :param wdp: The weather data provider to be used
+    :param sowing_date: date object providing sowing date of the crop
+    :param crop_no: The crop number
+    :param variety_no: The variety number (defaults to -1, generic variety)
+    :param phenology_engine: "numpy" for the vectorized phenology model or "pcse" for the
+        PCSE Engine, defaults to `config.simulator.phenology_engine`.
+    :return: The JSON data structure on phenology
+    """
+    if phenology_engine is None:
+        phenology_engine = config.simulator.phenology_engine
+
+    # get the pooled db connection of this process
+    DBengine = data_access.get_session()
+    crop = dp.CropDataProvider(DBengine, crop_no, variety_no)
+
+    if phenology_engine == "numpy":
+        # BBCH dates are derived from the thermal time index of the grid cell
+        with instrumentation.stage("simulation"):
+            result = thermal_time.query_phenology(wdp, sowing_date, crop)
+        palerts = result.BBCH_DATES
+    elif phenology_engine == "pcse":
+        crop["MANAGEMENT_ALERTS"] = []
+        crop["WEATHER_ALERTS"] = []
+        pprovider = dp.make_parameter_provider(sowing_date, crop, crop_start_type=config.simulator.crop_start_type,
+                                               crop_end_type=config.simulator.crop_end_type)
+        with instrumentation.stage("simulation"):
+            engine = Engine(pprovider, wdp, config=config.simulator.simulator_config)
+            engine.run_till_terminate()
+        palerts = engine.get_variable("BBCH_DATES")
+    else:
+        msg = "Unknown phenology engine: %s" % phenology_engine
+        raise ValueError(msg)
+
+    with instrumentation.stage("results") as s:
+        alerts = {"phenology": [r.as_dict() for r in palerts]}
+        s.rows = len(alerts["phenology"])
+
+    return alerts
+
+
+@instrumentation.timed_request
+def sowing_window_runner(wdp, first_sowing_date, last_sowing_date, crop_no=None, variety_no=-1, season_no=-1,
+                         step=1, phenology_engine=None, run_date=None):
+    """Make runs for a range of sowing dates for given crop_no, variety_no and season_no.
+
+    :param wdp: The weather data provider to be used
+    :param first_sowing_date: date object providing the first sowing date
+    :param last_sowing_date: date object providing the last sowing date (inclusive)
+    :param crop_no: The crop number
+    :param variety_no: The variety number (defaults to -1, generic variety)
+    :param season_no: The season number (defaults to -1: generic season)
+    :param step: number of days between consecutive sowing dates (defaults to 1)
+    :param phenology_engine: "numpy" for the vectorized models or "pcse" for the PCSE Engine,
+        defaults to `config.simulator.phenology_engine`.
+    :param run_date: the date of the run which determines the range of trusted weather data
+        for the weather alerts, defaults to today.
+    :return: a list with for each sowing date the JSON data structure on phenology, management
+        and weather alerts as returned by `GPRE_service_runner`, with the sowing date added
+        under the key "sowing_date".
+
+    The crop data and alerts are retrieved only once. With the "numpy" engine the weather data
+    are retrieved and the development rates are computed only once for all sowing dates.
+    """
+    if last_sowing_date < first_sowing_date:
+        msg = "Last sowing date (%s) before first sowing date (%s)" % (last_sowing_date, first_sowing_date)
+        raise ValueError(msg)
+    if step < 1:
+        msg = "Step between sowing dates must be at least 1 day, got %s" % step
+        raise ValueError(msg)
+    nsowings = (last_sowing_date - first_sowing_date).days // step + 1
+    sowing_dates = [first_sowing_date + dt.timedelta(days=i * step) for i in range(nsowings)]
+
+    return sowing_dates_runner(wdp, sowing_dates, crop_no, variety_no, season_no, phenology_engine, run_date)
+
+
+@instrumentation.timed_request
+def sowing_dates_runner(wdp, sowing_dates, crop_no=None, variety_no=-1, season_no=-1, phenology_engine=None,
+                        run_date=None):
+    """Make runs for a list of sowing dates for given crop_no, variety_no and season_no.
+
+    :param wdp: The weather data provider to be used
+    :param sowing_dates: list of date objects with the sowing dates
+    :param crop_no: The crop number
+    :param variety_no: The variety number (defaults to -1, generic variety)
+    :param season_no: The season number (defaults to -1: generic season)
+    :param phenology_engine: "numpy" for the vectorized models or "pcse" for the PCSE Engine,
+        defaults to `config.simulator.phenology_engine`.
+    :param run_date: the date of the run which determines the range of trusted weather data
+        for the weather alerts, defaults to today.
+    :return: a list with for each sowing date the JSON data structure on phenology, management
+        and weather alerts, see `sowing_window_runner`.
+    """
+    if phenology_engine is None:
+        phenology_engine = config.simulator.phenology_engine
+
+    # get the pooled db connection of this process
+    DBengine = data_access.get_session()
+
+    crop = dp.CropDataProvider(DBengine, crop_no, variety_no)
+    management_alerts, mremark = dp.fetch_management_alerts(DBengine, crop_no, variety_no, season_no)
+    weather_alerts, wremark = dp.fetch_weather_alerts(DBengine, crop_no, variety_no, season_no)
+
+    results = []
+    if phenology_engine == "numpy":
+        model = vectorized_phenology.VectorizedBBCHPhenology(crop)
+        wevaluator = vectorized_alerts.WeatherAlertEvaluator(weather_alerts)
+        mevaluator = vectorized_alerts.ManagementAlertEvaluator(management_alerts)
+        with instrumentation.stage("simulation"):
+            model_results = model.run_many(wdp, sowing_dates, crop["MAX_DURATION"])
+        for result in model_results:
+            with instrumentation.stage("alerts"):
+                palerts, walerts, malerts = (result.BBCH_DATES, wevaluator.evaluate(result, run_date),
+                                             mevaluator.evaluate(result))
+            results.append(_combine_alerts(palerts, walerts, malerts))
+    elif phenology_engine == "pcse":
+        crop["MANAGEMENT_ALERTS"] = management_alerts
+        crop["WEATHER_ALERTS"] = weather_alerts
+        crop["CROP_TEMPLATE"] = dp.fetch_crop_template(DBengine, crop_no, variety_no, season_no)
+        if run_date is not None:
+            crop["RUN_DATE"] = run_date
+        for sowing_date in sowing_dates:
+            pprovider = dp.make_parameter_provider(sowing_date, crop,
+                                                   crop_start_type=config.simulator.crop_start_type,
+                                                   crop_end_type=config.simulator.crop_end_type)
+            with instrumentation.stage("simulation"):
+                engine = Engine(pprovider, wdp, config=config.simulator.simulator_config)
+                engine.run_till_terminate()
+            alerts = _combine_alerts(engine.get_variable("BBCH_DATES"), engine.get_variable("WEATHER_MESSAGES"),
+                                     engine.get_variable("MANAGEMENT_MESSAGES"))
+            results.append(alerts)
+    else:
+        msg = "Unknown phenology engine: %s" % phenology_engine
+        raise ValueError(msg)
+
+    for sowing_date, alerts in zip(sowing_dates, results):
+        alerts["sowing_date"] = sowing_date.strftime("%Y-%m-%d")
+
+    return results
+
+
+@instrumentation.timed_request
+def ensemble_runner(wdp, sowing_date, crop_no=None, variety_no=-1, season_no=-1, run_date=None):
+    """Make a run for all members of an ensemble weather forecast for given sowing date, crop_no,
+    variety_no and season_no.
+
+    :param wdp: an EnsembleWeatherDataProvider
+    :param sowing_date: date object providing sowing date of the crop
+    :param crop_no: The crop number
+    :param variety_no: The variety number (defaults to -1, generic variety)
+    :param season_no: The season number (defaults to -1: generic season)
+    :param run_date: the date of the run which determines the range of trusted weather data
+        for the weather alerts, defaults to today.
+    :return: The JSON data structure on phenology, management and weather alerts, where each
+        record has the fraction of the ensemble members in which it occurs under the key
+        "probability". The number of members is added under the key "members".
+
+    The members are simulated with the vectorized models in one pass, running the PCSE Engine
+    for each member is not supported.
+    """
+    # get the pooled db connection of this process
+    DBengine = data_access.get_session()
+
+    crop = dp.CropDataProvider(DBengine, crop_no, variety_no)
+    management_alerts, mremark = dp.fetch_management_alerts(DBengine, crop_no, variety_no, season_no)
+    weather_alerts, wremark = dp.fetch_weather_alerts(DBengine, crop_no, variety_no, season_no)
 
-    # parse the JSON
-    alerts = json.loads(alerts)
+    with instrumentation.stage("simulation"):
+        model = vectorized_phenology.VectorizedBBCHPhenology(crop)
+        ensemble = model.run_ensemble(wdp, sowing_date, crop["MAX_DURATION"])
+    with instrumentation.stage("alerts"):
+        wevaluator = vectorized_alerts.WeatherAlertEvaluator(weather_alerts)
+        mevaluator = vectorized_alerts.ManagementAlertEvaluator(management_alerts)
+        walerts = wevaluator.evaluate_ensemble(ensemble, run_date)
+        malerts = mevaluator.evaluate_ensemble(ensemble)
+
+    alerts = _combine_alerts(ensemble.BBCH_PROBABILITIES, walerts, malerts)
+    alerts["members"] = len(ensemble)
 
     return alerts
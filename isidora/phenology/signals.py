@@ -8,6 +8,9 @@
  #Management rules
 MANAGEMENT_EVENT = "MANAGEMENT_EVENT"
 
+# Phenology, sent when the crop enters the next BBCH stage
+BBCH_STAGE_CHANGE = "BBCH_STAGE_CHANGE"
+
 # Weather alerts
 TMAX_STRESS = "TMAX_STRESS"
 RAIN_STRESS = "RAIN_STRESS"
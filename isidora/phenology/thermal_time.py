@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+# Copyright Alterra, Wageningen-UR
+# Allard de Wit (allard.dewit@wur.nl), March 2023
+"""Index on the thermal time for answering BBCH date queries without simulation.
+
+For a given grid cell and set of crop parameters that define the development rate (cardinal
+temperatures and daylength response), the daily development rate does not depend on the sowing
+date. The `ThermalTimeIndex` stores the cumulative sum (prefix sum) of the development rates
+over the entire period covered by the weather data of the grid cell. The day at which a BBCH
+stage is reached for a given sowing date is then found by a binary search for
+`prefix[sowing_date] + BBCH_TSUM` in the prefix sums.
+
+When the weather data of the grid cell change (new observed days or a new forecast), the index
+is updated from the first day at which the weather data differ. The result of an update is an
+immutable `ThermalTimeSnapshot` for the weather data provider, so concurrent requests with other
+weather data providers for the same grid cell do not affect each other. In the rare case that a
+temperature sum ends up within rounding distance of a BBCH temperature sum or of the
+rounding of the reported temperature sum, the phenology is simulated for that sowing date to
+guarantee identical results as the simulation.
+
+Use `get_thermal_time_index()` to obtain the index for a weather data provider and crop.
+"""
+from collections import OrderedDict
+import datetime as dt
+import threading
+import weakref
+
+import numpy as np
+
+import config
+from pcse.exceptions import PCSEError
+from .vectorized_phenology import VectorizedBBCHPhenology, get_weather_arrays
+
+
+class ThermalTimeSnapshot(object):
+    """The prefix sums of the development rates for the weather data of one weather data provider.
+
+    Snapshots are never modified after they are created, so they are queried without locking
+    while the index is updated for other weather data providers.
+
+    :param start_date: the first day of the weather data
+    :param DVR: array with the development rate for each day
+    :param prefix: array with the cumulative sum of DVR, prefix[k] is the sum of DVR[:k] (plus
+        a constant when the sums continue from another snapshot)
+    :param weather: dict with the weather arrays of the weather data provider
+    :param wdp: the weather data provider
+    """
+    # Relative tolerance for detecting temperature sums that depend on the order of summation
+    tolerance = 1e-9
+
+    def __init__(self, start_date, DVR, prefix, weather, wdp):
+        for values in [DVR, prefix] + list(weather.values()):
+            values.flags.writeable = False
+        self.start_date = start_date
+        self.DVR = DVR
+        self.prefix = prefix
+        self.weather = weather
+        self._wdp_ref = weakref.ref(wdp)
+
+    def __len__(self):
+        return len(self.DVR)
+
+    @property
+    def end_date(self):
+        return self.start_date + dt.timedelta(days=len(self) - 1)
+
+    def is_snapshot_of(self, wdp):
+        """Returns True if the snapshot holds the weather data of the weather data provider."""
+        return self._wdp_ref() is wdp
+
+    def query(self, model, sowing_date, max_duration):
+        """Returns the phenology for given sowing date.
+
+        :param model: VectorizedBBCHPhenology object defining the BBCH stages, its development
+            rate parameters must be the same as those of the index.
+        :param sowing_date: date object with the sowing date
+        :param max_duration: maximum duration of the simulation in days
+        :return: a PhenologyResult object
+        """
+        max_duration = int(max_duration)
+        DVR, prefix = self.DVR, self.prefix
+        start = (sowing_date - self.start_date).days
+        if start < 0 or start >= len(DVR):
+            msg = "No weather data available for simulating phenology at %s" % sowing_date
+            raise PCSEError(msg)
+        stop = min(start + max_duration + 1, len(DVR))
+        ndays = stop - start
+        weather = {name: values[start:stop] for name, values in self.weather.items()}
+
+        # Day at which the temperature sum since the sowing date reaches each BBCH stage
+        targets = prefix[start] + np.asarray(model.bbch_tsums[1:])
+        crossings = np.searchsorted(prefix[start:stop], targets, side="left")
+        stage_days = [0]
+        for day in crossings.tolist():
+            # Only a single stage can be reached on a day
+            day = max(day, stage_days[-1] + 1)
+            if day > ndays - 1:
+                break
+            stage_days.append(day)
+        stage_days += [-1] * (len(model.bbch_codes) - len(stage_days))
+
+        DVS = prefix[start:stop] - prefix[start]
+        if self._is_ambiguous(DVS, model.bbch_tsums, stage_days, prefix[stop - 1]):
+            return model._simulate(sowing_date, max_duration, DVR[start:stop], weather)
+        return model._make_result(sowing_date, max_duration, stage_days, DVR[start:stop], DVS, weather)
+
+    def _is_ambiguous(self, DVS, bbch_tsums, stage_days, scale):
+        """Checks if the temperature sums are within rounding distance of the BBCH temperature
+        sums or of the rounding to one decimal of the temperature sums at the BBCH dates.
+        """
+        eps = self.tolerance * max(1., abs(scale))
+        if (np.abs(DVS[:, None] - np.asarray(bbch_tsums[1:])[None, :]) <= eps).any():
+            return True
+        reached = [day for day in stage_days[1:] if day >= 0]
+        t_sum = DVS[reached] * 10.
+        return bool((np.abs(t_sum - np.floor(t_sum) - 0.5) <= eps * 10.).any())
+
+
+class ThermalTimeIndex(object):
+    """Prefix sums of the development rates for one grid cell and set of crop parameters.
+
+    The index keeps a `ThermalTimeSnapshot` for each weather data provider of the grid cell that
+    is in use. A new snapshot is computed from the most recent snapshot, only the development
+    rates from the first day at which the weather data differ are computed again.
+
+    :param model: a VectorizedBBCHPhenology object defining the development rate
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self._lock = threading.Lock()
+        self._latest = None
+        # Snapshots are kept as long as their weather data provider is in use
+        self._snapshots = weakref.WeakKeyDictionary()
+
+        self.updates = 0
+        self.updated_days = 0
+
+    def update(self, wdp):
+        """Returns the snapshot of the index for the weather data of the weather data provider.
+
+        :param wdp: weather data provider
+        :return: a ThermalTimeSnapshot
+        """
+        with self._lock:
+            # Weather data providers are immutable, so the snapshot of a provider needs no update
+            snapshot = self._snapshots.get(wdp)
+            if snapshot is not None:
+                return snapshot
+
+            weather = get_weather_arrays(wdp, wdp.first_date, wdp.last_date)
+            latest = self._latest
+            offset = None if latest is None else (wdp.first_date - latest.start_date).days
+            if offset is None or offset < 0 or offset >= len(latest):
+                first = 0
+            else:
+                # Find the first day at which the weather data differ from the latest snapshot
+                n = min(len(latest) - offset, len(weather["TEMP"]))
+                changed = (latest.weather["TEMP"][offset:offset + n] != weather["TEMP"][:n]) | \
+                          (latest.weather["LAT"][offset:offset + n] != weather["LAT"][:n])
+                first = int(np.argmax(changed)) if changed.any() else n
+
+            new_start = wdp.first_date + dt.timedelta(days=first)
+            DVR = self.model.development_rates(new_start, {"TEMP": weather["TEMP"][first:],
+                                                           "LAT": weather["LAT"][first:]})
+            if first == 0:
+                prefix = np.concatenate([[0.], np.cumsum(DVR)])
+            else:
+                DVR = np.concatenate([latest.DVR[offset:offset + first], DVR])
+                # Continue the summation from the last unchanged day
+                tail = np.cumsum(np.concatenate([latest.prefix[offset + first:offset + first + 1], DVR[first:]]))
+                prefix = np.concatenate([latest.prefix[offset:offset + first], tail])
+            snapshot = ThermalTimeSnapshot(wdp.first_date, DVR, prefix, weather, wdp)
+            self._snapshots[wdp] = self._latest = snapshot
+            self.updates += 1
+            self.updated_days += len(DVR) - first
+            return snapshot
+
+
+def rate_parameters(parameters):
+    """Returns the crop parameters that define the development rate as a tuple."""
+    return tuple(parameters[name] for name in ("PHENO_TBASE", "PHENO_TOPT1", "PHENO_TOPT2", "PHENO_TMAX",
+                                               "PHENO_DLC", "PHENO_DLO", "PHENO_IDSL"))
+
+
+_indexes = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def get_thermal_time_index(wdp, parameters):
+    """Returns the thermal time index for the grid cell of the weather data provider and the
+    crop parameters. Use `ThermalTimeIndex.update()` for the snapshot of the index for the weather
+    data of the weather data provider, which is the only state that can be queried.
+
+    The indexes are kept in a least-recently-used cache of `config.simulator.thermal_time_index_size`
+    entries keyed on (grid_no, development rate parameters).
+
+    :param wdp: weather data provider with a grid_no attribute
+    :param parameters: dict with crop parameters
+    """
+    key = (wdp.grid_no, rate_parameters(parameters))
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is None:
+            index = _indexes[key] = ThermalTimeIndex(VectorizedBBCHPhenology(parameters))
+        _indexes.move_to_end(key)
+        while len(_indexes) > config.simulator.thermal_time_index_size:
+            _indexes.popitem(last=False)
+    return index
+
+
+def query_phenology(wdp, sowing_date, cropd, max_duration=None):
+    """Returns the phenology for given sowing date and crop parameters from the thermal time index.
+
+    Falls back to simulating the phenology with the vectorized phenology model for weather data
+    providers that are not associated with a grid cell or weather data with missing days.
+
+    :param wdp: weather data provider
+    :param sowing_date: date object with the sowing date
+    :param cropd: dict with crop parameters
+    :param max_duration: maximum duration of the simulation, defaults to cropd["MAX_DURATION"]
+    :return: a PhenologyResult object
+    """
+    if max_duration is None:
+        max_duration = cropd["MAX_DURATION"]
+
+    model = VectorizedBBCHPhenology(cropd)
+    if getattr(wdp, "grid_no", None) is None:
+        return model.run(wdp, sowing_date, max_duration)
+    try:
+        snapshot = get_thermal_time_index(wdp, cropd).update(wdp)
+        return snapshot.query(model, sowing_date, max_duration)
+    except PCSEError:
+        return model.run(wdp, sowing_date, max_duration)
@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+# Copyright Alterra, Wageningen-UR
+# Allard de Wit (allard.dewit@wur.nl), March 2023
+"""Vectorized evaluation of the weather alerts defined in `weather_alerts_simulator` and the
+management alerts defined in `management_alerts_simulator`.
+
+Given the BBCH stage timeline from the vectorized phenology model, the threshold of each alert
+is known for every day of the season. The days at which the threshold is exceeded are computed
+for all days at once and the alerts are derived from the runs of consecutive days exceeding
+the threshold. The semantics are the same as for the `WeatherAlerts` simulation object:
+
+- The exceedance on day `d` is determined with the BBCH stage on day `d` and counted on day `d+1`.
+- An alert is sent when the number of consecutive days reaches the alert duration, after which
+  the counter is reset to zero. The alert is dated `duration` days before the day it is sent.
+- Alerts are only sent within the range of trusted weather data (see
+  `config.simulator.weather_alert_limit`), relative to the run date.
+
+Management alerts are sent on the first day (after the sowing date) at which the BBCH stage of
+the alert is the current stage, and each message is sent only once.
+
+For an ensemble forecast the alerts are evaluated for all members and each message is returned
+with the fraction of the members in which it is sent (the exceedance probability).
+"""
+from collections import OrderedDict
+import datetime as dt
+
+import numpy as np
+
+import config
+from pcse.exceptions import PCSEError
+from . import signals
+from .crop_template import index_management_rules
+from .records import AlertMessage, AlertProbability
+from .vectorized_phenology import day_of_year_array
+from .weather_alerts_simulator import humidity
+
+
+class WeatherAlertSpec(object):
+    """Parsed definition of a weather alert from the WEATHER_ALERTS table.
+
+    :param alert: row from the WEATHER_ALERTS table
+    """
+    # Mapping of the signal in the WEATHER_ALERTS table onto the signal sent by the alert,
+    # the name of the duration parameter and the name of the BBCH parameter
+    definitions = {"TMAX_STRESS": (signals.TMAX_STRESS, "TMAX_STRESS_DURATION", "TMAX_CRIT_BBCH"),
+                   "TMIN_STRESS": (signals.TMIN_STRESS, "TMIN_STRESS_DURATION", "TMIN_CRIT_BBCH"),
+                   "RAIN_STRESS": (signals.RAIN_STRESS, "RAIN_DURATION", "RAIN_CRIT_BBCH"),
+                   "RHMAX_STRESS": (signals.RHMAX_STRESS, "RHMAX_STRESS_DURATION", "RHMAX_CRIT_BBCH"),
+                   "FOG": (signals.FOG_STRESS, "FOG_DURATION", "CRIT_BBCH")}
+
+    def __init__(self, alert):
+        if alert.signal not in self.definitions:
+            msg = "Signal not recognized: %s" % alert.signal
+            raise PCSEError(msg)
+
+        self.alert_type = alert.signal
+        self.signal, duration_name, bbch_name = self.definitions[alert.signal]
+        self.parameters = eval(alert.parameters)
+        self.message_no = int(alert.message_no)
+        self.message = alert.weather_msg
+        self.duration = int(self.parameters[duration_name])
+        self.crit_bbch = list(self.parameters[bbch_name])
+
+        default = config.simulator.weather_alert_limit["DEFAULT"]
+        self.weather_alert_limit = config.simulator.weather_alert_limit.get(self.signal, default)
+
+    def stage_thresholds(self, name, bbch_codes, stage_index):
+        """Returns the threshold for parameter `name` on each day given the stage on that day.
+
+        :param name: name of the threshold parameter, e.g. TMAX_CRIT
+        :param bbch_codes: list of BBCH codes
+        :param stage_index: array with the index of the current BBCH code for each day
+        :return: array with the threshold, NaN on days where the stage has no threshold
+        """
+        values = self.parameters[name]
+        thresholds = np.full(len(bbch_codes), np.nan)
+        for i, code in enumerate(bbch_codes):
+            if code in self.crit_bbch:
+                thresholds[i] = values[self.crit_bbch.index(code)]
+        return thresholds[stage_index]
+
+    def exceedance(self, bbch_codes, stage_index, weather, derived):
+        """Returns a boolean array with the days at which the alert threshold is exceeded.
+        """
+        def thresholds(name):
+            return self.stage_thresholds(name, bbch_codes, stage_index)
+
+        # Comparisons with NaN are False, e.g. days with a stage without threshold
+        with np.errstate(invalid="ignore"):
+            if self.alert_type == "TMAX_STRESS":
+                return weather["TMAX"] >= thresholds("TMAX_CRIT")
+            elif self.alert_type == "TMIN_STRESS":
+                return weather["TMIN"] <= thresholds("TMIN_CRIT")
+            elif self.alert_type == "RAIN_STRESS":
+                return (weather["RAIN"] * 10) >= thresholds("RAIN_CRIT")
+            elif self.alert_type == "RHMAX_STRESS":
+                return derived["RH"] >= thresholds("RHMAX_CRIT")
+            else:
+                doy = derived["DOY"]
+                relevant = np.isin(derived["MONTH"], self.parameters["FOG_RELEVANT_MONTHS"])
+                return (relevant &
+                        (derived["RH"] >= thresholds("RHMAX_CRIT")) &
+                        (weather["WIND"] <= thresholds("UMIN_CRIT")) &
+                        ((doy > 336) | (doy < 60)) &
+                        (weather["TMIN"] <= thresholds("TMIN_CRIT")))
+
+    def alert_days(self, flags, last_valid_day):
+        """Returns the days at which the alert is sent.
+
+        :param flags: boolean array with exceedance of the threshold, flags[d] is counted on day d+1
+        :param last_valid_day: the last day index at which alerts can be sent
+        :return: array with the day indices at which the alert is sent
+        """
+        ndays = len(flags)
+        if self.duration <= 0:
+            # The counter always reaches the duration, so an alert is sent every day
+            days = np.arange(1, ndays + 1)
+        else:
+            # Start and length of the runs of consecutive days exceeding the threshold
+            edges = np.diff(np.concatenate([[0], flags.astype(np.int8), [0]]))
+            starts = np.flatnonzero(edges == 1)
+            lengths = np.flatnonzero(edges == -1) - starts
+            nalerts = lengths // self.duration
+            # The k-th alert within a run is sent on day start + k*duration (k=1, 2, ...)
+            run_starts = np.repeat(starts, nalerts)
+            k = np.arange(nalerts.sum()) - np.repeat(np.cumsum(nalerts) - nalerts, nalerts) + 1
+            days = run_starts + k * self.duration
+        # Alerts are not sent (nor reset) beyond the trusted range of weather data,
+        # as days only increase no alerts will be sent after the first invalid day.
+        return days[days <= last_valid_day]
+
+
+class WeatherAlertEvaluator(object):
+    """Evaluates all weather alerts for a crop on the result of the vectorized phenology model.
+
+    :param weather_alerts: rows from the WEATHER_ALERTS table
+    """
+
+    def __init__(self, weather_alerts):
+        self.specs = [WeatherAlertSpec(alert) for alert in weather_alerts]
+        # Days beyond the largest limit of trusted weather data are never evaluated
+        self.max_alert_limit = max([spec.weather_alert_limit for spec in self.specs], default=0)
+
+    def evaluate(self, result, run_date=None):
+        """Returns the weather messages for a phenology result, as AlertMessage objects in the
+        same order as the WEATHER_MESSAGES of `MainSimulator`.
+
+        :param result: a PhenologyResult object
+        :param run_date: the date of the run which determines the range of trusted weather data,
+            defaults to today.
+        :return: list of weather messages
+        """
+        return self._messages(result, self._alert_days(result, run_date))
+
+    def evaluate_ensemble(self, ensemble, run_date=None):
+        """Returns the weather messages for the phenology results of an ensemble forecast, with
+        the fraction of the members in which each message is sent.
+
+        The exceedance of the alert thresholds is computed for all members at once.
+
+        :param ensemble: an EnsembleResult object
+        :param run_date: the date of the run, see `evaluate()`
+        :return: list of AlertProbability objects
+        """
+        if run_date is None:
+            run_date = dt.date.today()
+        member_alerts = [[] for _ in ensemble.members]
+        end_days = ensemble.end_days
+        run_day = (run_date - ensemble.sowing_date).days
+        ndays = min(int(end_days.max()), run_day + self.max_alert_limit)
+        if self.specs and ndays >= 1:
+            stage_index = ensemble.stage_index[:, :ndays]
+            weather = {name: values[:, :ndays] for name, values in ensemble.weather.items()}
+            derived = self._derived_variables(ensemble.sowing_date, weather)
+
+            for position, spec in enumerate(self.specs):
+                flags = spec.exceedance(ensemble.bbch_codes, stage_index, weather, derived)
+                for i, end_day in enumerate(end_days.tolist()):
+                    days = spec.alert_days(flags[i, :end_day], run_day + spec.weather_alert_limit)
+                    member_alerts[i].extend((day, position, spec) for day in days.tolist())
+
+        return alert_probabilities([self._messages(ensemble, alerts) for alerts in member_alerts])
+
+    @staticmethod
+    def _messages(result, alerts):
+        """Builds the weather messages from a list of (day, position, spec) tuples.
+        """
+        # Alerts are sent day-by-day in the order in which the alerts are defined
+        alerts.sort(key=lambda a: (a[0], a[1]))
+        messages = []
+        for day, _, spec in alerts:
+            mday = result.date(day - spec.duration)
+            messages.append(AlertMessage(mday, spec.message_no, spec.message))
+        return messages
+
+    def count_alerts(self, result, run_date=None):
+        """Returns the number of weather alerts for a phenology result for each signal.
+
+        :param result: a PhenologyResult object
+        :param run_date: the date of the run, see `evaluate()`
+        :return: a dict with the number of alerts for each signal, including signals without alerts
+        """
+        counts = {spec.signal: 0 for spec in self.specs}
+        for _, _, spec in self._alert_days(result, run_date):
+            counts[spec.signal] += 1
+        return counts
+
+    def _alert_days(self, result, run_date=None):
+        """Returns a list of (day, position, spec) tuples for all alerts sent.
+        """
+        if run_date is None:
+            run_date = dt.date.today()
+        run_day = (run_date - result.sowing_date).days
+        # Exceedances on the last day are never counted as the simulation terminates, and
+        # days beyond the trusted range of weather data of all alerts are not evaluated.
+        ndays = min(result.end_day, run_day + self.max_alert_limit)
+        if not self.specs or ndays < 1:
+            return []
+
+        stage_index = result.stage_index[:ndays]
+        weather = {name: values[:ndays] for name, values in result.weather.items()}
+        derived = self._derived_variables(result.sowing_date, weather)
+
+        alerts = []
+        for position, spec in enumerate(self.specs):
+            flags = spec.exceedance(result.bbch_codes, stage_index, weather, derived)
+            days = spec.alert_days(flags, run_day + spec.weather_alert_limit)
+            alerts.extend((day, position, spec) for day in days.tolist())
+        return alerts
+
+    def _derived_variables(self, start_date, weather):
+        """Computes the relative humidity, day-of-year and month for each day, the relative
+        humidity and day-of-year are taken from the weather data when available.
+        """
+        derived = {}
+        if "RH" in weather:
+            derived["RH"] = weather["RH"]
+        else:
+            _, derived["RH"] = humidity(weather["TMAX"], weather["TMIN"], weather["VAP"])
+        ndays = weather["TMAX"].shape[-1]
+        derived["DOY"] = day_of_year_array(start_date, ndays)
+        days = np.arange(np.datetime64(start_date, "D"), np.datetime64(start_date, "D") + ndays)
+        derived["MONTH"] = days.astype("datetime64[M]").astype(np.int64) % 12 + 1
+        return derived
+
+
+class ManagementAlertEvaluator(object):
+    """Evaluates the management alerts for a crop on the result of the vectorized phenology model.
+
+    :param management_alerts: rows from the MANAGEMENT_ALERTS table
+    """
+
+    def __init__(self, management_alerts):
+        self.rules = list(management_alerts)
+        self.rules_by_stage = index_management_rules(self.rules)
+
+    @staticmethod
+    def stage_first_days(result):
+        """Returns a dict with the first day at which each BBCH stage is seen by the management
+        rules, which are evaluated from the first day after the sowing date onwards.
+        """
+        first_days = {}
+        if result.end_day < 1:
+            return first_days
+        for i, (code, day) in enumerate(zip(result.bbch_codes, result.stage_days)):
+            if day < 0:
+                break
+            if i == 0:
+                # The initial stage is only seen when the next stage is not reached on day 1
+                if result.stage_days[1] == 1:
+                    continue
+                day = 1
+            first_days[code] = day
+        return first_days
+
+    def evaluate(self, result):
+        """Returns the management messages for a phenology result, as AlertMessage objects in
+        the same order as the MANAGEMENT_MESSAGES of `MainSimulator`.
+
+        :param result: a PhenologyResult object
+        :return: list of management messages
+        """
+        messages = []
+        processed_message_ids = set()
+        # Each stage is entered on a different day, so the stages are resolved in order of the
+        # stage dates and the rules of a stage in the order of the table.
+        for code, day in sorted(self.stage_first_days(result).items(), key=lambda item: item[1]):
+            for rule in self.rules_by_stage.get(code, ()):
+                if rule.message_no in processed_message_ids:
+                    continue
+                processed_message_ids.add(rule.message_no)
+                mday = result.date(day) + dt.timedelta(days=rule.offset_days)
+                messages.append(AlertMessage(mday, rule.message_no, rule.management_msg))
+        return messages
+
+    def evaluate_ensemble(self, ensemble):
+        """Returns the management messages for the phenology results of an ensemble forecast,
+        with the fraction of the members in which each message is sent.
+
+        :param ensemble: an EnsembleResult object
+        :return: list of AlertProbability objects
+        """
+        return alert_probabilities([self.evaluate(result) for result in ensemble.members])
+
+
+def alert_probabilities(member_messages):
+    """Combines the messages of the members of an ensemble forecast into AlertProbability objects.
+
+    :param member_messages: a list with the list of AlertMessage objects of each member
+    :return: list of AlertProbability objects sorted on day, with the fraction of the members
+        in which each message is sent.
+    """
+    counts = OrderedDict()
+    for messages in member_messages:
+        seen = set()
+        for message in messages:
+            key = (message.day, message.msg_id, message.msg)
+            if key not in seen:
+                seen.add(key)
+                counts[key] = counts.get(key, 0) + 1
+
+    nmembers = len(member_messages)
+    # Sorting is stable, so messages on the same day keep the order in which they are sent
+    return [AlertProbability(day, msg_id, msg, counts[(day, msg_id, msg)] / nmembers)
+            for day, msg_id, msg in sorted(counts, key=lambda k: k[0])]
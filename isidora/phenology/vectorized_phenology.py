@@ -0,0 +1,447 @@
+# -*- coding: utf-8 -*-
+# Copyright Alterra, Wageningen-UR
+# Allard de Wit (allard.dewit@wur.nl), March 2023
+"""Vectorized implementation of the BBCH phenology model as a fast alternative to running
+`GenericBBCHPhenology` day-by-day in the PCSE Engine.
+
+The phenology model accumulates the daily development rate (effective temperature multiplied
+by the reduction factor for photoperiod) and moves to the next BBCH stage when the temperature
+sum of that stage is reached. As the development rate only depends on the weather, the rates
+for the entire season can be computed in one pass, after which the BBCH transition dates are
+found by searching the cumulative temperature sum. The results are identical to the results
+of the PCSE Engine, including the following properties of the day-by-day simulation:
+
+- The rate computed for a day is integrated on the next day, so the temperature sum on day `k`
+  after sowing is the sum of the rates of day 0 up to day `k-1`.
+- At most one BBCH stage can be reached on a day.
+- The simulation terminates when the final BBCH stage is reached or at the end of the
+  simulation period (`MAX_DURATION` days after sowing).
+
+With an ensemble weather forecast, the development rates of all members are computed at once
+from (members x days) weather arrays, see `VectorizedBBCHPhenology.run_ensemble()`.
+"""
+import datetime as dt
+import functools
+
+import numpy as np
+
+import config
+from pcse.exceptions import PCSEError
+from pcse.util import Afgen, daylength
+
+from .crop_template import bbch_stages
+from .records import BBCHRecord, BBCHProbability
+
+
+def afgen_array(tbl_xy, x):
+    """Vectorized version of the PCSE `Afgen` function which gives identical results.
+
+    :param tbl_xy: List of XY value pairs describing the function
+    :param x: array with abscissa values
+    :return: array with interpolated values
+    """
+    afgen = Afgen(tbl_xy)
+    x_list = np.array(afgen.x_list)
+    y_list = np.array(afgen.y_list)
+    slopes = np.array(afgen.slopes + [0.])
+    x = np.asarray(x, dtype=np.float64)
+    i = np.clip(np.searchsorted(x_list, x, side="left") - 1, 0, len(x_list) - 1)
+    v = y_list[i] + slopes[i] * (x - x_list[i])
+    v = np.where(x <= x_list[0], y_list[0], v)
+    v = np.where(x >= x_list[-1], y_list[-1], v)
+    return v
+
+
+def daylength_array(start_date, ndays, latitude):
+    """Returns the daylength for ndays consecutive days starting at start_date.
+
+    The daylength only depends on the day of the year, therefore it is computed with the
+    PCSE `daylength` function for each day of the year and looked up for the given days.
+
+    :param start_date: first day
+    :param ndays: number of days
+    :param latitude: latitude of the location
+    :return: array with the daylength [hours]
+    """
+    table = daylength_table(float(latitude))
+    doys = day_of_year_array(start_date, ndays)
+    return table[doys]
+
+
+def daylength_table(latitude):
+    """Daylength for day-of-year 0-366 (0 is not used) at given latitude.
+
+    The latitude is rounded to the resolution of the weather grid (`config.cell_size`), so the
+    tables are shared by all locations at the same grid latitude. Both the weather data providers
+    (DAYLENGTH) and the vectorized model use these tables, so their results remain identical.
+    The returned array is shared and read-only.
+    """
+    cell_size = config.cell_size
+    return _daylength_table(round(round(latitude / cell_size) * cell_size, 6))
+
+
+@functools.lru_cache(maxsize=1024)
+def _daylength_table(latitude):
+    table = np.zeros(367)
+    leap_year = dt.date(2000, 1, 1)
+    for i in range(366):
+        table[i + 1] = daylength(leap_year + dt.timedelta(days=i), latitude)
+    table.setflags(write=False)
+    return table
+
+
+def clear_daylength_tables():
+    """Removes the cached daylength tables."""
+    _daylength_table.cache_clear()
+
+
+def day_of_year_array(start_date, ndays):
+    """Returns the day of the year (Jan 1st = 1) for ndays consecutive days starting at start_date.
+    """
+    days = np.arange(np.datetime64(start_date, "D"), np.datetime64(start_date, "D") + ndays)
+    years = days.astype("datetime64[Y]")
+    return (days - years).astype(np.int64) + 1
+
+
+class PhenologyResult(object):
+    """Results of the vectorized phenology model.
+
+    :ivar sowing_date: the sowing date (start of the simulation)
+    :ivar end_day: the index of the last simulated day (0 is the sowing date)
+    :ivar bbch_codes: the BBCH codes in the order in which they are reached
+    :ivar stage_days: the day index at which each BBCH code is reached, the first code
+        is reached at day 0, codes that are not reached have -1
+    :ivar DVR: array with the development rate for each simulated day
+    :ivar DVS: array with the temperature sum at each simulated day
+    :ivar weather: dict with arrays of weather variables for each simulated day
+    """
+
+    def __init__(self, sowing_date, end_day, bbch_codes, bbch_tsums, stage_days, DVR, DVS, weather):
+        self.sowing_date = sowing_date
+        self.end_day = end_day
+        self.bbch_codes = bbch_codes
+        self.bbch_tsums = bbch_tsums
+        self.stage_days = stage_days
+        self.DVR = DVR
+        self.DVS = DVS
+        self.weather = weather
+
+    def date(self, day):
+        """Returns the date for given day index."""
+        return self.sowing_date + dt.timedelta(days=int(day))
+
+    @property
+    def days(self):
+        """The dates of the simulated days."""
+        return [self.date(i) for i in range(self.end_day + 1)]
+
+    @property
+    def stage_index(self):
+        """Array with the index of the BBCH code that is current at each simulated day."""
+        index = np.zeros(self.end_day + 1, dtype=np.int64)
+        for i, day in enumerate(self.stage_days[1:], 1):
+            if day >= 0:
+                index[day:] = i
+        return index
+
+    @property
+    def BBCH_DATES(self):
+        """The BBCH dates as BBCHRecord objects in the same way as by `GenericBBCHPhenology`."""
+        bbch_dates = []
+        for i, (code, day) in enumerate(zip(self.bbch_codes, self.stage_days)):
+            if day < 0:
+                break
+            t_sum = 0. if i == 0 else round(float(self.DVS[day]), 1)
+            bbch_dates.append(BBCHRecord(self.date(day), code, t_sum))
+        return bbch_dates
+
+    @property
+    def DATE_OF_CROP_MATURITY(self):
+        """The day at which the final BBCH stage is reached, or the last simulated day when it is
+        not reached, like `GenericBBCHPhenology.finalize()`."""
+        return self.date(self.end_day)
+
+    def get_output(self):
+        """Returns the daily output in the same way as `Engine.get_output()` for the variables
+        defined in OUTPUT_VARS of the simulator configuration.
+        """
+        stage_index = self.stage_index
+        # The target temperature sum is the sum of the next stage, which remains the sum of the
+        # final stage once that stage is reached.
+        target_index = np.minimum(stage_index + 1, len(self.bbch_tsums) - 1)
+        output = []
+        for i in range(self.end_day + 1):
+            output.append({"day": self.date(i),
+                           "DVR": float(self.DVR[i]),
+                           "DVS": float(self.DVS[i]),
+                           "BBCH_TARGET_TSUM": float(self.bbch_tsums[target_index[i]]),
+                           "BBCH_CURRENT_STAGE": self.bbch_codes[stage_index[i]]})
+        return output
+
+
+class EnsembleResult(object):
+    """Results of the vectorized phenology model for the members of an ensemble forecast.
+
+    :ivar members: list with a PhenologyResult object for each member
+    :ivar weather: dict with (members x days) arrays of weather variables for the days
+        simulated by any of the members
+    """
+
+    def __init__(self, members, weather):
+        self.members = members
+        self.weather = weather
+
+    def __len__(self):
+        return len(self.members)
+
+    @property
+    def sowing_date(self):
+        return self.members[0].sowing_date
+
+    @property
+    def bbch_codes(self):
+        return self.members[0].bbch_codes
+
+    @property
+    def end_days(self):
+        """Array with the index of the last simulated day of each member."""
+        return np.array([result.end_day for result in self.members])
+
+    @property
+    def stage_index(self):
+        """(members x days) array with the index of the current BBCH code, days after the end
+        of the simulation of a member have the final stage of that member."""
+        ndays = self.end_days.max() + 1
+        index = np.empty((len(self.members), ndays), dtype=np.int64)
+        for i, result in enumerate(self.members):
+            stage_index = result.stage_index
+            index[i, :len(stage_index)] = stage_index
+            index[i, len(stage_index):] = stage_index[-1]
+        return index
+
+    def date(self, day):
+        """Returns the date for given day index."""
+        return self.sowing_date + dt.timedelta(days=int(day))
+
+    @property
+    def BBCH_PROBABILITIES(self):
+        """The distribution of the BBCH dates over the members as BBCHProbability objects, for the
+        BBCH stages that are reached by at least one member."""
+        records = []
+        for i, code in enumerate(self.bbch_codes):
+            days = sorted(result.stage_days[i] for result in self.members if result.stage_days[i] >= 0)
+            if not days:
+                break
+            median = days[(len(days) - 1) // 2]
+            records.append(BBCHProbability(code, self.date(median), self.date(days[0]), self.date(days[-1]),
+                                           len(days) / len(self.members)))
+        return records
+
+
+class VectorizedBBCHPhenology(object):
+    """Vectorized version of `GenericBBCHPhenology`.
+
+    :param parameters: dict or ParameterProvider with crop parameters, including the cardinal
+        temperatures, daylength parameters and the BBCH_* temperature sums.
+    """
+
+    def __init__(self, parameters):
+        self.PHENO_TBASE = float(parameters["PHENO_TBASE"])
+        self.PHENO_TOPT1 = float(parameters["PHENO_TOPT1"])
+        self.PHENO_TOPT2 = float(parameters["PHENO_TOPT2"])
+        self.PHENO_TMAX = float(parameters["PHENO_TMAX"])
+        self.PHENO_DLC = float(parameters["PHENO_DLC"])
+        self.PHENO_DLO = float(parameters["PHENO_DLO"])
+        self.PHENO_IDSL = int(parameters["PHENO_IDSL"])
+        self.bbch_codes, self.bbch_tsums = bbch_stages(parameters)
+        if len(self.bbch_codes) < 2:
+            msg = "At least two BBCH stages are needed for simulating phenology, found: %s"
+            raise PCSEError(msg % self.bbch_codes)
+
+        # Temperature function from cardinal temperatures, see GenericBBCHPhenology
+        self.Tfunc = [self.PHENO_TBASE, 0.,
+                      self.PHENO_TOPT1, (self.PHENO_TOPT1 - self.PHENO_TBASE),
+                      self.PHENO_TOPT2, (self.PHENO_TOPT1 - self.PHENO_TBASE),
+                      self.PHENO_TMAX, 0.]
+
+    def development_rates(self, start_date, weather):
+        """Computes the daily development rate for consecutive days starting at start_date.
+
+        :param start_date: date of the first day
+        :param weather: dict with arrays TEMP and LAT for each day, or (members x days) arrays
+            for an ensemble forecast
+        :return: array with the development rate (DVR), with the same shape as TEMP
+        """
+        TEMP = np.asarray(weather["TEMP"], dtype=np.float64)
+        RF_PHOTO = np.ones(TEMP.shape)
+        if self.PHENO_IDSL >= 1:
+            LAT = np.asarray(weather["LAT"], dtype=np.float64)
+            DAYLP = np.empty(TEMP.shape)
+            for lat in np.unique(LAT):
+                ix = (LAT == lat)
+                DAYLP[ix] = np.broadcast_to(daylength_array(start_date, TEMP.shape[-1], lat), TEMP.shape)[ix]
+            RF_PHOTO = np.clip((DAYLP - self.PHENO_DLC) / (self.PHENO_DLO - self.PHENO_DLC), 0., 1.)
+        Teff = afgen_array(self.Tfunc, TEMP)
+        return Teff * RF_PHOTO
+
+    def stage_days(self, DVS, max_day):
+        """Finds the day index at which each BBCH stage is reached.
+
+        :param DVS: array with the temperature sum for day 0, 1, 2, ...
+        :param max_day: the last day that can be simulated
+        :return: a list with the day index for each BBCH stage, -1 if not reached.
+        """
+        stage_days = [0]
+        previous = 0
+        for target in self.bbch_tsums[1:]:
+            day = int(np.searchsorted(DVS, target, side="left"))
+            # Only a single stage can be reached on a day
+            day = max(day, previous + 1)
+            if day > max_day:
+                break
+            stage_days.append(day)
+            previous = day
+        stage_days += [-1] * (len(self.bbch_codes) - len(stage_days))
+        return stage_days
+
+    def run(self, wdp, sowing_date, max_duration):
+        """Simulates phenology from the sowing date until the final BBCH stage is reached or
+        the simulation period of max_duration days ends.
+
+        :param wdp: weather data provider
+        :param sowing_date: date object with the sowing date
+        :param max_duration: maximum duration of the simulation in days
+        :return: a PhenologyResult object
+        """
+        return self.run_many(wdp, [sowing_date], max_duration)[0]
+
+    def run_many(self, wdp, sowing_dates, max_duration):
+        """Simulates phenology for a number of sowing dates.
+
+        The weather data are retrieved and the development rates are computed only once for
+        the period covering all sowing dates, as the development rate on a given day does not
+        depend on the sowing date.
+
+        :param wdp: weather data provider
+        :param sowing_dates: list of date objects with the sowing dates
+        :param max_duration: maximum duration of the simulation in days
+        :return: a list of PhenologyResult objects, one for each sowing date
+        """
+        max_duration = int(max_duration)
+        first_day = min(sowing_dates)
+        last_day = min(max(sowing_dates) + dt.timedelta(days=max_duration), wdp.last_date)
+        weather = get_weather_arrays(wdp, first_day, last_day)
+        DVR = self.development_rates(first_day, weather)
+
+        results = []
+        for sowing_date in sowing_dates:
+            start = (sowing_date - first_day).days
+            stop = start + max_duration + 1
+            results.append(self._simulate(sowing_date, max_duration, DVR[start:stop],
+                                          {name: values[start:stop] for name, values in weather.items()}))
+        return results
+
+    def run_ensemble(self, wdp, sowing_date, max_duration):
+        """Simulates phenology for all members of an ensemble forecast.
+
+        The development rates of all members are computed in one pass over the
+        (members x days) weather arrays.
+
+        :param wdp: an EnsembleWeatherDataProvider
+        :param sowing_date: date object with the sowing date
+        :param max_duration: maximum duration of the simulation in days
+        :return: an EnsembleResult object
+        """
+        max_duration = int(max_duration)
+        last_day = min(sowing_date + dt.timedelta(days=max_duration), wdp.last_date)
+        weather = get_ensemble_arrays(wdp, sowing_date, last_day)
+        DVR = self.development_rates(sowing_date, weather)
+
+        members = []
+        for i in range(DVR.shape[0]):
+            members.append(self._simulate(sowing_date, max_duration, DVR[i],
+                                          {name: values[i] for name, values in weather.items()}))
+        ndays = max(result.end_day for result in members) + 1
+        return EnsembleResult(members, {name: values[:, :ndays] for name, values in weather.items()})
+
+    def _simulate(self, sowing_date, max_duration, DVR, weather):
+        """Simulates phenology from given development rates starting at the sowing date.
+        """
+        ndays = len(DVR)
+        # Temperature sum at day k is the sum of the rates of day 0 to k-1
+        DVS = np.concatenate([[0.], np.cumsum(DVR[:-1])])
+        stage_days = self.stage_days(DVS, ndays - 1)
+        return self._make_result(sowing_date, max_duration, stage_days, DVR, DVS, weather)
+
+    def _make_result(self, sowing_date, max_duration, stage_days, DVR, DVS, weather):
+        """Determines the end of the simulation and builds the result for the simulated days.
+        """
+        ndays = len(DVR)
+        if stage_days[-1] >= 0:
+            end_day = stage_days[-1]
+        elif ndays - 1 == max_duration:
+            end_day = max_duration
+        else:
+            last_day = sowing_date + dt.timedelta(days=ndays - 1)
+            msg = "No weather data available for simulating phenology beyond %s" % last_day
+            raise PCSEError(msg)
+
+        weather = {name: values[:end_day + 1] for name, values in weather.items()}
+        return PhenologyResult(sowing_date, end_day, self.bbch_codes, self.bbch_tsums, stage_days,
+                               DVR[:end_day + 1], DVS[:end_day + 1], weather)
+
+
+def get_weather_arrays(wdp, start_date, end_date):
+    """Returns the weather data from start_date up to and including end_date as a dict of arrays.
+
+    Uses `wdp.get_weather_arrays()` when the weather data provider supports it, otherwise the
+    weather data are retrieved day-by-day from the weather data provider.
+
+    :param wdp: weather data provider
+    :param start_date: first day
+    :param end_date: last day
+    """
+    try:
+        if hasattr(wdp, "get_weather_arrays"):
+            return wdp.get_weather_arrays(start_date, end_date)
+
+        ndays = (end_date - start_date).days + 1
+        records = [wdp(start_date + dt.timedelta(days=i)) for i in range(ndays)]
+        weather = {}
+        for name in ("TMAX", "TMIN", "VAP", "WIND", "RAIN", "LAT"):
+            weather[name] = np.array([getattr(r, name) for r in records], dtype=np.float64)
+        weather["TEMP"] = np.array([getattr(r, "TEMP", (r.TMIN + r.TMAX)/2.) for r in records])
+        return weather
+    except KeyError as e:
+        msg = "Failed to retrieve weather data between %s and %s: %s" % (start_date, end_date, e)
+        raise PCSEError(msg)
+
+
+def get_ensemble_arrays(wdp, start_date, end_date):
+    """Returns the weather data of all members of an ensemble forecast from start_date up to and
+    including end_date as a dict of (members x days) arrays.
+
+    :param wdp: an EnsembleWeatherDataProvider
+    :param start_date: first day
+    :param end_date: last day
+    """
+    try:
+        return wdp.get_ensemble_arrays(start_date, end_date)
+    except KeyError as e:
+        msg = "Failed to retrieve weather data between %s and %s: %s" % (start_date, end_date, e)
+        raise PCSEError(msg)
+
+
+def run_phenology(wdp, sowing_date, cropd, max_duration=None):
+    """Runs the vectorized phenology model for given crop parameters and sowing date.
+
+    :param wdp: weather data provider
+    :param sowing_date: date object with the sowing date
+    :param cropd: dict with crop parameters
+    :param max_duration: maximum duration of the simulation, defaults to cropd["MAX_DURATION"]
+    :return: a PhenologyResult object
+    """
+    if max_duration is None:
+        max_duration = cropd["MAX_DURATION"]
+    model = VectorizedBBCHPhenology(cropd)
+    return model.run(wdp, sowing_date, max_duration)
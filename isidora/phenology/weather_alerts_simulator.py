@@ -16,12 +16,47 @@ from pcse.exceptions import PCSEError
 from pcse.base_classes import SimulationObject, ParamTemplate
 from pcse.decorators import prepare_rates, prepare_states
 
+from .crop_template import get_crop_template
+
 # Convert hPa to kPa
 hPa2kPa = lambda x: x/10.
 # Saturated Vapour pressure [kPa] at temperature temp [C]
 SatVapourPressure = lambda temp: 0.6108 * np.exp((17.27 * temp) / (237.3 + temp))
 
 
+def humidity(TMAX, TMIN, VAP):
+    """Returns the daily average saturated vapour pressure [kPa] and the relative humidity [%]
+    from the maximum and minimum temperature [C] and the vapour pressure [hPa], for a single day
+    or for arrays of days.
+    """
+    # Daily average saturated vapour pressure [kPa] from min&max air temperature
+    SVAP = (SatVapourPressure(TMAX) + SatVapourPressure(TMIN)) / 2.
+    # Relative humidity from SVAP and VAP in [%]
+    RH = 100 * np.minimum(hPa2kPa(VAP), SVAP)/SVAP
+    return SVAP, RH
+
+
+def relative_humidity(drv):
+    """Returns the relative humidity [%] of the day, as computed once for all days by the weather
+    data provider (see `CombinedECMWFDarkSkyWeatherDataProvider._compute_derived_variables()`).
+    It is computed here for weather data providers without derived variables.
+
+    :param drv: the driving variables of the day
+    """
+    RH = getattr(drv, "RH", None)
+    if RH is None:
+        _, RH = humidity(drv.TMAX, drv.TMIN, drv.VAP)
+    return RH
+
+
+def day_of_year(day, drv):
+    """Returns the day of the year from the driving variables, or from the day for weather data
+    providers without derived variables.
+    """
+    DOY = getattr(drv, "DOY", None)
+    return day.timetuple().tm_yday if DOY is None else DOY
+
+
 class WeatherAlerts(SimulationObject):
     """Groups all weather alerts and ensures execution of all individual alerts.
     """
@@ -35,48 +70,19 @@ class WeatherAlerts(SimulationObject):
         :param parameters: dict with alert parameter values
         """
         self.weather_alerts = []
-        # Read list weather alerts from database
-        weather_alert_tbl = parameters["WEATHER_ALERTS"]
-        for alert in weather_alert_tbl:
-            if alert.signal == "TMAX_STRESS":
-                parvalues = eval(alert.parameters)
-                # Add message_no and message to parvalues dictionary
-                parvalues.update(MESSAGE_NO=alert.message_no)
-                parvalues.update(MESSAGE=alert.weather_msg)
-                simobj = TmaxStressThreshold(day, kiosk, parvalues)
-                self.weather_alerts.append(simobj)
-            elif alert.signal == "TMIN_STRESS":
-                parvalues = eval(alert.parameters)
-                # Add message_no and message to parvalues dictionary
-                parvalues.update(MESSAGE_NO=alert.message_no)
-                parvalues.update(MESSAGE=alert.weather_msg)
-                simobj = TminStressThreshold(day, kiosk, parvalues)
-                self.weather_alerts.append(simobj)
-            elif alert.signal == "RAIN_STRESS":
-                parvalues = eval(alert.parameters)
-                # Add message_no and message to parvalues dictionary
-                parvalues.update(MESSAGE_NO=alert.message_no)
-                parvalues.update(MESSAGE=alert.weather_msg)
-                simobj = RainStressThreshold(day, kiosk, parvalues)
-                self.weather_alerts.append(simobj)
-            elif alert.signal == "RHMAX_STRESS":
-                parvalues = eval(alert.parameters)
-                # Add message_no and message to parvalues dictionary
-                parvalues.update(MESSAGE_NO=alert.message_no)
-                parvalues.update(MESSAGE=alert.weather_msg)
-                simobj = RHMAXStressThreshold(day, kiosk, parvalues)
-                self.weather_alerts.append(simobj)
-            elif alert.signal == "FOG":
-                parvalues = eval(alert.parameters)
-                # Add message_no and message to parvalues dictionary
-                parvalues.update(MESSAGE_NO=alert.message_no)
-                parvalues.update(MESSAGE=alert.weather_msg)
-                simobj = FOGthreshold(day, kiosk, parvalues)
-                self.weather_alerts.append(simobj)  
-            else:
-                msg = "Signal not recognized: %s" % alert.signal
+        # The run date determines the range of trusted weather data, it can be passed as crop
+        # parameter RUN_DATE for reproducing earlier runs.
+        run_date = parameters["RUN_DATE"] if "RUN_DATE" in parameters else datetime.date.today()
+        # The weather alerts are parsed once in the crop template
+        template = get_crop_template(parameters)
+        for spec in template.weather_alerts:
+            alert_class = alert_classes.get(spec.signal)
+            if alert_class is None:
+                msg = "Signal not recognized: %s" % spec.signal
                 raise PCSEError(msg)
-        
+            self.weather_alerts.append(alert_class(day, kiosk, spec.parameter_values(), run_date=run_date))
+        self._active_alerts = list(self.weather_alerts)
+
     def calc_rates(self, day, drv):
         """Calculate the rates of change given the current states and driving
         variables (drv).
@@ -84,7 +90,7 @@ class WeatherAlerts(SimulationObject):
         :param day: current day of pcse simulation
         :param drv: dict with drivers
         """
-        for alert in self.weather_alerts:
+        for alert in self._active_alerts:
             alert.calc_rates(day, drv)
 
     def integrate(self, day, delt=1.0):
@@ -93,18 +99,38 @@ class WeatherAlerts(SimulationObject):
         :param day: current day of pcse simulation
         :param delt: integer for calculating every delt days; in this case 1
         """
-        
-        for alert in self.weather_alerts:
+        for alert in self._active_alerts:
             alert.integrate(day, delt)
 
+        # Alerts are not sent beyond their horizon, so they are no longer evaluated
+        if any(alert.alert_horizon <= day for alert in self._active_alerts):
+            self._active_alerts = [alert for alert in self._active_alerts if alert.alert_horizon > day]
+
+    def get_snapshot(self):
+        """Returns the counters of all weather alerts as a list of dicts, see `restore_snapshot()`.
+        """
+        return [alert.get_snapshot() for alert in self.weather_alerts]
+
+    def restore_snapshot(self, snapshot):
+        """Restores the counters of all weather alerts from a snapshot taken with `get_snapshot()`.
+
+        :param snapshot: list with a dict with the counters of each weather alert
+        """
+        if len(snapshot) != len(self.weather_alerts):
+            msg = "Snapshot has %i weather alerts, expected %i" % (len(snapshot), len(self.weather_alerts))
+            raise PCSEError(msg)
+        for alert, alert_snapshot in zip(self.weather_alerts, snapshot):
+            alert.restore_snapshot(alert_snapshot)
+
 
 class GenericWeatherAlert(SimulationObject):
     """Super class for defining weather alerts. Only to be inherited from.
     """
     signal = None
     weather_alert_limit = None
+    alert_horizon = None
 
-    def __init__(self, day, kiosk, parameters):
+    def __init__(self, day, kiosk, parameters, run_date=None):
 
         if self.signal is None:
             msg = "self.signal should be defined as class atttribute in class definition of weather alert."
@@ -114,18 +140,32 @@ class GenericWeatherAlert(SimulationObject):
         # Get default for weather alert limit
         default = config.simulator.weather_alert_limit["DEFAULT"]
         self.weather_alert_limit = config.simulator.weather_alert_limit.get(self.signal, default)
+        # The last day at which the alert can be sent
+        if run_date is None:
+            run_date = datetime.date.today()
+        self.alert_horizon = run_date + datetime.timedelta(days=self.weather_alert_limit)
 
         SimulationObject.__init__(self, day, kiosk, parameters)
 
+    def get_snapshot(self):
+        """Returns the counters of consecutive days exceeding the threshold (NDAYS_*) as a dict.
+
+        The flags (FLAG_*) are not included as they are computed again in calc_rates().
+        """
+        return {name: getattr(self, name) for name in self.trait_names() if name.startswith("NDAYS_")}
+
+    def restore_snapshot(self, snapshot):
+        """Restores the counters from a snapshot taken with `get_snapshot()`.
+        """
+        for name, value in snapshot.items():
+            setattr(self, name, value)
+
     def _valid_alert(self, day):
         """Determine if we are within the range where weather data can be trusted
         Either observed (past) data or a day of the weather forecasting within the range
         that we trust the forecast (defined by config.simulator.weather_alert_limit)
         """
-        if (day - datetime.date.today()).days <= self.weather_alert_limit:
-            return True
-        else:
-            return False
+        return day <= self.alert_horizon
 
 
 # Weather alert 1: Heat stress, if Tmax > Tcrit for x number of consecutive days
@@ -296,12 +336,7 @@ class RHMAXStressThreshold(GenericWeatherAlert):
         :param drv: dict with drivers
         """
         
-        # Daily average saturated vapour pressure [kPa] from min&max air temperature
-        SVAP_TMAX = SatVapourPressure(drv.TMAX)
-        SVAP_TMIN = SatVapourPressure(drv.TMIN)
-        SVAP = (SVAP_TMAX + SVAP_TMIN) / 2.
-        # Relative humidity from SVAP and VAP in [%]
-        RH = 100 * np.minimum(hPa2kPa(drv.VAP), SVAP)/SVAP        
+        RH = relative_humidity(drv)
         
         # IF (actual BBCH_CURRENT_STAGE equals set_BBCH) AND (RH > RHcrit) THAN set FLAG = 1, otherwise FLAG = 0
         BBCH = self.kiosk["BBCH_CURRENT_STAGE"]
@@ -322,12 +357,6 @@ class RHMAXStressThreshold(GenericWeatherAlert):
         :param delt: integer for calculating every delt days; in this case 1
         """
 
-        # First determine if we are within the range where weather data can be trusted
-        # Either observed (past) data or a day of the weather forecasting with the range
-        # of self.weather_alert_limit
-        if (day - datetime.date.today()).days < self.weather_alert_limit:
-            valid_weather = True
-
         # Calculate duration: count number of consecutive days when FLAG = 1
         #  When number of consequtive days equals RHmax_duration than sent message and re-set FLAG to 0
         if self.FLAG_RHMAX_CRIT:
@@ -444,12 +473,8 @@ class FOGthreshold(GenericWeatherAlert):
         :param drv: dict with drivers
         """        
         
-        # Daily average saturated vapour pressure [kPa] from min&max air temperature
-        SVAP_TMAX = SatVapourPressure(drv.TMAX)
-        SVAP_TMIN = SatVapourPressure(drv.TMIN)
-        SVAP = (SVAP_TMAX + SVAP_TMIN) / 2.
-        # Relative humidity from SVAP and VAP in [%]
-        RH = 100 * np.minimum(hPa2kPa(drv.VAP), SVAP)/SVAP
+        RH = relative_humidity(drv)
+        DOY = day_of_year(day, drv)
         
         # IF (actual BBCH_CURRENT_STAGE equals set_BBCH) AND (Tmin < Tcrit) AND (RH > RHcrit) AND
         # (Wind < Windcrit) THAN set FLAG = 1, otherwise FLAG = 0
@@ -463,7 +488,7 @@ class FOGthreshold(GenericWeatherAlert):
             TMIN_CRIT = self.params.TMIN_CRIT[index]
             self.FLAG_FOG_CRIT = 1 if (RH >= RHMAX_CRIT and
                                        drv.WIND <= UMIN_CRIT and
-                                       (int(day.strftime('%j')) > 336 or int(day.strftime('%j')) < 60) and
+                                       (DOY > 336 or DOY < 60) and
                                        drv.TMIN <= TMIN_CRIT) else 0
         else:
             # Otherwise set FLAG = 0
@@ -492,3 +517,11 @@ class FOGthreshold(GenericWeatherAlert):
                               message_no=self.params.MESSAGE_NO, message=self.params.MESSAGE)
             # Set NDAYS_MAX_CRIT back to zero
             self.NDAYS_FOG_CRIT = 0
+
+
+# Weather alert simulation objects for the signals in the WEATHER_ALERTS table
+alert_classes = {"TMAX_STRESS": TmaxStressThreshold,
+                 "TMIN_STRESS": TminStressThreshold,
+                 "RAIN_STRESS": RainStressThreshold,
+                 "RHMAX_STRESS": RHMAXStressThreshold,
+                 "FOG": FOGthreshold}
@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+# Copyright Alterra, Wageningen-UR
+# Allard de Wit (allard.dewit@wur.nl), March 2023
+"""Local archive of the grid weather data for reading weather data without database queries.
+
+The archive holds the weather data of all grid cells for a fixed period, taken from the
+observed weather data and the long term average (LTA) weather data in the database. It is
+written by an export job after each daily load of observed weather data, e.g. from cron::
+
+    python -m phenology.weather_archive 2023-01-01 2024-12-31
+
+Each export is stored in a directory named after the last day of observed weather data, holding
+a (grid cells x days) float32 array for each weather variable as NumPy file. The arrays are
+memory-mapped when read, so retrieving the weather data of a grid cell only reads the rows of
+that grid cell and all (uWSGI) workers share the same pages of the operating system cache.
+The `ArchiveWeatherDataProvider` combines the weather data from the archive with the weather
+forecast from the forecast store.
+
+Layout of the archive::
+
+    <directory>/<last observed day as YYYYMMDD>/meta.json
+                                               /grid_no.npy
+                                               /TMAX.npy, TMIN.npy, VAP.npy, WIND.npy, RAIN.npy,
+                                                IRRAD.npy, ET0.npy
+"""
+import argparse
+import datetime as dt
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+import numpy as np
+
+import config
+from pcse.exceptions import PCSEError
+from pcse.base_classes import WeatherDataProvider
+from pcse.util import check_date
+from . import data_providers as dp
+from . import forecast_store
+from . import instrumentation
+
+logger = logging.getLogger(__name__)
+
+# Weather variables in the archive, in the units used by PCSE. ES0 and E0 are taken from ET0,
+# like for the weather data from the database.
+archive_variables = ("TMAX", "TMIN", "VAP", "WIND", "RAIN", "IRRAD", "ET0")
+
+
+class WeatherArchive(object):
+    """Memory-mapped archive of the grid weather data, one directory per export.
+
+    :param directory: the directory of the archive, defaults to `config.weather.weather_archive_directory`
+    :param keep_exports: the number of exports kept in the archive, defaults to
+        `config.weather.weather_archive_keep_exports`
+    """
+
+    def __init__(self, directory=None, keep_exports=None):
+        self.directory = config.weather.weather_archive_directory if directory is None else directory
+        self.keep_exports = config.weather.weather_archive_keep_exports if keep_exports is None else keep_exports
+        os.makedirs(self.directory, exist_ok=True)
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self._lock = threading.Lock()
+        self._export = None
+        self._listing = None
+        self._listing_mtime = None
+
+    def _export_dir(self, weather_version):
+        return os.path.join(self.directory, weather_version.strftime("%Y%m%d"))
+
+    def exports(self):
+        """Returns the sorted list of weather versions (last days of observed weather data) of
+        the exports in the archive."""
+        # The listing only changes when an export is added or removed, which changes the mtime
+        mtime = os.stat(self.directory).st_mtime
+        with self._lock:
+            if self._listing is not None and mtime == self._listing_mtime:
+                return self._listing
+        versions = []
+        for name in os.listdir(self.directory):
+            try:
+                version = dt.datetime.strptime(name, "%Y%m%d").date()
+            except ValueError:
+                continue
+            if os.path.exists(os.path.join(self.directory, name, "meta.json")):
+                versions.append(version)
+        versions.sort()
+        with self._lock:
+            self._listing, self._listing_mtime = versions, mtime
+        return versions
+
+    def write(self, weather_version, first_day, ndays, grid_no, fetch):
+        """Writes a new export into the archive.
+
+        :param weather_version: the last day of observed weather data in the database
+        :param first_day: date object with the first day of the archive
+        :param ndays: the number of days in the archive
+        :param grid_no: array with the grid numbers
+        :param fetch: function returning a GridWeatherColumns object with the weather data for a
+            grid number, covering the period of the archive.
+        """
+        grid_no = np.sort(np.asarray(grid_no, dtype=np.int64))
+        # Write into a temporary directory first, so that readers never see a partial export
+        tmp_dir = tempfile.mkdtemp(dir=self.directory, suffix=".tmp")
+        try:
+            np.save(os.path.join(tmp_dir, "grid_no.npy"), grid_no)
+            arrays = {name: np.lib.format.open_memmap(os.path.join(tmp_dir, name + ".npy"), mode="w+",
+                                                      dtype=np.float32, shape=(len(grid_no), ndays))
+                      for name in archive_variables}
+            for i, g in enumerate(grid_no):
+                grid_weather = fetch(int(g))
+                for name in archive_variables:
+                    arrays[name][i] = grid_weather.columns[name][:ndays]
+                if (i + 1) % 1000 == 0:
+                    self.logger.info("Exported weather data for %i of %i grid cells." % (i + 1, len(grid_no)))
+            for values in arrays.values():
+                values.flush()
+            del arrays
+
+            meta = {"weather_version": weather_version.strftime("%Y-%m-%d"),
+                    "first_day": first_day.strftime("%Y-%m-%d"),
+                    "ndays": ndays}
+            with open(os.path.join(tmp_dir, "meta.json"), "w") as fp:
+                json.dump(meta, fp)
+
+            export_dir = self._export_dir(weather_version)
+            if os.path.exists(export_dir):
+                shutil.rmtree(export_dir)
+            os.rename(tmp_dir, export_dir)
+        except Exception:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+
+        self.logger.info("Exported weather data until %s for %i grid cells and %i days." %
+                         (weather_version, len(grid_no), ndays))
+        self._prune()
+
+    def _prune(self):
+        """Removes the oldest exports beyond the number of exports to keep."""
+        for version in self.exports()[:-self.keep_exports]:
+            shutil.rmtree(self._export_dir(version), ignore_errors=True)
+
+    def _open(self):
+        """Returns the memory-mapped arrays of the most recent export, opened once per process
+        and again when a new export has been written."""
+        versions = self.exports()
+        if not versions:
+            msg = "No weather data available in the weather archive at %s" % self.directory
+            raise PCSEError(msg)
+        export_dir = self._export_dir(versions[-1])
+        meta_fname = os.path.join(export_dir, "meta.json")
+        mtime = os.stat(meta_fname).st_mtime
+        with self._lock:
+            export = self._export
+        if export is not None and export["directory"] == export_dir and export["mtime"] == mtime:
+            return export
+
+        with open(meta_fname) as fp:
+            meta = json.load(fp)
+        export = {"directory": export_dir,
+                  "mtime": mtime,
+                  "weather_version": dt.datetime.strptime(meta["weather_version"], "%Y-%m-%d").date(),
+                  "first_day": dt.datetime.strptime(meta["first_day"], "%Y-%m-%d").date(),
+                  "ndays": meta["ndays"],
+                  "grid_no": np.load(os.path.join(export_dir, "grid_no.npy")),
+                  "arrays": {name: np.load(os.path.join(export_dir, name + ".npy"), mmap_mode="r")
+                             for name in archive_variables}}
+        with self._lock:
+            self._export = export
+        return export
+
+    @property
+    def weather_version(self):
+        """The last day of observed weather data in the most recent export."""
+        return self._open()["weather_version"]
+
+    def get_grid_weather(self, grid_no, start_date=None, end_date=None):
+        """Returns the weather data of a grid cell from the most recent export.
+
+        :param grid_no: the grid number
+        :param start_date: first day of the weather data, defaults to the first day of the archive
+        :param end_date: last day of the weather data, defaults to the last day of the archive
+        :return: a tuple with the weather version and a GridWeatherColumns object. Days outside
+            the period of the archive are not included.
+        """
+        export = self._open()
+        i = int(np.searchsorted(export["grid_no"], grid_no))
+        if i >= len(export["grid_no"]) or export["grid_no"][i] != grid_no:
+            msg = "No weather data available for grid %s in the weather archive" % grid_no
+            raise PCSEError(msg)
+
+        first_ordinal = export["first_day"].toordinal()
+        start = 0 if start_date is None else max(start_date.toordinal() - first_ordinal, 0)
+        stop = export["ndays"] if end_date is None else min(end_date.toordinal() - first_ordinal + 1,
+                                                           export["ndays"])
+        if start >= stop:
+            msg = "No weather data available for grid %s between %s and %s in the weather archive" % \
+                  (grid_no, start_date, end_date)
+            raise PCSEError(msg)
+
+        # Only the slice of the grid cell is read from the memory-mapped arrays
+        with instrumentation.stage("grid_weather") as s:
+            columns = {name: np.asarray(values[i, start:stop], dtype=np.float64)
+                       for name, values in export["arrays"].items()}
+            s.rows = stop - start
+            s.bytes = sum(values[i, start:stop].nbytes for values in export["arrays"].values())
+        columns["ES0"] = columns["ET0"]
+        columns["E0"] = columns["ET0"]
+        first_day = dt.date.fromordinal(first_ordinal + start)
+        return export["weather_version"], dp.GridWeatherColumns(first_day, columns)
+
+
+class ArchiveWeatherDataProvider(dp.CombinedECMWFDarkSkyWeatherDataProvider):
+    """Same as `CombinedECMWFDarkSkyWeatherDataProvider`, but the grid weather data are read
+    from the weather archive instead of the database.
+
+    :param latitude: Latitude of location to retrieve weather data
+    :param longitude: Longitude of location to retrieve weather data
+    :param grid_no: grid_no of the location, if already known this avoids retrieving it again.
+    :param elevation: elevation of the grid, must be provided together with grid_no
+    :param start_date: first day of the weather data to retrieve
+    :param end_date: last day of the weather data to retrieve, the window is extended to the last
+        day of the weather forecast when that is later.
+    :param archive: the WeatherArchive, defaults to the weather archive of this process
+
+    The values in the archive are float32, so they equal the values in the database up to the
+    precision of float32.
+    """
+
+    def __init__(self, latitude, longitude, grid_no=None, elevation=None, start_date=None, end_date=None,
+                 archive=None):
+
+        WeatherDataProvider.__init__(self)
+
+        self.latitude = float(latitude)
+        self.longitude = float(longitude)
+        self.elevation = -999
+        if archive is None:
+            archive = get_weather_archive()
+
+        if grid_no is None:
+            self._fetch_location_from_db()
+        else:
+            self.grid_no = grid_no
+            self.elevation = elevation
+
+        self.forecast_issue_day, forecast = forecast_store.get_forecast_store().get_forecast(self.grid_no)
+        if start_date is not None and end_date is not None:
+            self.window = (check_date(start_date), max(check_date(end_date), forecast.index[-1].date()))
+            self.weather_version, self.grid_weather = archive.get_grid_weather(self.grid_no, *self.window)
+        else:
+            self.weather_version, self.grid_weather = archive.get_grid_weather(self.grid_no)
+        if not self.grid_weather.available.any():
+            msg = "No grid weather data available for grid %s" % self.grid_no
+            raise PCSEError(msg)
+        self.weather_data = self.grid_weather.to_frame()
+        self._integrate_DarkSky_forecast(forecast)
+        self._compute_derived_variables()
+        self._freeze_weather_data()
+
+        self.description = ["Weather data derived for area %s from the weather archive" % config.area_name]
+
+
+def export_weather_archive(first_day, last_day, archive=None):
+    """Exports the grid weather data from the database into the weather archive.
+
+    :param first_day: date object with the first day of the archive
+    :param last_day: date object with the last day of the archive
+    :param archive: the WeatherArchive, defaults to the weather archive of this process
+    """
+    if archive is None:
+        archive = get_weather_archive()
+    grid_index = dp.get_grid_index()
+    ndays = (last_day - first_day).days + 1
+
+    connection = dp.connect_weather_db()
+    try:
+        weather_version = dp.fetch_weather_version(connection)
+
+        def fetch(grid_no):
+            return dp.fetch_grid_weather_window(connection, grid_no, first_day, last_day)
+
+        archive.write(weather_version, first_day, ndays, grid_index.grid_no, fetch)
+    finally:
+        connection.close()
+
+
+# The weather archive used by this process, created on first use
+_weather_archive = None
+
+
+def get_weather_archive():
+    """Returns the weather archive used by this process.
+    """
+    global _weather_archive
+    if _weather_archive is None:
+        _weather_archive = WeatherArchive()
+    return _weather_archive
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Export the grid weather data into the weather archive.")
+    parser.add_argument("first_day", help="First day of the archive as YYYY-MM-DD")
+    parser.add_argument("last_day", help="Last day of the archive as YYYY-MM-DD")
+    args = parser.parse_args(args)
+
+    first_day = dt.datetime.strptime(args.first_day, "%Y-%m-%d").date()
+    last_day = dt.datetime.strptime(args.last_day, "%Y-%m-%d").date()
+    if last_day < first_day:
+        parser.error("last_day before first_day")
+    export_weather_archive(first_day, last_day)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+# Copyright Alterra, Wageningen-UR
+# Allard de Wit (allard.dewit@wur.nl), March 2023
+"""Cache for weather data providers which is keyed on the grid cell.
+
+Many requests resolve to the same grid cell, while the weather data for a grid cell only
+change once a day: when new observed weather data are loaded into the database and when
+a new weather forecast is issued. Therefore, a weather data provider is built once for each
+grid cell and shared among all requests for that grid cell until one of these events occurs.
+
+Providers can be restricted to the window of weather data needed by a simulation. A cached
+provider is reused for any window it covers, otherwise it is replaced by a provider for a window
+covering both the cached and the requested window.
+
+The cache is local to the process, so each (uWSGI) worker holds its own cache.
+"""
+from collections import OrderedDict
+import threading
+import time
+import logging
+
+import config
+from . import data_providers as dp
+from . import weather_archive
+from . import instrumentation
+
+
+class GridWeatherCache(object):
+    """Least-recently-used cache of `CombinedECMWFDarkSkyWeatherDataProvider` objects keyed on grid_no.
+
+    :param maxsize: the maximum number of grid cells kept in the cache, defaults to
+        `config.simulator.weather_cache_size`
+    :param version_check_interval: the interval (seconds) for checking if new observed weather
+        data have been loaded, defaults to `config.simulator.weather_version_check_interval`
+
+    Entries are invalidated when the forecast they contain was issued before the current
+    forecast issue day. The entire cache is flushed when a new load of observed weather data
+    is detected in the database.
+    """
+
+    def __init__(self, maxsize=None, version_check_interval=None):
+        self.maxsize = config.simulator.weather_cache_size if maxsize is None else maxsize
+        self.version_check_interval = config.simulator.weather_version_check_interval \
+            if version_check_interval is None else version_check_interval
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self._providers = OrderedDict()
+        self._lock = threading.RLock()
+        self._weather_version = None
+        self._version_checked_at = None
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get_provider(self, latitude, longitude, start_date=None, end_date=None):
+        """Returns the weather data provider for the grid cell that contains latitude/longitude.
+
+        :param latitude: Latitude of location to retrieve weather data
+        :param longitude: Longitude of location to retrieve weather data
+        :param start_date: first day of the weather data needed, see `dp.simulation_window()`
+        :param end_date: last day of the weather data needed
+        :return: a CombinedECMWFDarkSkyWeatherDataProvider instance, which is shared by
+            all locations within the same grid cell.
+
+        Without start_date and end_date the provider holds all weather data of the grid cell.
+        """
+        grid_no, elevation = dp.fetch_grid_location(latitude, longitude)
+        self._check_weather_version()
+
+        wdp, window = self._lookup(grid_no, start_date, end_date)
+        if wdp is None:
+            if config.weather.use_weather_archive:
+                provider = weather_archive.ArchiveWeatherDataProvider
+            else:
+                provider = dp.CombinedECMWFDarkSkyWeatherDataProvider
+            with instrumentation.stage("weather") as s:
+                wdp = provider(latitude, longitude, grid_no=grid_no, elevation=elevation,
+                               start_date=window[0], end_date=window[1])
+                s.rows = len(wdp.weather_data)
+            self._store(grid_no, wdp)
+
+        return wdp
+
+    def _lookup(self, grid_no, start_date=None, end_date=None):
+        """Returns a tuple with the cached provider for grid_no, or None if not available, outdated
+        or not covering the requested window, and the window for retrieving a new provider.
+        """
+        window = (None, None) if start_date is None or end_date is None else (start_date, end_date)
+        with self._lock:
+            wdp = self._providers.get(grid_no)
+            if wdp is not None and wdp.forecast_issue_day != dp.current_forecast_issue_day():
+                del self._providers[grid_no]
+                self.invalidations += 1
+                wdp = None
+            if wdp is not None and not wdp.covers(*window):
+                # The new provider also covers the window of the cached provider
+                if window[0] is not None:
+                    window = (min(window[0], wdp.window[0]), max(window[1], wdp.window[1]))
+                wdp = None
+            if wdp is None:
+                self.misses += 1
+            else:
+                self._providers.move_to_end(grid_no)
+                self.hits += 1
+            return wdp, window
+
+    def _store(self, grid_no, wdp):
+        """Stores the provider for grid_no and evicts the least recently used grid cells.
+
+        Providers are built outside the lock, so the cache may have been flushed for a new load
+        of observed weather data in the meantime. Providers holding another load of observed
+        weather data than the cache are not stored.
+        """
+        with self._lock:
+            if wdp.weather_version != self._weather_version:
+                self.logger.debug("Weather data of grid %s until %s do not match the weather cache (%s), "
+                                  "not stored." % (grid_no, wdp.weather_version, self._weather_version))
+                return
+            self._providers[grid_no] = wdp
+            self._providers.move_to_end(grid_no)
+            while len(self._providers) > self.maxsize:
+                self._providers.popitem(last=False)
+                self.evictions += 1
+
+    def _check_weather_version(self):
+        """Flushes the cache when a new load of observed weather data is found in the database,
+        or in the weather archive when the providers read from the archive.
+
+        The database is only checked once every `self.version_check_interval` seconds.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if self._version_checked_at is not None and \
+                    (now - self._version_checked_at) < self.version_check_interval:
+                return
+            self._version_checked_at = now
+
+        if config.weather.use_weather_archive:
+            version = weather_archive.get_weather_archive().weather_version
+        else:
+            connection = dp.connect_weather_db()
+            try:
+                version = dp.fetch_weather_version(connection)
+            finally:
+                connection.close()
+        with self._lock:
+            if version != self._weather_version:
+                if self._weather_version is not None:
+                    msg = "New observed weather data until %s, flushing weather cache." % version
+                    self.logger.info(msg)
+                self.invalidations += len(self._providers)
+                self._providers.clear()
+                self._weather_version = version
+
+    def clear(self):
+        """Removes all grid cells from the cache.
+        """
+        with self._lock:
+            self._providers.clear()
+
+    @property
+    def weather_version(self):
+        """The version of the observed weather data of the providers in the cache.
+        """
+        return self._weather_version
+
+    def stats(self):
+        """Returns a dict with the hits, misses, evictions and invalidations of the cache.
+        """
+        with self._lock:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "invalidations": self.invalidations,
+                    "size": len(self._providers),
+                    "maxsize": self.maxsize}
+
+
+# The cache shared by all requests in this process, created on first use
+_grid_weather_cache = None
+
+
+def get_grid_weather_cache():
+    """Returns the weather cache shared by all requests in this process.
+    """
+    global _grid_weather_cache
+    if _grid_weather_cache is None:
+        _grid_weather_cache = GridWeatherCache()
+    return _grid_weather_cache
+
+
+def get_weather_provider(latitude, longitude, start_date=None, end_date=None):
+    """Returns the shared weather data provider for the grid cell containing latitude/longitude.
+
+    :param latitude: Latitude of location to retrieve weather data
+    :param longitude: Longitude of location to retrieve weather data
+    :param start_date: first day of the weather data needed, defaults to all weather data
+    :param end_date: last day of the weather data needed, defaults to all weather data
+    """
+    return get_grid_weather_cache().get_provider(latitude, longitude, start_date, end_date)
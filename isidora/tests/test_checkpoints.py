@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+# Copyright Alterra, Wageningen-UR
+# Allard de Wit (allard.dewit@wur.nl), March 2023
+"""Checks that runs continuing from a checkpoint give the same results as a run of the PCSE
+Engine from the sowing date, and that checkpoints are not used when the weather data changed.
+
+Run from the isidora directory with::
+
+    python -m unittest discover tests
+"""
+import copy
+import datetime as dt
+import unittest
+from unittest import mock
+
+import pandas as pd
+
+from phenology import checkpoints
+from tests.test_vectorized_phenology import (SyntheticWeatherDataProvider, crop_parameters, management_alerts,
+                                             weather_alerts, run_engine)
+
+
+def observed_until(wdp, day):
+    """Sets the last day of observed weather data of the provider, the forecast is issued the
+    next day."""
+    wdp.weather_version = day
+    wdp.forecast_issue_day = day + dt.timedelta(days=1)
+
+
+def revised_provider(wdp, day, change):
+    """Returns a copy of the weather data provider with change added to TMAX and TMIN on day."""
+    revised = copy.copy(wdp)
+    revised.weather_data = wdp.weather_data.copy()
+    revised.weather_data.loc[pd.Timestamp(day), ["TMAX", "TMIN"]] += change
+    revised._compute_derived_variables()
+    revised._freeze_weather_data()
+    return revised
+
+
+class TestRunWithCheckpoint(unittest.TestCase):
+
+    sowing_date = dt.date(2021, 3, 1)
+
+    def setUp(self):
+        self.wdp = SyntheticWeatherDataProvider(8, 21.3)
+        self.store = checkpoints.CheckpointStore(maxsize=10)
+
+    def run_with_checkpoint(self, wdp, run_date):
+        """Returns the results of run_with_checkpoint() and the snapshot the run started from."""
+        crop = dict(crop_parameters, MANAGEMENT_ALERTS=list(management_alerts),
+                    WEATHER_ALERTS=list(weather_alerts), RUN_DATE=run_date)
+        with mock.patch.object(checkpoints, "_start_engine", wraps=checkpoints._start_engine) as start_engine:
+            results = checkpoints.run_with_checkpoint(wdp, self.sowing_date, crop, "plot", self.store)
+        if start_engine.call_args is None:
+            # The simulation finished before the checkpoint day, its results are in the checkpoint
+            return results, self.store.get("plot").snapshot
+        args = start_engine.call_args[0]
+        return results, args[4] if len(args) > 4 else None
+
+    def assertSameAsFullRun(self, wdp, run_date, results):
+        engine = run_engine(wdp, self.sowing_date, crop_parameters, run_date)
+        self.assertEqual(engine.get_variable("BBCH_DATES"), results[0])
+        self.assertEqual(engine.get_variable("WEATHER_MESSAGES"), results[1])
+        self.assertEqual(engine.get_variable("MANAGEMENT_MESSAGES"), results[2])
+
+    def test_restored_run_equals_full_run(self):
+        for days in (20, 45, 80, 120, 200):
+            day = self.sowing_date + dt.timedelta(days=days)
+            observed_until(self.wdp, day)
+            run_date = day + dt.timedelta(days=1)
+            results, snapshot = self.run_with_checkpoint(self.wdp, run_date)
+            # The first run is simulated from the sowing date, the others from the checkpoint
+            self.assertEqual(snapshot is None, days == 20)
+            self.assertSameAsFullRun(self.wdp, run_date, results)
+
+    def test_revised_weather_before_checkpoint(self):
+        day = self.sowing_date + dt.timedelta(days=60)
+        observed_until(self.wdp, day)
+        run_date = day + dt.timedelta(days=1)
+        self.run_with_checkpoint(self.wdp, run_date)
+
+        revised = revised_provider(self.wdp, self.sowing_date + dt.timedelta(days=30), 4.)
+        observed_until(revised, day + dt.timedelta(days=1))
+        run_date += dt.timedelta(days=1)
+        results, snapshot = self.run_with_checkpoint(revised, run_date)
+        self.assertIsNone(snapshot)
+        self.assertSameAsFullRun(revised, run_date, results)
+
+    def test_later_run_date_within_horizon(self):
+        day = self.sowing_date + dt.timedelta(days=60)
+        observed_until(self.wdp, day)
+        self.run_with_checkpoint(self.wdp, day + dt.timedelta(days=1))
+
+        # The run date is not part of the checkpoint, it is reused as long as the checkpoint
+        # day is not beyond the alert horizon of the run
+        run_date = day + dt.timedelta(days=5)
+        results, snapshot = self.run_with_checkpoint(self.wdp, run_date)
+        self.assertIsNotNone(snapshot)
+        self.assertSameAsFullRun(self.wdp, run_date, results)
+
+        run_date = day - dt.timedelta(days=10)
+        results, snapshot = self.run_with_checkpoint(self.wdp, run_date)
+        self.assertIsNone(snapshot)
+        self.assertSameAsFullRun(self.wdp, run_date, results)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+# Copyright Alterra, Wageningen-UR
+# Allard de Wit (allard.dewit@wur.nl), March 2023
+"""Checks that the phenology from the thermal time index equals the phenology simulated by the
+vectorized phenology model.
+
+Run from the isidora directory with::
+
+    python -m unittest discover tests
+"""
+import copy
+import datetime as dt
+import unittest
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+
+from phenology import thermal_time
+from phenology import vectorized_phenology
+from tests.test_vectorized_phenology import SyntheticWeatherDataProvider, crop_parameters
+
+
+def revised_provider(wdp, first_day=None, change_from=None, change=0.):
+    """Returns a copy of the weather data provider starting at first_day, with change added to
+    TMAX and TMIN from change_from onwards, like a revised forecast."""
+    revised = copy.copy(wdp)
+    weather_data = wdp.weather_data.copy()
+    if first_day is not None:
+        weather_data = weather_data[weather_data.index >= pd.Timestamp(first_day)]
+    if change_from is not None:
+        weather_data.loc[weather_data.index >= pd.Timestamp(change_from), ["TMAX", "TMIN"]] += change
+    revised.weather_data = weather_data
+    revised._compute_derived_variables()
+    revised._freeze_weather_data()
+    return revised
+
+
+class TestThermalTimeIndex(unittest.TestCase):
+
+    def assertSamePhenology(self, expected, result, msg=None):
+        self.assertEqual(expected.BBCH_DATES, result.BBCH_DATES, msg)
+        self.assertEqual(expected.end_day, result.end_day, msg)
+        np.testing.assert_allclose(result.DVS, expected.DVS, rtol=1e-12, err_msg=msg or "")
+
+    def compare(self, snapshot, model, wdp, sowing_dates):
+        for sowing_date in sowing_dates:
+            expected = model.run(wdp, sowing_date, crop_parameters["MAX_DURATION"])
+            result = snapshot.query(model, sowing_date, crop_parameters["MAX_DURATION"])
+            self.assertSamePhenology(expected, result, "sowing date %s" % sowing_date)
+
+    def test_query_equals_simulation(self):
+        for idsl, latitude in [(0, 21.3), (1, 16.8)]:
+            wdp = SyntheticWeatherDataProvider(4, latitude)
+            model = vectorized_phenology.VectorizedBBCHPhenology(dict(crop_parameters, PHENO_IDSL=idsl))
+            snapshot = thermal_time.ThermalTimeIndex(model).update(wdp)
+            sowing_dates = [wdp.first_date + dt.timedelta(days=k) for k in range(0, 600, 7)]
+            self.compare(snapshot, model, wdp, sowing_dates)
+
+    def test_incremental_update(self):
+        wdp = SyntheticWeatherDataProvider(5, 21.3)
+        model = vectorized_phenology.VectorizedBBCHPhenology(crop_parameters)
+        index = thermal_time.ThermalTimeIndex(model)
+        snapshot = index.update(wdp)
+
+        # Revised tail of the weather data in a provider with a later window
+        change_from = wdp.first_date + dt.timedelta(days=500)
+        revised = revised_provider(wdp, first_day=wdp.first_date + dt.timedelta(days=100),
+                                   change_from=change_from, change=1.5)
+        revised_snapshot = index.update(revised)
+        self.assertEqual(index.updates, 2)
+        self.assertEqual(index.updated_days, len(snapshot) + (wdp.last_date - change_from).days + 1)
+        sowing_dates = [revised.first_date + dt.timedelta(days=k) for k in range(0, 600, 5)]
+        self.compare(revised_snapshot, model, revised, sowing_dates)
+
+        # The snapshot of the first provider is not affected by the update for the revised provider
+        self.compare(snapshot, model, wdp, sowing_dates)
+        self.assertIs(index.update(wdp), snapshot)
+        self.assertEqual(index.updates, 2)
+
+    def test_ambiguous_temperature_sum(self):
+        wdp = SyntheticWeatherDataProvider(6, 21.3)
+        sowing_date = wdp.first_date + dt.timedelta(days=30)
+        model = vectorized_phenology.VectorizedBBCHPhenology(crop_parameters)
+        DVS = model.run(wdp, sowing_date, crop_parameters["MAX_DURATION"]).DVS
+
+        # A BBCH temperature sum that is exactly reached on a day needs the simulation
+        crop = dict(crop_parameters, BBCH_30=float(DVS[40]))
+        model = vectorized_phenology.VectorizedBBCHPhenology(crop)
+        snapshot = thermal_time.ThermalTimeIndex(model).update(wdp)
+        with mock.patch.object(model, "_simulate", wraps=model._simulate) as simulate:
+            result = snapshot.query(model, sowing_date, crop["MAX_DURATION"])
+        self.assertEqual(simulate.call_count, 1)
+        self.assertSamePhenology(model.run(wdp, sowing_date, crop["MAX_DURATION"]), result)
+
+    def test_query_phenology(self):
+        wdp = SyntheticWeatherDataProvider(7, 21.3)
+        wdp.grid_no = 1
+        sowing_date = wdp.first_date + dt.timedelta(days=60)
+        expected = vectorized_phenology.VectorizedBBCHPhenology(crop_parameters).run(
+            wdp, sowing_date, crop_parameters["MAX_DURATION"])
+        self.assertSamePhenology(expected, thermal_time.query_phenology(wdp, sowing_date, crop_parameters))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+# Copyright Alterra, Wageningen-UR
+# Allard de Wit (allard.dewit@wur.nl), March 2023
+"""Checks that the vectorized phenology model and alert evaluators give the same results as the
+simulation objects in the PCSE Engine.
+
+Run from the isidora directory with::
+
+    python -m unittest discover tests
+"""
+from collections import namedtuple
+import datetime as dt
+import unittest
+
+import numpy as np
+import pandas as pd
+
+import config
+from pcse.base_classes import WeatherDataProvider
+from pcse.engine import Engine
+from phenology import data_providers as dp
+from phenology import vectorized_alerts
+from phenology import vectorized_phenology
+
+WeatherAlert = namedtuple("WeatherAlert", "signal parameters message_no weather_msg")
+ManagementAlert = namedtuple("ManagementAlert", "BBCH_code message_no management_msg offset_days crop_no variety_no")
+
+crop_parameters = {"PHENO_TBASE": 8., "PHENO_TOPT1": 25., "PHENO_TOPT2": 30., "PHENO_TMAX": 40.,
+                   "PHENO_DLC": 10., "PHENO_DLO": 12.5, "PHENO_IDSL": 0,
+                   "BBCH_00": 0., "BBCH_10": 50., "BBCH_13": 120., "BBCH_30": 400., "BBCH_61": 800.,
+                   "BBCH_89": 1500., "MAX_DURATION": 150}
+
+weather_alerts = [
+    WeatherAlert("TMAX_STRESS", "{'TMAX_CRIT': [31.0, 33.0], 'TMAX_STRESS_DURATION': 1, "
+                                "'TMAX_CRIT_BBCH': ['BBCH_10', 'BBCH_30']}", 101, "High temperature"),
+    WeatherAlert("TMIN_STRESS", "{'TMIN_CRIT': [22.0], 'TMIN_STRESS_DURATION': 0, "
+                                "'TMIN_CRIT_BBCH': ['BBCH_13']}", 102, "Low temperature"),
+    WeatherAlert("RAIN_STRESS", "{'RAIN_CRIT': [0.5, 1.0], 'RAIN_DURATION': 1, "
+                                "'RAIN_CRIT_BBCH': ['BBCH_00', 'BBCH_61']}", 103, "Heavy rain"),
+    WeatherAlert("RHMAX_STRESS", "{'RHMAX_CRIT': [60.0], 'RHMAX_STRESS_DURATION': 0, "
+                                 "'RHMAX_CRIT_BBCH': ['BBCH_30']}", 104, "High humidity"),
+    WeatherAlert("FOG", "{'RHMAX_CRIT': [40.0, 45.0], 'UMIN_CRIT': [4.0, 3.0], 'TMIN_CRIT': [26.0, 24.0], "
+                        "'FOG_DURATION': 0, "
+                        "'CRIT_BBCH': ['BBCH_10', 'BBCH_13'], 'FOG_RELEVANT_MONTHS': [1, 2, 3, 4, 11, 12]}",
+                 105, "Fog"),
+]
+
+management_alerts = [
+    ManagementAlert("BBCH_00", 201, "Apply basal fertilizer", 0, 1, -1),
+    ManagementAlert("BBCH_10", 202, "Check crop stand", 3, 1, -1),
+    ManagementAlert("BBCH_13", 203, "Weeding", -2, 1, -1),
+    ManagementAlert("BBCH_30", 204, "Top dressing", 1, 1, -1),
+    ManagementAlert("BBCH_61", 205, "Scout for pests", 0, 1, -1),
+    ManagementAlert("BBCH_89", 206, "Harvest", 5, 1, -1),
+]
+
+
+class SyntheticWeatherDataProvider(dp.CombinedECMWFDarkSkyWeatherDataProvider):
+    """Weather data provider with random weather data, derived variables are computed in the
+    same way as for the weather data from the database.
+
+    :param seed: seed of the random number generator
+    :param latitude: latitude of the location
+    :param first_day: first day of the weather data
+    :param ndays: number of days of weather data
+    """
+
+    def __init__(self, seed, latitude, first_day=dt.date(2021, 1, 1), ndays=800):
+        WeatherDataProvider.__init__(self)
+        self.latitude = latitude
+        self.longitude = 96.0
+        self.elevation = 10.
+
+        rng = np.random.default_rng(seed)
+        doy = np.arange(ndays)
+        tmax = 30. + 6. * np.sin(doy / 365. * 2 * np.pi) + rng.normal(0., 3., ndays)
+        tmin = tmax - 8. - rng.uniform(0., 6., ndays)
+        days = pd.date_range(first_day, periods=ndays, freq="D")
+        self.weather_data = pd.DataFrame({"TMAX": tmax.round(1), "TMIN": tmin.round(1),
+                                          "VAP": rng.uniform(10., 35., ndays).round(2),
+                                          "WIND": rng.uniform(0., 6., ndays).round(2),
+                                          "RAIN": np.where(rng.uniform(size=ndays) < .4,
+                                                           rng.exponential(1.5, ndays), 0.).round(2),
+                                          "IRRAD": rng.uniform(1e7, 2.5e7, ndays),
+                                          "ET0": .4, "ES0": .4, "E0": .4,
+                                          "LAT": latitude, "LON": self.longitude},
+                                         index=pd.Index(days, name="DAY"))
+        self._compute_derived_variables()
+        self._freeze_weather_data()
+        self.description = ["Synthetic weather data"]
+
+
+def run_engine(wdp, sowing_date, crop, run_date):
+    """Runs the PCSE Engine in the same way as `runners.GPRE_service_runner`."""
+    crop = dict(crop, MANAGEMENT_ALERTS=list(management_alerts), WEATHER_ALERTS=list(weather_alerts),
+                RUN_DATE=run_date)
+    pprovider = dp.make_parameter_provider(sowing_date, crop, crop_start_type=config.simulator.crop_start_type,
+                                           crop_end_type=config.simulator.crop_end_type)
+    engine = Engine(pprovider, wdp, config=config.simulator.simulator_config)
+    engine.run_till_terminate()
+    return engine
+
+
+class TestVectorizedPhenology(unittest.TestCase):
+
+    def compare(self, wdp, crop, sowing_dates, run_offsets):
+        """Compares the BBCH dates, the date of maturity and the weather and management messages
+        of the PCSE Engine and the vectorized models, returns the number of messages compared."""
+        model = vectorized_phenology.VectorizedBBCHPhenology(crop)
+        wevaluator = vectorized_alerts.WeatherAlertEvaluator(weather_alerts)
+        mevaluator = vectorized_alerts.ManagementAlertEvaluator(management_alerts)
+        nmessages = 0
+        for sowing_date in sowing_dates:
+            result = model.run(wdp, sowing_date, crop["MAX_DURATION"])
+            for offset in run_offsets:
+                run_date = sowing_date + dt.timedelta(days=offset)
+                engine = run_engine(wdp, sowing_date, crop, run_date)
+                msg = "sowing date %s, run date %s" % (sowing_date, run_date)
+
+                self.assertEqual(engine.get_variable("BBCH_DATES"), result.BBCH_DATES, msg)
+                self.assertEqual(engine.get_variable("DATE_OF_CROP_MATURITY"), result.DATE_OF_CROP_MATURITY, msg)
+                walerts = engine.get_variable("WEATHER_MESSAGES")
+                self.assertEqual(walerts, wevaluator.evaluate(result, run_date), msg)
+                malerts = engine.get_variable("MANAGEMENT_MESSAGES")
+                self.assertEqual(malerts, mevaluator.evaluate(result), msg)
+                nmessages += len(walerts) + len(malerts)
+        return nmessages
+
+    def test_without_daylength_sensitivity(self):
+        wdp = SyntheticWeatherDataProvider(1, 21.3)
+        crop = dict(crop_parameters, PHENO_IDSL=0)
+        sowing_dates = [dt.date(2021, 1, 1) + dt.timedelta(days=k) for k in range(0, 360, 45)]
+        self.assertGreater(self.compare(wdp, crop, sowing_dates, [2, 30, 80]), 0)
+
+    def test_with_daylength_sensitivity(self):
+        wdp = SyntheticWeatherDataProvider(2, 16.8)
+        crop = dict(crop_parameters, PHENO_IDSL=1, PHENO_DLC=13.5, PHENO_DLO=11.)
+        sowing_dates = [dt.date(2021, 1, 1) + dt.timedelta(days=k) for k in range(10, 360, 45)]
+        self.assertGreater(self.compare(wdp, crop, sowing_dates, [2, 30, 80]), 0)
+
+    def test_maturity_not_reached(self):
+        wdp = SyntheticWeatherDataProvider(3, 21.3)
+        crop = dict(crop_parameters, MAX_DURATION=40)
+        sowing_dates = [dt.date(2021, 1, 1) + dt.timedelta(days=k) for k in range(0, 360, 60)]
+        self.compare(wdp, crop, sowing_dates, [5, 30])
+        result = vectorized_phenology.VectorizedBBCHPhenology(crop).run(wdp, sowing_dates[0], crop["MAX_DURATION"])
+        self.assertLess(result.stage_days[-1], 0)
+        self.assertEqual(result.DATE_OF_CROP_MATURITY, sowing_dates[0] + dt.timedelta(days=40))
+
+    def test_daylength_off_grid_latitude(self):
+        # Locations within a grid cell share the daylength table of the grid latitude
+        vectorized_phenology.clear_daylength_tables()
+        table = vectorized_phenology.daylength_table(16.8)
+        self.assertIs(vectorized_phenology.daylength_table(16.8 + 0.3 * config.cell_size), table)
+        self.assertFalse(table.flags.writeable)
+
+        wdp = SyntheticWeatherDataProvider(4, 16.8 + 0.3 * config.cell_size)
+        crop = dict(crop_parameters, PHENO_IDSL=1, PHENO_DLC=13.5, PHENO_DLO=11.)
+        sowing_dates = [dt.date(2021, 1, 1) + dt.timedelta(days=k) for k in range(10, 360, 90)]
+        self.compare(wdp, crop, sowing_dates, [30])
+
+
+if __name__ == "__main__":
+    unittest.main()